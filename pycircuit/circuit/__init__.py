@@ -2,9 +2,10 @@ from circuit import *
 from elements import *
 from analysis import *
 from dcanalysis import *
+from initialguess import InitialGuess
 from symbolicdc import *
 from analysis_ss import *
 from nportanalysis import *
 import symbolic
 import numeric
-
+import sparse_numeric
@@ -12,8 +12,11 @@ from pycircuit.post.waveform import Waveform
 from pycircuit.post.result import IVResultDict
 from pycircuit.post.internalresult import InternalResultDict
 from copy import copy
+from contextlib import contextmanager
 import numeric
+import numpy as np
 import types
+import time
 
 class NoConvergenceError(Exception):
     pass
@@ -22,7 +25,12 @@ class SingularMatrix(Exception):
     pass
 
 class CircuitResult(IVResultDict, InternalResultDict):
-    """Result class for analyses that returns voltages and currents"""
+    """Result class for analyses that returns voltages and currents
+
+    The sweep_values of nested sweeps is a list of the sweep vectors with 
+    a tuple of the labels as sweep_label and of the units as sweep_unit.
+
+    """
     def __init__(self, circuit, x, xdot = None, 
                  sweep_values=[], sweep_label='', sweep_unit=''):
         super(CircuitResult, self).__init__()
@@ -38,10 +46,12 @@ class CircuitResult(IVResultDict, InternalResultDict):
 
     def build_waveform(self, result, ylabel, yunit):
         if hasattr(result, '__iter__'):
+            xlabels, xunits = self.sweep_label, self.sweep_unit
+            if type(xlabels) is not tuple:
+                xlabels, xunits = (xlabels,), (xunits,)
             return Waveform(self.sweep_values, result,
                             ylabel = ylabel, yunit = 'V', 
-                            xlabels = (self.sweep_label,), 
-                            xunits=(self.sweep_unit,))
+                            xlabels = xlabels, xunits = xunits)
         else:
             return result
 
@@ -61,18 +71,111 @@ class CircuitResult(IVResultDict, InternalResultDict):
         return self.build_waveform(result, 'i(%s)'%(str(term)), 'A')
 
 def remove_row_col(matrices, n, toolkit):
-    result = []
-    for A in matrices:
-        for axis in range(len(A.shape)):
-            A=toolkit.delete(A, [n], axis=axis)
-        result.append(A)
-    return tuple(result)
+    """Remove row and column n from vectors and matrices"""
+    if len(matrices) == 0:
+        return ()
+    reduction = RefnodeReduction(matrices[0].shape[0], n, toolkit)
+    return tuple(reduction.reduce(A) for A in matrices)
+
+class RefnodeReduction(object):
+    """Plan for removing the reference node from the circuit equations
+
+    The indices of the remaining rows and columns, the reduced-index vector,
+    are calculated once and are then used to reduce vectors and matrices 
+    and to expand solutions of the reduced system to full x-vectors. 
+
+    >>> import numpy as np
+    >>> reduction = RefnodeReduction(3, 1)
+    >>> reduction.reduce(np.arange(9.).reshape(3,3))
+    array([[ 0.,  2.],
+           [ 6.,  8.]])
+    >>> reduction.expand(np.array([1., 2.]))
+    array([ 1.,  0.,  2.])
+
+    """
+    def __init__(self, n, irefnode, toolkit=numeric):
+        self.n = n
+        self.irefnode = irefnode
+        self.toolkit = toolkit
+        self.indices = np.delete(np.arange(n), irefnode)
+        self._ix = np.ix_(self.indices, self.indices)
+
+    def reduce(self, A):
+        """Return vector or matrix A without the reference node row/column"""
+        if getattr(self.toolkit, 'sparse', False) and self.toolkit.issparse(A):
+            return A.tocsr()[self.indices][:, self.indices]
+        elif len(A.shape) == 1:
+            return A[self.indices]
+        else:
+            return A[self._ix]
+
+    def expand(self, x):
+        """Insert the reference node voltage in a solution of the reduced 
+        system
+
+        The reduced rows are the first axis of x so several solutions can be 
+        expanded at once.
+
+        """
+        xfull = np.zeros((self.n,) + x.shape[1:], dtype=x.dtype)
+        xfull[self.indices] = x
+        return xfull
+
+    def reduced_function(self, func):
+        """Return Newton function of the reduced system
+
+        func(x, *args) should return the residual vector and the 
+        jacobian of the full system.
+
+        """
+        def reduced(x, *args, **kvargs):
+            f, J = func(self.expand(x), *args, **kvargs)
+            return self.reduce(f), self.reduce(J)
+        return reduced
 
 class Analysis(sim.Analysis):
+    """Base class of circuit analyses
+
+    The analyses that solve the circuit equations by Newton iterations 
+    collect solver statistics in the stats dictionary that is also 
+    attached to the result. It holds the number of Newton solves (nsolves),
+    iterations (nit), function evaluations (nfev), jacobian factorizations
+    (nfactor), continuation or time steps (nsteps) and rejected steps 
+    (nrejected). The solver time in seconds (time) is split into the time 
+    in the residual and jacobian functions (time_func), of which the 
+    circuit assembly takes time_assembly and the device evaluation 
+    time_eval, and the time in the linear solver (time_solve).
+
+    If the trace parameter is True the residual and update norms of every
+    Newton iteration are appended to stats['norms']. If a monitor function
+    is given it is called as monitor(event, info) during the solve where 
+    event is 'iteration', 'step', 'rejected', 'breakpoint', 'stopped', 
+    'algorithm', 'shooting' or 'done' and info is a dictionary. The norms 
+    are only calculated when a monitor is given or trace is True.
+
+    If the bypass parameter is True the nonlinear elements whose x-vectors
+    have changed by less than bypasstol since their last evaluation are 
+    not evaluated, see the bypass attribute of Circuit. The number of 
+    element evaluations (ndevices), of bypassed evaluations (nbypass) and
+    the ratio of the two (bypassrate) are then added to the statistics.
+
+    """
     parameters = [Parameter(name='analysis', desc='Analysis name', 
                             default=None),
                   Parameter(name='epar', desc='Environment parameters',
-                            default=defaultepar)]
+                            default=defaultepar),
+                  Parameter(name='monitor', 
+                            desc='Function monitor(event, info) called '
+                            'with solver progress', default=None),
+                  Parameter(name='trace', 
+                            desc='Record residual and update norms of the '
+                            'Newton iterations', default=False),
+                  Parameter(name='bypass', 
+                            desc='Bypass the evaluation of latent nonlinear '
+                            'elements', default=False),
+                  Parameter(name='bypasstol', 
+                            desc='Maximum change of the x-vector of a '
+                            'bypassed element', unit='V', default=1e-6)]
 
     def __init__(self, cir, toolkit=None, **kvargs):
         
@@ -95,9 +198,104 @@ class Analysis(sim.Analysis):
         self.cir = cir
         self.result = None
         self.epar = epar
+        self.stats = None
+        self._reduction = None
+
+    @contextmanager
+    def _assembly_toolkit(self):
+        """Assemble the circuit matrices with the toolkit of the analysis
+
+        A sparse toolkit needs the circuit matrices to be assembled as 
+        sparse matrices so it replaces the toolkit of the circuit until the
+        block is left.
+
+        """
+        cir = self.cir
+        if not getattr(self.toolkit, 'sparse', False) or \
+                cir.toolkit is self.toolkit:
+            yield
+            return
+
+        toolkit = cir.toolkit
+        cir.toolkit = self.toolkit
+        try:
+            yield
+        finally:
+            cir.toolkit = toolkit
+
+    def _refnode_reduction(self, irefnode):
+        """Return the plan for removing the reference node 
+
+        The plan is reused as long as the circuit size and the reference
+        node are unchanged.
+
+        """
+        reduction = self._reduction
+        if reduction is None or reduction.n != self.cir.n or \
+                reduction.irefnode != irefnode:
+            reduction = RefnodeReduction(self.cir.n, irefnode, self.toolkit)
+            self._reduction = reduction
+        return reduction
+
+    def _reset_stats(self, **stats):
+        """Reset the solver statistics and start timing of the assembly"""
+        self.stats = {'nsolves': 0, 'nit': 0, 'nfev': 0, 'nfactor': 0, 
+                      'nsteps': 0, 'nrejected': 0, 'time': 0., 
+                      'time_func': 0., 'time_assembly': 0., 'time_eval': 0., 
+                      'time_solve': 0., 'norms': []}
+        self.stats.update(stats)
+        self.cir.timing = {'assembly': 0., 'eval': 0.}
+        if self.par.bypass:
+            self.cir.bypass = {'tol': self.par.bypasstol, 
+                               'ndevices': 0, 'nbypass': 0}
+
+    def _accumulate_stats(self, infodict):
+        """Add the statistics of a solver run to the stats dictionary"""
+        if self.stats is None:
+            self._reset_stats()
+        self.stats['nsolves'] += 1
+        for key in infodict:
+            self.stats[key] += infodict[key]
+
+    def _finish_stats(self):
+        """Stop timing of the assembly and notify the monitor"""
+        timing = self.cir.timing
+        if timing is not None:
+            self.stats['time_assembly'] += timing['assembly']
+            self.stats['time_eval'] += timing['eval']
+            self.cir.timing = None
+        bypass = self.cir.bypass
+        if bypass is not None:
+            self.stats['ndevices'] = bypass['ndevices']
+            self.stats['nbypass'] = bypass['nbypass']
+            self.stats['bypassrate'] = \
+                bypass['nbypass'] / float(max(bypass['ndevices'], 1))
+            self.cir.bypass = None
+        self._monitor('done', **self.stats)
+        return self.stats
+
+    def _iteration_callback(self):
+        """Return the Newton iteration callback or None if not needed"""
+        monitor, trace = self.par.monitor, self.par.trace
+        if monitor is None and not trace:
+            return None
+
+        def callback(info):
+            if trace:
+                self.stats['norms'].append((info['fnorm'], info['xnorm']))
+            if monitor is not None:
+                monitor('iteration', info)
+
+        return callback
+
+    def _monitor(self, event, **info):
+        if self.par.monitor is not None:
+            self.par.monitor(event, info)
 
 def fsolve(f, x0, args=(), full_output=False, maxiter=200,
-           xtol=1e-6, reltol=1e-4, abstol=1e-12, toolkit='Numeric'):
+           xtol=1e-6, reltol=1e-4, abstol=1e-12, toolkit='Numeric',
+           limit=None, linesearch=False, chord=False, maxbacktrack=8,
+           chordrate=0.5, callback=None):
     """Solve a multidimensional non-linear equation with Newton-Raphson's method
 
     In each iteration the linear system
@@ -105,17 +303,74 @@ def fsolve(f, x0, args=(), full_output=False, maxiter=200,
     M{J(x_n)(x_{n+1}-x_n) + F(xn) = 0
 
     is solved and a new value for x is obtained x_{n+1}
+
+    The Newton steps can be damped and the jacobian reused by the 
+    following keyword arguments:
+
+    *limit*
+      Function limit(x, x0) that returns a copy of the new x-vector x
+      where the change from x0 is limited, e.g. of junction voltages
+
+    *linesearch*
+      If True the step is halved up to maxbacktrack times until the norm 
+      of the residual decreases
+
+    *chord*
+      If True the LU factorization of the jacobian is reused in the
+      following iterations until the residual norm decreases by less than
+      the factor chordrate. This needs a toolkit with a factorize function.
+
+    The infodict of the full output holds the number of iterations (nit),
+    function evaluations (nfev), jacobian factorizations (nfactor), the 
+    elapsed time in seconds (time) and the time spent in f (time_func) 
+    and in the linear solver (time_solve). If a callback function is given
+    it is called in each iteration with a dictionary of the iteration 
+    number and the norms of the residual (fnorm) and of the update (xnorm).
+
+    >>> import numeric
+    >>> f = lambda x: (x**2 - 4, np.diag(2*x))
+    >>> x, infodict, ier, mesg = fsolve(f, np.array([1.]), full_output=True,
+    ...                                 toolkit=numeric, chord=True)
+    >>> np.around(x, 6), ier
+    (array([ 2.]), 1)
     
     """
     
-    converged = False
+    starttime = time.time()
+    chord = chord and hasattr(toolkit, 'factorize')
+
+    f = _Timed(f)
+    if chord:
+        factorize = solver = _Timed(toolkit.factorize)
+    else:
+        linearsolver = solver = _Timed(toolkit.linearsolver)
+
     ier = 2
+    lu = None
+    nfactor = 0
+    F, J = f(x0, *args) # TODO: Make sure J is never 0, e.g. by gmin (stepping)
+    nfev = 1
     for i in xrange(maxiter):
-        F, J = f(x0, *args) # TODO: Make sure J is never 0, e.g. by gmin (stepping)
-        xdiff = toolkit.linearsolver(J, -F)# TODO: Limit xdiff to improve convergence
+        if chord:
+            if lu is None:
+                lu = factorize(J)
+                lusolve = _Timed(lu.solve, factorize)
+                nfactor += 1
+            xdiff = lusolve(-F)
+        else:
+            xdiff = linearsolver(J, -F)
+            nfactor += 1
 
         x = x0 + xdiff
 
+        if limit is not None:
+            x = limit(x, x0)
+            xdiff = x - x0
+
+        if callback is not None:
+            callback({'iteration': i + 1, 'fnorm': _norm(F), 
+                      'xnorm': _norm(xdiff)})
+
         if toolkit.alltrue(abs(xdiff) < reltol * toolkit.maximum(x, x0) + xtol):
             ier = 1
             mesg = "Success"
@@ -124,18 +379,200 @@ def fsolve(f, x0, args=(), full_output=False, maxiter=200,
             ier = 1
             mesg = "Success"
             break
+
+        Fnew, Jnew = f(x, *args)
+        nfev += 1
+
+        ## Backtrack until the norm of the residual decreases
+        if linesearch:
+            alpha = 1.
+            for k in xrange(maxbacktrack):
+                if _norm(Fnew) <= (1 - 1e-4 * alpha) * _norm(F):
+                    break
+                alpha /= 2
+                x = x0 + alpha * xdiff
+                Fnew, Jnew = f(x, *args)
+                nfev += 1
+
+        ## Refactorize when the chord iterations converge too slowly
+        if chord and _norm(Fnew) > chordrate * _norm(F):
+            lu = None
             
-        x0 = x
+        x0, F, J = x, Fnew, Jnew
 
     if ier == 2:
         mesg = "No convergence. xerror = "+str(xdiff)
     
-    infodict = {}
+    infodict = {'nit': i + 1, 'nfev': nfev, 'nfactor': nfactor,
+                'time': time.time() - starttime, 'time_func': f.time,
+                'time_solve': solver.time}
     if full_output:
         return x, infodict, ier, mesg
     else:
         return x
 
+def continuation(f, x0, lam0=0., lam1=1., args=(), full_output=False,
+                 h0=0.1, hmin=1e-6, hmax=0.5, maxsteps=500, maxiter=8,
+                 xtol=1e-6, reltol=1e-4, abstol=1e-12, toolkit=numeric,
+                 callback=None):
+    """Trace the solutions of f(x, lambda) = 0 from lam0 to lam1
+
+    The solution curve is followed by pseudo-arclength continuation so 
+    turning points where lambda changes direction can be passed. In each
+    step the point is predicted along the tangent of the curve and 
+    corrected by Newton iterations on the system extended with the 
+    arclength equation. The step length h is doubled after fast corrector
+    convergence and halved when the corrector fails.
+
+    f(x, lambda, *args) should return the residual vector, the jacobian 
+    and the derivative of the residual with respect to lambda. The 
+    initial guess x0 is corrected at lam0 and the solution at lam1 is 
+    found by Newton's method when the curve has passed lam1.
+
+    The infodict of the full output holds the number of continuation 
+    steps (nsteps) and of rejected steps (nrejected) in addition to the 
+    statistics of fsolve. The callback function is called in the Newton 
+    iterations and corrector iterations like in fsolve.
+
+    >>> f = lambda x, lam: (x**3 - 3*x + 18 - 36*lam, np.diag(3*x**2 - 3), 
+    ...                     np.array([-36.]))
+    >>> x, infodict, ier, mesg = continuation(f, np.array([-3.]), 
+    ...                                       full_output=True)
+    >>> np.around(x, 6), ier
+    (array([ 3.]), 1)
+
+    """
+    starttime = time.time()
+    
+    infodict = {'nsteps': 0, 'nrejected': 0, 'nit': 0, 'nfev': 0, 
+                'nfactor': 0, 'time_solve': 0.}
+    def accumulate(info):
+        for key in ('nit', 'nfev', 'nfactor', 'time_solve'):
+            infodict[key] += info[key]
+
+    f = _Timed(f)
+
+    def newton(x, lam):
+        func = lambda x: f(x, lam, *args)[:2]
+        x, info, ier, mesg = fsolve(func, x, full_output=True, 
+                                    xtol=xtol, reltol=reltol, abstol=abstol,
+                                    toolkit=toolkit, callback=callback)
+        accumulate(info)
+        return x, ier, mesg
+
+    def solve(J, *b):
+        infodict['nfactor'] += 1
+        if hasattr(toolkit, 'factorize'):
+            lu = toolkit.factorize(J)
+            return [lu.solve(bk) for bk in b]
+        else:
+            return [toolkit.linearsolver(J, bk) for bk in b]
+    solve = _Timed(solve)
+
+    def tangent(J, Flam, direction):
+        (z,) = solve(J, -Flam)
+        scale = np.sqrt(np.dot(z, z) + 1)
+        tx, tlam = z / scale, 1. / scale
+        if np.dot(tx, direction[0]) + tlam * direction[1] < 0:
+            tx, tlam = -tx, -tlam
+        return tx, tlam
+
+    ## Correct the initial point
+    x, ier, mesg = newton(x0, lam0)
+    lam = lam0
+
+    if ier == 1:
+        F, J, Flam = f(x, lam, *args)
+        infodict['nfev'] += 1
+        tx, tlam = tangent(J, Flam, (0 * x, np.sign(lam1 - lam0)))
+        h = h0
+        ier = 2
+        mesg = "No convergence. Maximum number of steps reached"
+        
+    while ier == 2 and infodict['nsteps'] < maxsteps:
+        ## Predictor
+        xc = x + h * tx
+        lamc = lam + h * tlam
+
+        ## Corrector
+        converged = False
+        for k in xrange(maxiter):
+            F, J, Flam = f(xc, lamc, *args)
+            infodict['nfev'] += 1
+            g = np.dot(tx, xc - x) + tlam * (lamc - lam) - h
+            try:
+                z1, z2 = solve(J, -F, -Flam)
+            except toolkit.linearsolverError():
+                break
+            dlam = -(g + np.dot(tx, z1)) / (tlam + np.dot(tx, z2))
+            dx = z1 + dlam * z2
+            xc = xc + dx
+            lamc = lamc + dlam
+            infodict['nit'] += 1
+
+            if callback is not None:
+                callback({'iteration': k + 1, 'fnorm': _norm(F), 
+                          'xnorm': _norm(dx), 'lambda': lamc})
+
+            if toolkit.alltrue(abs(dx) < reltol * abs(xc) + xtol) and \
+                    abs(dlam) < reltol * abs(h):
+                converged = True
+                break
+
+        if not converged:
+            infodict['nrejected'] += 1
+            h /= 2
+            if h < hmin:
+                mesg = "No convergence. Continuation step too small at " + \
+                    "lambda = " + str(lam)
+                break
+            continue
+
+        infodict['nsteps'] += 1
+
+        if (lamc - lam1) * np.sign(lam1 - lam0) >= 0:
+            ## The curve has passed lam1, interpolate and solve at lam1
+            xi = x + (xc - x) * (lam1 - lam) / (lamc - lam)
+            x, ier, mesg = newton(xi, lam1)
+            break
+
+        F, J, Flam = f(xc, lamc, *args)
+        infodict['nfev'] += 1
+        tx, tlam = tangent(J, Flam, (tx, tlam))
+        x, lam = xc, lamc
+
+        if k < 3:
+            h = min(2 * h, hmax)
+
+    infodict['time'] = time.time() - starttime
+    infodict['time_func'] = f.time
+    infodict['time_solve'] += solve.time
+
+    if full_output:
+        return x, infodict, ier, mesg
+    else:
+        return x
+
+def _norm(x):
+    return np.sqrt(np.sum(abs(x)**2))
+
+class _Timed(object):
+    """Function wrapper that accumulates the time spent in calls
+
+    The time can be accumulated in another _Timed object given as timer.
+
+    """
+    def __init__(self, func, timer=None):
+        self.func = func
+        self.timer = timer or self
+        self.time = 0.
+
+    def __call__(self, *args, **kvargs):
+        starttime = time.time()
+        try:
+            return self.func(*args, **kvargs)
+        finally:
+            self.timer.time += time.time() - starttime
 
 if __name__ == "__main__":
     import doctest
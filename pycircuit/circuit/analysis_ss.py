@@ -40,38 +40,43 @@ class SSAnalysis(Analysis):
     parameters = [Parameter(name='analysis', desc='Analysis name', default='ss'),
                    Parameter(name='dcx', desc='Provided DC-solution vector', 
                              unit='', 
-                             default=None)]
+                             default=None),
+                   Parameter(name='opcache', 
+                             desc='Operating-point cache, None disables caching',
+                             unit='', default=None)]
 
     def __init__(self, cir, toolkit=None, **kvargs):    
         self.parameters = super(SSAnalysis, self).parameters + self.parameters            
-        super(SSAnalysis, self).__init__(cir, **kvargs)
+        super(SSAnalysis, self).__init__(cir, toolkit=toolkit, **kvargs)
         
 
     def ss_map_function(self, func, ss, refnode):
         """Apply a function over a list of frequencies or a single frequency"""
-        irefnode = self.cir.nodes.index(refnode)
+        reduction = self._refnode_reduction(self.cir.get_node_index(refnode))
 
-        def myfunc(s):
-            x = func(s)
-            # Insert reference node voltage
-            return self.toolkit.concatenate((x[:irefnode], self.toolkit.array([0.0]), x[irefnode:]))
-            
+        # Insert reference node voltage
         if isiterable(ss):
-            return self.toolkit.array([myfunc(s) for s in ss]).swapaxes(0,1)
+            return reduction.expand(self.toolkit.array([func(s) for s in ss]).swapaxes(0,1))
         else:
-            return myfunc(ss)
+            return reduction.expand(func(ss))
 
     def dc_steady_state(self, freqs, refnode, complexfreq=False, u=None):
         """Return G,C,u matrices at dc steady-state and complex frequencies"""
-        return dc_steady_state(self.cir, freqs, refnode, self.toolkit, 
-                               complexfreq = complexfreq, u = u, 
-                               analysis=self.par.analysis,
-                               epar=self.epar,x0=self.par.dcx)
+        with self._assembly_toolkit():
+            return dc_steady_state(self.cir, freqs, refnode, self.toolkit, 
+                                   complexfreq = complexfreq, u = u, 
+                                   analysis=self.par.analysis,
+                                   epar=self.epar,x0=self.par.dcx,
+                                   opcache=self.par.opcache)
 
 class AC(SSAnalysis):
     """
     AC analysis class
 
+    A vector of frequencies is solved at once by the factorize_pencil 
+    function of the toolkit if it has one, otherwise each frequency is 
+    solved separately.
+
     Examples:
     
     >>> circuit.default_toolkit = symbolic
@@ -108,7 +113,7 @@ class AC(SSAnalysis):
 
     def __init__(self, cir, toolkit=None, **kvargs):
         self.parameters = super(AC, self).parameters + self.parameters            
-        super(AC, self).__init__(cir, **kvargs)
+        super(AC, self).__init__(cir, toolkit=toolkit, **kvargs)
 
     def solve(self, freqs, refnode=gnd, complexfreq = False, u = None):
         G, C, CY, u, x, ss = self.dc_steady_state(freqs, refnode,
@@ -116,13 +121,18 @@ class AC(SSAnalysis):
 
         ## Refer the voltages to the reference node by removing
         ## the rows and columns that corresponds to this node
-        irefnode = self.cir.get_node_index(refnode)
-        G,C,CY,u = remove_row_col((G,C,CY,u), irefnode, self.toolkit)
+        reduction = self._refnode_reduction(self.cir.get_node_index(refnode))
+        G,C,CY,u = (reduction.reduce(A) for A in (G,C,CY,u))
 
-        def acsolve(s):
-            return self.toolkit.linearsolver(s*C + G, -u)
+        if isiterable(ss) and hasattr(self.toolkit, 'factorize_pencil'):
+            ## Solve all frequencies together
+            pencil = self.toolkit.factorize_pencil(G, C)
+            xac = reduction.expand(pencil.solve(ss, -u))
+        else:
+            def acsolve(s):
+                return self.toolkit.linearsolver(s*C + G, -u)
 
-        xac = self.ss_map_function(acsolve, ss, refnode)
+            xac = self.ss_map_function(acsolve, ss, refnode)
 
         self.result = CircuitResultAC(self.cir, x, xac, ss * xac, 
                                       sweep_values = freqs, 
@@ -155,7 +165,7 @@ class TransimpedanceAnalysis(SSAnalysis):
         parameters = super(TransimpedanceAnalysis, self).parameters + \
             self.parameters
             
-        super(TransimpedanceAnalysis, self).__init__(cir, **kvargs)
+        super(TransimpedanceAnalysis, self).__init__(cir, toolkit=toolkit, **kvargs)
 
             
     def solve(self, freqs, outbranches, currentoutput=False,
@@ -177,8 +187,8 @@ class TransimpedanceAnalysis(SSAnalysis):
 
         ## Refer the voltages to the gnd node by removing
         ## the rows and columns that corresponds to this node
-        irefnode = self.cir.get_node_index(refnode)
-        G,C = remove_row_col((G,C), irefnode, self.toolkit)
+        reduction = self._refnode_reduction(self.cir.get_node_index(refnode))
+        G,C = reduction.reduce(G), reduction.reduce(C)
 
         # Calculate the reciprocal G and C matrices
         Yreciprocal = G.T + s*C.T
@@ -198,7 +208,7 @@ class TransimpedanceAnalysis(SSAnalysis):
                 u[self.cir.get_node_index(branch.plus)] = -1
                 u[self.cir.get_node_index(branch.minus)] = 1
 
-            u, = remove_row_col((u,), irefnode, self.toolkit)
+            u = reduction.reduce(u)
 
             ## Calculate transimpedances from currents in each nodes to output
             result.append(self.toolkit.linearsolver(Yreciprocal, -u))
@@ -283,7 +293,7 @@ class Noise(SSAnalysis):
         """
 
         self.parameters = super(Noise, self).parameters + self.parameters            
-        super(Noise, self).__init__(cir, **kvargs)
+        super(Noise, self).__init__(cir, toolkit=toolkit, **kvargs)
 
     
         if not (self.par.outputnodes != None or self.par.outputsrc != None):
@@ -306,8 +316,6 @@ class Noise(SSAnalysis):
 
     def noise_map_function(self, func, ss, refnode):
         """Apply a function over a list of frequencies or a single frequency"""
-        irefnode = self.cir.nodes.index(refnode)
-
         def myfunc(s):
             x, g = func(s)
             return x,g 
@@ -373,8 +381,8 @@ class Noise(SSAnalysis):
             
         ## Refer the voltages to the gnd node by removing
         ## the rows and columns that corresponds to this node
-        irefnode = self.cir.nodes.index(refnode)
-        G,C,CY,u = remove_row_col((G,C,CY,u), irefnode, tk)
+        reduction = self._refnode_reduction(self.cir.get_node_index(refnode))
+        G,C,CY,u = (reduction.reduce(A) for A in (G,C,CY,u))
         
         xn2out, gain = self.noise_map_function(noisesolve, ss, refnode)
 
@@ -401,8 +409,14 @@ class Noise(SSAnalysis):
 
 
 def dc_steady_state(cir, freqs, refnode, toolkit, complexfreq = False, 
-                    analysis='ac', u = None, epar=defaultepar, x0=None):
-    """Return G,C,CY,u matrices at dc steady-state and complex frequencies"""
+                    analysis='ac', u = None, epar=defaultepar, x0=None,
+                    opcache=None):
+    """Return G,C,CY,u matrices at dc steady-state and complex frequencies
+
+    If x0 is not given the DC operating point is taken from the 
+    operating-point cache opcache if given or solved by a DC analysis.
+
+    """
 
     n = cir.n
 
@@ -415,9 +429,14 @@ def dc_steady_state(cir, freqs, refnode, toolkit, complexfreq = False,
         if toolkit.symbolic:
             x=None
         else:
-        #x = zeros(n) ## FIXME, this should be calculated from the dc analysis
-            resdc=DC(cir).solve()
-            x = resdc.x
+            x = None
+            if opcache is not None:
+                key = opcache.key(cir, epar, cir.get_node_index(gnd))
+                x = opcache.get(key)
+            if x is None:
+                x = DC(cir, epar=epar, opcache=None).solve().x
+                if opcache is not None:
+                    opcache.put(key, x)
     else:
         x = x0 #provide the DC steady-state FIXME: need to add parameter to AC
 
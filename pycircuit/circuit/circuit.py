@@ -4,11 +4,14 @@
 
 from pycircuit.utilities.param import Parameter, ParameterDict#, EvalError
 from pycircuit.utilities.misc import indent, inplace_add_selected, \
-    inplace_add_selected_2d, create_index_vectors
+    inplace_add_selected_2d, create_index_vectors, create_stamp_indices, \
+    scatter_add_matrix, ObserverSubject
 from copy import copy
+from contextlib import contextmanager
 import types
 import numeric
 import numpy as np
+import time
 
 default_toolkit = numeric
 
@@ -147,7 +150,41 @@ class Circuit(object):
 
         *linear* 
           A boolean value that is true if i(x) and q(x) are linear 
-          functions
+          functions. Unless it is set by the class or the instance it is 
+          True if the class does not override the i and q methods, which
+          give G*x and C*x
+
+        *eval_group*
+          Optional class method that evaluates a group of instances of the 
+          class in one vectorized operation. The signature is
+          eval_group(X, params, epar, want) where X is a k x n array with 
+          the x-vectors of k instances, params a dictionary of arrays with 
+          the instance parameter values and want a sequence of names among 
+          'i', 'q', 'G' and 'C'. It returns a dictionary of k x n vector and 
+          k x n x n matrix arrays keyed by the names in want.
+
+        *limit*
+          Optional method limit(xnew, xold, epar) used by Newton iterations 
+          of nonlinear instances. It returns a copy of the new x-vector 
+          xnew where the change from xold is limited, e.g. of junction 
+          voltages.
+
+        *timing*
+          Optional dictionary where the time in seconds spent in the 
+          assembly of the circuit vectors and matrices by evaluate() is 
+          accumulated under the key 'assembly' and the time spent in the 
+          evaluation of the elements under the key 'eval'. It is set by 
+          the analyses during a solve and is None otherwise.
+
+        *bypass*
+          Optional dictionary that enables the bypass of latent nonlinear 
+          elements by evaluate(). An element whose x-vector differs by less
+          than bypass['tol'] from the x-vector of its last evaluation is 
+          not evaluated, its cached G and C matrices are used and its i and
+          q vectors are extrapolated from the cached values. The number of
+          element evaluations and of bypassed evaluations are accumulated
+          under the keys 'ndevices' and 'nbypass'. It is set by the 
+          analyses during a solve and is None otherwise.
 
     """
 
@@ -156,7 +193,14 @@ class Circuit(object):
     branches = []
     terminals = []
     instparams = []
-    linear = True
+    eval_group = None
+    limit = None
+    timing = None
+    bypass = None
+
+    ## Cached dictionaries of node and branch indices
+    _nodeindex = None
+    _branchindex = None
     
     def __init__(self, *args, **kvargs):
         if 'toolkit' in kvargs:
@@ -201,6 +245,7 @@ class Circuit(object):
         newc.nodes = copy(self.nodes)    
         newc.nodenames = copy(self.nodenames)    
         newc.branches = copy(self.branches)    
+        newc._invalidate_indices()
         newc.instparams = copy(self.instparams)
         newc.ipar = copy(self.ipar)        
         newc.ipar.detach(self)
@@ -217,6 +262,20 @@ class Circuit(object):
     def _ipar_changed(self, subject):
         self.update_iparv(ignore_errors=True)
 
+    ## Linearity set by the instance
+    _linear = None
+
+    def _get_linear(self):
+        if self._linear is None:
+            return not _overrides(self, ('i', 'q'), Circuit)
+        return self._linear
+
+    def _set_linear(self, linear):
+        self._linear = linear
+
+    linear = property(_get_linear, _set_linear, 
+                      doc='True if i(x) and q(x) are linear functions')
+
     def add_nodes(self, *names):
         """Create internal nodes in the circuit and return the new nodes
 
@@ -245,8 +304,11 @@ class Circuit(object):
         if self.__class__.nodes is self.nodes:
             self.nodes = list(self.nodes)
 
-        if node not in self.nodes:
+        nodeindex = self._indexmap('_nodeindex', self.nodes)
+        if node not in nodeindex:
+            nodeindex[node] = len(self.nodes)
             self.nodes.append(node)
+            self._nodeindex = (len(self.nodes), nodeindex)
         self.nodenames[node.name] = node
 
     def append_branches(self, *branches):
@@ -255,7 +317,35 @@ class Circuit(object):
         if self.__class__.branches is self.branches:
             self.branches = list(self.branches)
 
-        self.branches.extend(branches)
+        branchindex = self._indexmap('_branchindex', self.branches)
+        for branch in branches:
+            branchindex.setdefault(branch, len(self.branches))
+            self.branches.append(branch)
+        self._branchindex = (len(self.branches), branchindex)
+
+    def _indexmap(self, attrname, objects):
+        """Return dictionary of list positions keyed by the list items
+
+        The dictionary is cached in the given attribute together with the 
+        length of the list and is rebuilt when the length has changed. 
+        Methods that reorder the node or branch lists must call 
+        _invalidate_indices. As for list.index the position of the first 
+        occurrence is used for duplicated items.
+
+        """
+        cache = getattr(self, attrname)
+        if cache is None or cache[0] != len(objects):
+            indexmap = {}
+            for index, obj in enumerate(objects):
+                indexmap.setdefault(obj, index)
+            cache = (len(objects), indexmap)
+            setattr(self, attrname, cache)
+        return cache[1]
+
+    def _invalidate_indices(self):
+        """Clear the cached node and branch indices"""
+        self._nodeindex = None
+        self._branchindex = None
 
     def get_terminal_branch(self, terminalname):
         """Find the branch that is connected to the given terminal
@@ -306,10 +396,14 @@ class Circuit(object):
         if refnode and not isinstance(refnode, Node):
             refnode = Node(str(refnode))
 
-        if node in self.nodes:
-            index = self.nodes.index(node)
+        nodeindex = self._indexmap('_nodeindex', self.nodes)
+        if node in nodeindex:
+            index = nodeindex[node]
             if refnode != None:
-                irefnode = self.nodes.index(refnode)
+                if refnode not in nodeindex:
+                    raise ValueError('Node %s is not in circuit node list (%s)'%
+                                     (str(refnode), str(self.nodes)))
+                irefnode = nodeindex[refnode]
                 if index == irefnode:
                     return None
                 if index > irefnode:
@@ -321,8 +415,9 @@ class Circuit(object):
 
     def get_branch_index(self, branch):
         """Get row in the x vector of a branch instance"""
-        if branch in self.branches:
-            return len(self.nodes) + self.branches.index(branch)
+        branchindex = self._indexmap('_branchindex', self.branches)
+        if branch in branchindex:
+            return len(self.nodes) + branchindex[branch]
         else:
             raise ValueError('Branch %s is not present in circuit (%s)'%
                              (str(branch), str(self.branches)))
@@ -377,9 +472,10 @@ class Circuit(object):
 
             ## move node to position k in nodes as it is
             ## now a terminal node
-            if not self.nodes.index(node) < self._nterminalnodes:
+            if not self.get_node_index(node) < self._nterminalnodes:
                 self.nodes.remove(node)
                 self.nodes.insert(self._nterminalnodes-1, node)
+                self._invalidate_indices()
   
     def connect_terminals(self, **kvargs):
         """Connect nodes to terminals by using keyword arguments
@@ -404,6 +500,8 @@ class Circuit(object):
                 self.nodes.insert(self._nterminalnodes, node)
             
             self.nodenames[terminal] = node            
+
+            self._invalidate_indices()
             
     def save_current(self, terminal):
         """Returns a circuit where a current probe is added at a terminal
@@ -488,6 +586,31 @@ class Circuit(object):
         """
         return self.toolkit.dot(self.C(x), x)
 
+    def evaluate(self, x, t=0.0, epar=defaultepar, want=('i', 'q', 'G', 'C'),
+                 analysis=None):
+        """Evaluate several quantities of the circuit equations at once
+
+        Returns a dictionary keyed by the names in *want* which can be any 
+        of 'i', 'q', 'G', 'C' and 'u'. The x-vector is used by i, q, G and C 
+        and the time t and analysis arguments by u.
+
+        Elements can override this method to calculate all quantities 
+        from shared intermediate results. The default implementation calls 
+        the i(), q(), G(), C() and u() methods.
+
+        >>> c = Circuit()
+        >>> c.evaluate(None, want=('u',))
+        {'u': array([], dtype=float64)}
+
+        """
+        result = {}
+        for name in want:
+            if name == 'u':
+                result[name] = self.u(t, epar, analysis)
+            else:
+                result[name] = getattr(self, name)(x, epar)
+        return result
+
     def CY(self, x, w, epar=defaultepar):
         """Calculate the noise sources correlation matrix
 
@@ -501,8 +624,14 @@ class Circuit(object):
         return self.toolkit.zeros((self.n, self.n))
 
     def next_event(self, t):
-        """Returns the time of the next event given the current time t"""
-        return inf
+        """Returns the time of the next event given the current time t
+
+        The events are breakpoints of the time dependent sources where the 
+        transient analysis lands its time steps, e.g. the corners of a 
+        pulse.
+
+        """
+        return self.toolkit.inf
     
     def name_state_vector(self, x, analysis=''):
         """Return a dictionary of the x-vector keyed by node and branch names
@@ -780,12 +909,29 @@ class SubCircuit(Circuit):
     elementnodemap = {}
     term_node_map = {}
 
+    ## Nesting level of batch() blocks
+    _batchlevel = 0
+
+    ## Names of the instances connected to each node, built when needed
+    _nodeinstances = None
+
     def __init__(self, *args, **kvargs):
+        ## Notifies parent circuits when the cached linear stamps are invalid
+        self._stampsubject = ObserverSubject()
+        self._linearstamps = {}
+        self._nonlinear = None
+        self._limiting = None
+        self._sources = None
+        self._bypassgroup = None
+        self._linear = True
+
         super(SubCircuit, self).__init__(*args, **kvargs)
         self.elements = {}
         self.elementnodemap = {}
         self.term_node_map = {}
-        self._mapmatrix = {}
+        self._stampplan = {}
+        self._branchinstances = set()
+        self._batchinstances = []
 
     def __eq__(self, a):
         return super(SubCircuit, self).__eq__(a) and \
@@ -798,6 +944,7 @@ class SubCircuit(Circuit):
         newc.elements = {}
         for instance_name, element in self.elements.items():
             newc.elements[instance_name] = copy(self.elements[instance_name])
+            newc._observe_instance(newc.elements[instance_name])
         newc.elementnodemap = copy(self.elementnodemap)
         newc.term_node_map = copy(self.term_node_map)
         
@@ -871,6 +1018,8 @@ class SubCircuit(Circuit):
 
         self.elements[instancename] = instance
 
+        nnodes = len(self.nodes)
+
         ## Add local nodes and branches from new instance
         for node in instance.non_terminal_nodes(instancename):
             self.append_node(node)
@@ -894,12 +1043,87 @@ class SubCircuit(Circuit):
         newbranches = self._instance_branches(instance, instancename)
         self.append_branches(*newbranches)
 
+        ## Subscribe to changes that invalidates the cached linear stamps
+        self._observe_instance(instance)
+
+        if self._nodeinstances is not None:
+            for node in self._element_nodes(instancename):
+                self._nodeinstances.setdefault(node, set()).add(instancename)
+
+        ## Defer the updates to the end of the batch
+        if self._batchlevel > 0:
+            self._batchinstances.append((instancename, instance))
+            return
+
         ## Update circuit node - instance map
-        self.update_node_map()
+        self._shift_branch_indices(nnodes)
+        self._map_instance(instancename)
+        self._invalidate_stamps(linear = self._linear and instance.linear)
 
         ## update iparv
         instance.update_iparv(self.iparv, ignore_errors=True)
 
+    def add_instances(self, instances):
+        """Add several instances to the circuit
+
+        The instances argument is an iterable of (instancename, instance, 
+        connection) tuples where connection is a dictionary that maps the
+        terminals of the instance to nodes. If connection is None the
+        terminals are connected as when the instance is added by item
+        assignment. The node map and instance parameters are updated once
+        after all instances have been added.
+
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> c.add_instances(('R%d'%k, R('n%d'%k, 'n%d'%(k+1)), None)
+        ...                 for k in range(3))
+        >>> c.elementnodemap['R2']
+        [2, 3]
+
+        """
+        with self.batch():
+            for instancename, instance, connection in instances:
+                if connection is None:
+                    self[instancename] = instance
+                else:
+                    self.add_instance(instancename, instance, **connection)
+
+    @contextmanager
+    def batch(self):
+        """Context manager that defers updates when adding many instances
+
+        Inside the with-block add_instance and __delitem__ do not update
+        the node map and do not propagate instance parameters. This is 
+        done once when the outermost block exits.
+
+        >>> from elements import *
+        >>> c = SubCircuit()
+        >>> with c.batch():
+        ...     for k in range(3):
+        ...         c['R%d'%k] = R('n%d'%k, 'n%d'%(k+1))
+        >>> c.elementnodemap['R2']
+        [2, 3]
+
+        """
+        self._batchlevel += 1
+        try:
+            yield self
+        finally:
+            self._batchlevel -= 1
+            if self._batchlevel == 0:
+                self._end_batch()
+
+    def _end_batch(self):
+        """Update node map and instance parameters after a batch"""
+        instances = self._batchinstances
+        self._batchinstances = []
+
+        self.update_node_map()
+
+        for instancename, instance in instances:
+            if self.elements.get(instancename) is instance:
+                instance.update_iparv(self.iparv, ignore_errors=True)
+
     def __setitem__(self, instancename, element):
         """Adds an instance to the circuit"""
 
@@ -919,30 +1143,64 @@ class SubCircuit(Circuit):
         []
         
         """
+        element_nodes = self._element_nodes(instancename)
+        nodeinstances = self._node_instances()
+
         element = self.elements.pop(instancename)
 
+        element.iparv.detach(self, updatemethod='_invalidate_stamps')
+        if isinstance(element, SubCircuit):
+            element._stampsubject.detach(self, 
+                                         updatemethod='_invalidate_stamps')
+
         ## Remove floating terminal nodes and internal nodes
-        othernodes = set(self.terminal_nodes())
-        for instance_name, e in self.elements.items():
-            terminal_nodes = set([self.term_node_map[instance_name][term]
-                                  for term in e.terminals])
-            othernodes.update(terminal_nodes)
-        internal_nodes = set(element.non_terminal_nodes(instancename))
-        terminal_nodes = set([self.term_node_map[instancename][term]
-                              for term in element.terminals])
-        floating_terminal_nodes =  terminal_nodes - othernodes
-        removed_nodes = internal_nodes | floating_terminal_nodes
-
-        for node in removed_nodes:
-            self.nodes.remove(node)
+        internal_nodes = element_nodes[len(element.terminals):]
+        removed_nodes = set(internal_nodes)
+        terminal_nodes = set(self.terminal_nodes())
+        for node in element_nodes:
+            instances = nodeinstances.get(node)
+            if instances is None:
+                continue
+            instances.discard(instancename)
+            if len(instances) == 0:
+                del nodeinstances[node]
+                if node not in terminal_nodes:
+                    removed_nodes.add(node)
+
+        ## The last node takes the place of a removed node so only the 
+        ## instances connected to the moved nodes need new node maps
+        nodeindex = self._indexmap('_nodeindex', self.nodes)
+        movednodes = []
+        for index in sorted([nodeindex[node] for node in removed_nodes 
+                             if node in nodeindex], reverse=True):
+            node = self.nodes[index]
+            last = self.nodes.pop()
+            del nodeindex[node]
+            if index < len(self.nodes):
+                self.nodes[index] = last
+                nodeindex[last] = index
+                movednodes.append(last)
             del self.nodenames[node.name] 
+        self._nodeindex = (len(self.nodes), nodeindex)
 
         for branch in self._instance_branches(element, instancename):
             self.branches.remove(branch)
+        self._branchindex = None
 
         del self.term_node_map[instancename]
 
-        self.update_node_map()
+        self.elementnodemap.pop(instancename, None)
+        self._stampplan.pop(instancename, None)
+        self._branchinstances.discard(instancename)
+
+        if self._batchlevel == 0:
+            ## The branch indices follow the node indices
+            instances = set(self._branchinstances)
+            for node in movednodes:
+                instances.update(nodeinstances.get(node, ()))
+            for instance_name in instances:
+                self._map_instance(instance_name)
+            self._invalidate_stamps()
 
     def __getitem__(self, instancename):
         """Get local or hierarchical instance by name"""
@@ -1056,37 +1314,96 @@ class SubCircuit(Circuit):
                 return instname + '.' + name
         
     def update_node_map(self):
-        """Update the elementnodemap attribute"""
+        """Update the elementnodemap attribute and the stamp plans
 
-        self.elementnodemap = {}
-        self._rep_nodemap_list = {}
+        The stamp plan of an instance holds the global indices of its x-vector
+        elements (nodemap) together with the row and column index vectors
+        used to scatter-add its k x k matrices into the n x n circuit
+        matrices.
+
+        The cached linear stamps are also invalidated.
         
-        for instance_name, element in self.elements.items():
-            nodemap = self.term_node_map[instance_name]
-            element_nodes = [nodemap[terminal] for terminal in element.terminals]
+        """
 
-            for node in element.non_terminal_nodes(instance_name):
-                element_nodes.append(node)
+        self.elementnodemap = {}
+        self._stampplan = {}
+        self._branchinstances = set()
+        self._nodeinstances = None
         
-            element_branches = self._instance_branches(element, instance_name)
+        for instance_name in self.elements:
+            self._map_instance(instance_name)
 
-            nodemap = \
-                [self.nodes.index(node) for node in element_nodes] + \
-                [self.branches.index(branch) + len(self.nodes) 
-                 for branch in element_branches]
+        self._invalidate_stamps()
 
-            self.elementnodemap[instance_name] = nodemap
+    def _element_nodes(self, instance_name):
+        """Return the terminal nodes followed by the internal nodes of an 
+        instance"""
+        element = self.elements[instance_name]
 
-            ## Create mapping matrix
-            if len(nodemap) > 0:
-                mapmatrix = self.toolkit.zeros((self.n, len(nodemap)),
-                                               dtype = np.integer)
-            
-                for inst_node_index, node_index in enumerate(nodemap):
-                    mapmatrix[node_index, inst_node_index] = 1
-                self._mapmatrix[instance_name] = mapmatrix
-            else:
-                self._nodemap = None
+        nodemap = self.term_node_map[instance_name]
+        element_nodes = [nodemap[terminal] for terminal in element.terminals]
+
+        for node in element.non_terminal_nodes(instance_name):
+            element_nodes.append(node)
+
+        return element_nodes
+
+    def _node_instances(self):
+        """Return dictionary of the sets of names of the instances that are
+        connected to each node"""
+        if self._nodeinstances is None:
+            nodeinstances = {}
+            for instance_name in self.elements:
+                for node in self._element_nodes(instance_name):
+                    nodeinstances.setdefault(node, set()).add(instance_name)
+            self._nodeinstances = nodeinstances
+        return self._nodeinstances
+
+    def _map_instance(self, instance_name):
+        """Update the elementnodemap entry and stamp plan of an instance"""
+        element = self.elements[instance_name]
+        element_nodes = self._element_nodes(instance_name)
+
+        element_branches = self._instance_branches(element, instance_name)
+
+        nodeindex = self._indexmap('_nodeindex', self.nodes)
+        branchindex = self._indexmap('_branchindex', self.branches)
+        nnodes = len(self.nodes)
+
+        nodemap = \
+            [nodeindex[node] for node in element_nodes] + \
+            [branchindex[branch] + nnodes for branch in element_branches]
+
+        if len(element.branches) > 0:
+            self._branchinstances.add(instance_name)
+
+        self._set_nodemap(instance_name, nodemap)
+
+    def _set_nodemap(self, instance_name, nodemap):
+        self.elementnodemap[instance_name] = nodemap
+
+        ## Create stamp plan
+        rows, cols = create_stamp_indices(nodemap)
+        self._stampplan[instance_name] = \
+            (np.array(nodemap, dtype=int), rows, cols)
+
+    def _shift_branch_indices(self, nnodes):
+        """Shift branch indices of the node maps after nodes were appended
+
+        The branch rows follows the node rows in the x-vector so the branch
+        indices of the existing instances are moved when the number of nodes
+        changes from nnodes.
+
+        """
+        shift = len(self.nodes) - nnodes
+
+        if shift == 0:
+            return
+
+        for instance_name in self._branchinstances:
+            nodemap = [index + shift * (index >= nnodes) 
+                       for index in self.elementnodemap[instance_name]]
+            self._set_nodemap(instance_name, nodemap)
 
     def update_iparv(self, parent_ipar=None, globalparams=None, 
                      ignore_errors = False):
@@ -1129,6 +1446,12 @@ class SubCircuit(Circuit):
         """
         return self._add_element_submatrices('CY', x, (w, epar,))
 
+    def next_event(self, t):
+        """Returns the time of the first event of the elements after t"""
+        return min([element.next_event(t) 
+                    for element in self.elements.values()] + 
+                   [self.toolkit.inf])
+
     def save_current(self, terminal):
         """Returns a circuit where the given terminal current is saved
         
@@ -1193,15 +1516,163 @@ class SubCircuit(Circuit):
         for element in self.elements.values():
             element.update_iparv(self.iparv, ignore_errors=True)
         
-    def _add_element_submatrices(self, methodname, x, args):
-        dot = self.toolkit.dot
-        n = self.n
-        lhs = self.toolkit.zeros((n,n))
+    def _observe_instance(self, instance):
+        """Invalidate the cached linear stamps when the instance changes"""
+        instance.iparv.attach(self, updatemethod='_invalidate_stamps')
+        if isinstance(instance, SubCircuit):
+            instance._stampsubject.attach(self, 
+                                          updatemethod='_invalidate_stamps')
+
+    def _invalidate_stamps(self, subject=None, linear=None):
+        """Clear the cached linear stamps and notify parent circuits
+
+        This is called when the topology changes or when the instance 
+        parameters of an element change. The linear attribute is set to 
+        the linear argument or is recalculated the next time it is used.
+
+        """
+        self._linear = linear
+        self._linearstamps = {}
+        self._nonlinear = None
+        self._limiting = None
+        self._sources = None
+        self._bypassgroup = None
+        self._stampsubject.notify()
+
+    def _linear_stamps(self, methodname, x, epar):
+        """Return the pre-summed G or C matrix of the linear elements
+
+        The matrix is returned as (rows, cols, values) coordinate vectors 
+        and is cached until the topology or an instance parameter changes 
+        or until it is evaluated with other environment parameters. 
+        
+        """
+        eparvalues = _epar_values(epar)
 
-        for instance, element in self.elements.items():
-            nodemap = self.elementnodemap[instance]
+        if methodname in self._linearstamps:
+            cachedepar, stamps = self._linearstamps[methodname]
+            if cachedepar == eparvalues:
+                return stamps
 
-            if x != None:
+        instances = [instance for instance, element in self.elements.items()
+                     if element.linear]
+
+        stamps = _sum_stamps(self.n, *self._element_stamps(methodname, 
+                                                           instances, x, 
+                                                           (epar,)))
+
+        self._linearstamps[methodname] = (eparvalues, stamps)
+        
+        return stamps
+
+    def _get_linear(self):
+        if self._linear is None:
+            self._linear = all(element.linear 
+                               for element in self.elements.values())
+        return self._linear
+
+    def _set_linear(self, linear):
+        self._linear = linear
+
+    linear = property(_get_linear, _set_linear, 
+                      doc='True if all instances are linear')
+
+    @property
+    def nonlinearinstances(self):
+        """List of names of instances that are not linear"""
+        return [instance for instance, element in self.elements.items()
+                if not element.linear]
+
+    def _nonlinear_groups(self):
+        """Return the nonlinear instances grouped for evaluation
+
+        Returns a list of ElementGroup objects with the instances of classes
+        that defines an eval_group method and a list of names of the other 
+        nonlinear instances.
+
+        """
+        if self._nonlinear is None:
+            groups = {}
+            instances = []
+            for instance in self.nonlinearinstances:
+                element = self.elements[instance]
+                nodemap = self._stampplan[instance][0]
+
+                if len(nodemap) == 0:
+                    continue
+
+                if element.eval_group is not None:
+                    elementclass = element.__class__
+                    if elementclass not in groups:
+                        groups[elementclass] = ElementGroup(elementclass)
+                    groups[elementclass].append(instance, element, nodemap)
+                else:
+                    instances.append(instance)
+
+            self._nonlinear = groups.values(), instances
+
+        return self._nonlinear
+
+    def _bypass_group(self, instances):
+        """Return an ElementGroup of the instances for the bypass
+
+        The group is used to bypass the latent nonlinear instances that are
+        not evaluated by eval_group.
+
+        """
+        if self._bypassgroup is None:
+            group = ElementGroup(Circuit)
+            for instance in instances:
+                group.append(instance, self.elements[instance], 
+                             self._stampplan[instance][0])
+            self._bypassgroup = group
+        return self._bypassgroup
+
+    def _source_instances(self):
+        """Return names of the instances that override the u method"""
+        if self._sources is None:
+            self._sources = [instance 
+                             for instance, element in self.elements.items()
+                             if _overrides(element, 'u', Circuit)]
+        return self._sources
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        """Limit the Newton step of the instances that define a limit method
+        """
+        if self._limiting is None:
+            self._limiting = [instance for instance in self.nonlinearinstances
+                              if self.elements[instance].limit is not None]
+
+        if len(self._limiting) == 0:
+            return xnew
+
+        x = self.toolkit.array(xnew)
+        for instance in self._limiting:
+            nodemap = self._stampplan[instance][0]
+            x[nodemap] = self.elements[instance].limit(x[nodemap], 
+                                                       xold[nodemap], epar)
+        return x
+
+    def _element_stamps(self, methodname, instances, x, args):
+        """Evaluate element matrices and return their coordinates and values
+
+        Returns lists of row index, column index and value vectors, one 
+        for each evaluated instance.
+
+        """
+        rows, cols, values = [], [], []
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        for instance in instances:
+            element = self.elements[instance]
+            nodemap, irows, icols = self._stampplan[instance]
+
+            if len(nodemap) == 0:
+                continue
+
+            if x is not None:
                 subx = x[nodemap]
                 try:
                     rhs = getattr(element, methodname)(subx, *args)
@@ -1210,30 +1681,178 @@ class SubCircuit(Circuit):
                                       + ', args='+str(args))
             else:
                 rhs = getattr(element, methodname)(*((None,) + tuple(args)))
-                
-            T = self._mapmatrix[instance]
+
+            _append_coords((rows, cols, values), 
+                           *_stamp_coords(rhs, nodemap, irows, icols))
+
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
+
+        return rows, cols, values
+
+    def evaluate(self, x, t=0.0, epar=defaultepar, want=('i', 'q', 'G', 'C'),
+                 analysis=None):
+        """Evaluate several quantities in one pass over the elements
+
+        The nonlinear elements are evaluated once for all quantities in 
+        *want* and the contributions of the linear elements are taken from 
+        the cached linear stamps.
+
+        """
+        return self._evaluate(x, t, epar, want, analysis)
+
+    def _evaluate(self, x, t=0.0, epar=defaultepar, want=('i', 'q', 'G', 'C'),
+                  analysis=None, sparse=None):
+        nlwant = tuple(name for name in want if name in ('i', 'q', 'G', 'C'))
+
+        ## Coordinate and value vectors keyed by quantity name
+        coords = dict((name, ([], [], [])) for name in nlwant)
+
+        groups, instances = self._nonlinear_groups()
+        bypass = self.bypass
+        if x is None or np.asarray(x).dtype == object:
+            bypass = None
+        elif bypass is not None and len(instances) > 0:
+            groups = list(groups) + [self._bypass_group(instances)]
+            instances = []
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        for group in groups:
+            result = group.evaluate(nlwant, x, epar, bypass=bypass)
+            for name in nlwant:
+                if name in ('i', 'q'):
+                    group_coords = group.indices, None, result[name]
+                else:
+                    group_coords = group.rows, group.cols, result[name]
+                _append_coords(coords[name], *group_coords)
+
+        for instance in instances:
+            element = self.elements[instance]
+            nodemap, irows, icols = self._stampplan[instance]
+
+            if x is not None:
+                subx = x[nodemap]
+            else:
+                subx = None
+
+            try:
+                result = element.evaluate(subx, t, epar, want=nlwant,
+                                          analysis=analysis)
+            except Exception, e:
+                raise e.__class__(str(e) + ' at element ' + str(element) 
+                                  + ', epar='+str(epar))
+
+            for name in nlwant:
+                if name in ('i', 'q'):
+                    _append_coords(coords[name], nodemap, None, result[name])
+                else:
+                    _append_coords(coords[name], 
+                                   *_stamp_coords(result[name], nodemap, 
+                                                  irows, icols))
+
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
+
+        ## The linear elements are timed when their stamps are evaluated
+        linearstamps = [self._linear_stamps({'i': 'G', 'q': 'C'}.get(name, 
+                                                                     name), 
+                                            x, epar)
+                        for name in nlwant]
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        ## Add linear elements where i = G*x and q = C*x
+        for name, (rows, cols, values) in zip(nlwant, linearstamps):
+            if name in ('i', 'q'):
+                _append_coords(coords[name], rows, None, values * x[cols])
+            else:
+                _append_coords(coords[name], rows, cols, values)
         
-            lhs += dot(dot(T, rhs), T.T)
+        result = {}
+        for name in nlwant:
+            rows, cols, values = coords[name]
+            if name in ('i', 'q'):
+                result[name] = _assemble_vector(self.toolkit, self.n, 
+                                                rows, values)
+            else:
+                result[name] = _assemble_matrix(self.toolkit, self.n, 
+                                                rows, cols, values, 
+                                                sparse=sparse)
 
-        return lhs
+        if self.timing is not None:
+            self.timing['assembly'] += time.time() - starttime
+
+        if 'u' in want:
+            result['u'] = self.u(t, epar, analysis)
+
+        return result
+
+    def _add_element_submatrices(self, methodname, x, args, sparse=None):
+        """Assemble the element matrices into a n x n circuit matrix
+
+        The element matrices are scatter-added in one vectorized operation
+        using the precomputed stamp plans. A scipy.sparse matrix is returned
+        if *sparse* is True and the values are numeric, otherwise a dense 
+        toolkit array. The default is given by the sparse attribute of the 
+        toolkit.
+
+        The G and C matrices of the linear elements are taken from a cache 
+        so only the nonlinear elements are evaluated.
+
+        """
+        if methodname in ('G', 'C'):
+            return self._evaluate(x, epar=args[-1], want=(methodname,), 
+                                  sparse=sparse)[methodname]
+
+        rows, cols, values = \
+            self._element_stamps(methodname, self.elements.keys(), x, args)
+
+        return _assemble_matrix(self.toolkit, self.n, rows, cols, values, 
+                                sparse=sparse)
 
     def _add_element_subvectors(self, methodname, x, args, dtype=None):
+        if methodname in ('i', 'q'):
+            return self._evaluate(x, epar=args[-1], 
+                                  want=(methodname,))[methodname]
+
         n = self.n
         lhs = self.toolkit.zeros(n, dtype=dtype)
 
-        for instance, element in self.elements.items():
-            if x != None:
-                subx = x[self.elementnodemap[instance]]
-                rhs = getattr(element, methodname)(subx, *args)
+        ## Only the sources contribute to the u vector
+        if methodname == 'u':
+            instances = self._source_instances()
+        else:
+            instances = self.elements.keys()
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        for instance in instances:
+            element = self.elements[instance]
+            nodemap = self._stampplan[instance][0]
+
+            if len(nodemap) == 0:
+                continue
+
+            if x is not None:
+                rhs = getattr(element, methodname)(x[nodemap], *args)
             else:
                 rhs = getattr(element, methodname)(*args)
 
-            T = self._mapmatrix[instance]
+            np.add.at(lhs, nodemap, rhs)
 
-            lhs += self.toolkit.dot(T, rhs)
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
 
         return lhs
 
+    def compile(self):
+        """Return a CompiledCircuit with the flattened circuit hierarchy"""
+        return CompiledCircuit(self)
+
     def find_class_instances(self, instance_class):
         instances = []        
         for instanceName, element in self.elements.items():
@@ -1307,7 +1926,9 @@ class CircuitProxy(Circuit):
         self.nodes = circuit.nodes
         self.nodenames = circuit.nodenames
         self.branches = circuit.branches
+        self._invalidate_indices()
         self.iparv = circuit.iparv
+        self.linear = circuit.linear
         
         ## Find out how this instance was connected to its parent
         ## and set terminalhook accordingly
@@ -1321,6 +1942,877 @@ class CircuitProxy(Circuit):
     def i(self, x, epar=defaultepar): return self.device.i(x,epar)
     def q(self, x, epar=defaultepar): return self.device.q(x,epar)
     def CY(self, x, w, epar=defaultepar): return self.device.CY(x,epar)
+    def next_event(self, t): return self.device.next_event(t)
+
+class CompiledCircuit(object):
+    """Flattened representation of a SubCircuit hierarchy
+
+    The circuit hierarchy is flattened once into a list of leaf elements 
+    with global x-vector index maps. The nonlinear leaves are grouped by
+    element class and the G and C matrices of the linear leaves are 
+    pre-summed so the G, C, i, q, u and CY methods evaluate the circuit 
+    without traversing the hierarchy.
+
+    A CompiledCircuit can be passed to the analyses in place of the 
+    circuit it was compiled from. Attributes and methods that are not 
+    related to the evaluation of the circuit equations, like nodes, 
+    get_node_index() or extract_v(), are forwarded to the circuit. The 
+    flattened representation is rebuilt when an instance parameter or
+    the topology of the circuit changes.
+
+    **Attributes**
+        *circuit*
+          The compiled SubCircuit object
+
+        *leaves*
+          List of (instance name, element, nodemap) tuples of the leaf 
+          elements where nodemap is the global indices of the x-vector 
+          elements of the leaf
+
+        *groups*
+          Dictionary of ElementGroup objects of the nonlinear leaves keyed 
+          by the element class
+
+    >>> from elements import *
+    >>> c = SubCircuit()
+    >>> c['R1'] = R(1, gnd, r=1e3)
+    >>> c['D1'] = Diode(1, gnd)
+    >>> cc = c.compile()
+    >>> len(cc.leaves), [group.names for group in cc.groups.values()]
+    (2, [['D1']])
+
+    """
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.toolkit = circuit.toolkit
+        self.timing = None
+        self.bypass = None
+        self._valid = False
+
+        circuit._stampsubject.attach(self, updatemethod='_invalidate')
+
+        self._build()
+
+    def __getattr__(self, name):
+        return getattr(self.circuit, name)
+
+    def __getitem__(self, instancename):
+        return self.circuit[instancename]
+
+    def __repr__(self):
+        return 'CompiledCircuit(' + repr(self.circuit) + ')'
+
+    def _invalidate(self, subject=None):
+        self._valid = False
+
+    def _build(self):
+        """Flatten the circuit hierarchy"""
+        self.leaves = list(flatten_circuit(self.circuit))
+
+        self.groups = {}
+        self._usources = []
+        self._noisesources = []
+        self._linearleaves = []
+        self._limitleaves = []
+        self._linearstamps = {}
+
+        for name, element, nodemap in self.leaves:
+            if len(nodemap) > 0:
+                self._add_leaf(name, element, nodemap)
+
+        self._valid = True
+
+    def _add_leaf(self, name, element, nodemap):
+        """Sort a leaf element into the linear, group, source and noise lists"""
+        if element.linear:
+            self._linearleaves.append((element, nodemap) + 
+                                      create_stamp_indices(nodemap))
+        else:
+            elementclass = element.__class__
+            if elementclass not in self.groups:
+                self.groups[elementclass] = ElementGroup(elementclass)
+            self.groups[elementclass].append(name, element, nodemap)
+
+        if _overrides(element, 'u', Circuit):
+            self._usources.append((element, nodemap))
+
+        if _overrides(element, 'CY', Circuit):
+            self._noisesources.append((element, nodemap) + 
+                                      create_stamp_indices(nodemap))
+
+        if not element.linear and element.limit is not None:
+            self._limitleaves.append((element, nodemap))
+
+    def _check(self):
+        if not self._valid:
+            self._build()
+
+    def _linear_stamps(self, methodname, x, epar):
+        """Return the pre-summed G or C matrix of the linear leaves"""
+        eparvalues = _epar_values(epar)
+        
+        if methodname in self._linearstamps:
+            cachedepar, stamps = self._linearstamps[methodname]
+            if cachedepar == eparvalues:
+                return stamps
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        coords = _evaluate_stamps(self._linearleaves, methodname, x, (epar,))
+
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
+
+        stamps = _sum_stamps(self.n, *coords)
+
+        self._linearstamps[methodname] = (eparvalues, stamps)
+
+        return stamps
+
+    def evaluate(self, x, t=0.0, epar=defaultepar, want=('i', 'q', 'G', 'C'),
+                 analysis=None):
+        """Evaluate several quantities in one pass over the leaf elements"""
+        self._check()
+
+        nlwant = tuple(name for name in want if name in ('i', 'q', 'G', 'C'))
+
+        result = {}
+        for name in nlwant:
+            result[name] = ([], [], [])
+
+        bypass = self.bypass
+        if x is None or np.asarray(x).dtype == object:
+            bypass = None
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        for group in self.groups.values():
+            groupresult = group.evaluate(nlwant, x, epar, bypass=bypass)
+            for name in nlwant:
+                if name in ('i', 'q'):
+                    _append_coords(result[name], group.indices, None,
+                                   groupresult[name])
+                else:
+                    _append_coords(result[name], group.rows, group.cols,
+                                   groupresult[name])
+
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
+
+        ## The linear leaves are timed when their stamps are evaluated
+        linearstamps = [self._linear_stamps({'i': 'G', 'q': 'C'}.get(name, 
+                                                                     name), 
+                                            x, epar)
+                        for name in nlwant]
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        ## Add linear elements where i = G*x and q = C*x
+        for name, (rows, cols, values) in zip(nlwant, linearstamps):
+            if name in ('i', 'q'):
+                _append_coords(result[name], rows, None, values * x[cols])
+            else:
+                _append_coords(result[name], rows, cols, values)
+
+        for name in nlwant:
+            rows, cols, values = result[name]
+            if name in ('i', 'q'):
+                result[name] = _assemble_vector(self.toolkit, self.n, 
+                                                rows, values)
+            else:
+                result[name] = _assemble_matrix(self.toolkit, self.n, 
+                                                rows, cols, values)
+
+        if self.timing is not None:
+            self.timing['assembly'] += time.time() - starttime
+
+        if 'u' in want:
+            result['u'] = self.u(t, epar, analysis)
+
+        return result
+
+    def G(self, x, epar=defaultepar):
+        return self.evaluate(x, epar=epar, want=('G',))['G']
+
+    def C(self, x, epar=defaultepar):
+        return self.evaluate(x, epar=epar, want=('C',))['C']
+
+    def i(self, x, epar=defaultepar):
+        return self.evaluate(x, epar=epar, want=('i',))['i']
+
+    def q(self, x, epar=defaultepar):
+        return self.evaluate(x, epar=epar, want=('q',))['q']
+
+    def u(self, t=0.0, epar=defaultepar, analysis=None):
+        self._check()
+
+        dtype = None
+        if analysis == 'ac':
+            dtype = self.toolkit.ac_u_dtype
+
+        lhs = self.toolkit.zeros(self.n, dtype=dtype)
+
+        for element, nodemap in self._usources:
+            np.add.at(lhs, nodemap, element.u(t, epar, analysis))
+
+        return lhs
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        self._check()
+
+        if len(self._limitleaves) == 0:
+            return xnew
+
+        x = self.toolkit.array(xnew)
+        for element, nodemap in self._limitleaves:
+            x[nodemap] = element.limit(x[nodemap], xold[nodemap], epar)
+        return x
+
+    def CY(self, x, w, epar=defaultepar):
+        self._check()
+
+        rows, cols, values = _evaluate_stamps(self._noisesources, 'CY', 
+                                              x, (w, epar))
+
+        return _assemble_matrix(self.toolkit, self.n, rows, cols, values)
+
+class ElementGroup(object):
+    """Elements of the same class that are evaluated together
+
+    If the element class defines an eval_group method and the toolkit is 
+    numeric the group is evaluated in one call to eval_group, otherwise 
+    the elements are evaluated one by one.
+
+    **Attributes**
+        *elementclass*
+          The class of the elements
+
+        *names*
+          List of the hierarchical instance names
+
+        *elements*
+          List of the element objects
+
+        *nodemaps*
+          List of global x-vector indices of each element
+
+        *indices*, *rows*, *cols*
+          Concatenated nodemaps and stamp row and column index vectors of 
+          the elements in the order of the elements list
+
+        *parameters*
+          Dictionary of arrays of the instance parameter values of the 
+          elements keyed by the parameter names
+
+    The results of the elements are cached for the bypass of latent 
+    elements, see the bypass attribute of Circuit.
+
+    """
+    def __init__(self, elementclass):
+        self.elementclass = elementclass
+        self.names = []
+        self.elements = []
+        self.nodemaps = []
+        self.indices = np.zeros(0, dtype=int)
+        self.rows = np.zeros(0, dtype=int)
+        self.cols = np.zeros(0, dtype=int)
+        self._parameters = None
+        self._X_indices = None
+
+        ## Positions of the elements in indices and of the matrix rows and
+        ## columns in indices used by the bypass of latent elements
+        self._starts = np.zeros(0, dtype=int)
+        self._mstarts = np.zeros(0, dtype=int)
+        self._sizes = np.zeros(0, dtype=int)
+        self._rowpos = np.zeros(0, dtype=int)
+        self._colpos = np.zeros(0, dtype=int)
+        self._bypasscache = {}
+
+    def __len__(self):
+        return len(self.elements)
+
+    def append(self, name, element, nodemap):
+        rows, cols = create_stamp_indices(nodemap)
+        rowpos, colpos = create_stamp_indices(len(self.indices) + 
+                                              np.arange(len(nodemap)))
+
+        self.names.append(name)
+        self.elements.append(element)
+        self.nodemaps.append(nodemap)
+        self._starts = np.append(self._starts, len(self.indices))
+        self._mstarts = np.append(self._mstarts, len(self.rows))
+        self._sizes = np.append(self._sizes, len(nodemap))
+        self.indices = np.concatenate((self.indices, nodemap))
+        self.rows = np.concatenate((self.rows, rows))
+        self.cols = np.concatenate((self.cols, cols))
+        self._rowpos = np.concatenate((self._rowpos, rowpos))
+        self._colpos = np.concatenate((self._colpos, colpos))
+        self._parameters = None
+        self._X_indices = None
+        self._bypasscache = {}
+
+    @property
+    def parameters(self):
+        if self._parameters is None:
+            self._parameters = \
+                dict((param.name, np.array([element.iparv.get(param) 
+                                            for element in self.elements]))
+                     for param in self.elementclass.instparams)
+        return self._parameters
+
+    @property
+    def batchable(self):
+        """True if the elements can be evaluated by eval_group"""
+        return self.elementclass.eval_group is not None and \
+            len(set(map(len, self.nodemaps))) == 1 and \
+            getattr(self.elements[0].toolkit, 'numeric', False)
+
+    def batched(self, x):
+        """Return True if the group is evaluated by eval_group"""
+        if self._X_indices is None:
+            if self.batchable:
+                self._X_indices = np.array(self.nodemaps)
+            else:
+                self._X_indices = False
+
+        return self._X_indices is not False and x is not None and \
+            np.asarray(x).dtype != object
+
+    def evaluate(self, want, x, epar=defaultepar, bypass=None):
+        """Evaluate the elements and return the concatenated results
+
+        Returns a dictionary keyed by the names in *want* ('i', 'q', 'G' or 
+        'C'). The vectors are ordered as the indices attribute and the 
+        raveled matrices as the rows and cols attributes. Latent elements 
+        are bypassed if the bypass dictionary is given.
+
+        """
+        if bypass is not None and x is not None and \
+                np.asarray(x).dtype != object:
+            return self._evaluate_bypassed(want, x, epar, bypass)
+
+        if self.batched(x):
+            result = self.elementclass.eval_group(x[self._X_indices], 
+                                                  self.parameters, epar, 
+                                                  want=want)
+            return dict((name, np.ravel(result[name])) for name in want)
+
+        results = []
+        for element, nodemap in zip(self.elements, self.nodemaps):
+            if x is not None:
+                subx = x[nodemap]
+            else:
+                subx = None
+            results.append(element.evaluate(subx, epar=epar, want=want))
+
+        return dict((name, np.concatenate([np.ravel(_todense(result[name])) 
+                                           for result in results]))
+                    for name in want)
+
+    def _evaluate_bypassed(self, want, x, epar, bypass):
+        """Evaluate the elements that are not latent
+
+        The concatenated x-vectors and results of the last evaluation of 
+        the elements are cached. Only the elements whose x-vectors have 
+        changed by bypass['tol'] or more are evaluated and the i and q 
+        vectors of the other elements are extrapolated by the cached G and
+        C matrices.
+
+        """
+        cache = self._bypasscache
+        cached = _cached_names(cache, epar)
+        X = x[self.indices]
+        k = len(self)
+
+        if all(name in cached for name in want):
+            changed = abs(X - cache['X']) >= bypass['tol']
+            active = np.logical_or.reduceat(changed, self._starts)
+            names = cached
+        else:
+            ## Evaluate all elements and restart the cache
+            active = np.ones(k, dtype=bool)
+            names = tuple(set(want) | set(cached))
+            cache.clear()
+            cache['epar'] = _epar_values(epar)
+            cache['X'] = np.array(X, dtype=float)
+            for name in names:
+                if name in ('i', 'q'):
+                    cache[name] = np.zeros(len(self.indices))
+                else:
+                    cache[name] = np.zeros(len(self.rows))
+
+        nactive = np.count_nonzero(active)
+        if nactive > 0:
+            self._update_cache(X, active, names, epar)
+
+        bypass['ndevices'] += k
+        bypass['nbypass'] += k - nactive
+
+        result = {}
+        for name in want:
+            values = cache[name]
+            matrix = {'i': 'G', 'q': 'C'}.get(name)
+            if nactive < k and matrix in cache:
+                dX = X - cache['X']
+                values = values + np.bincount(self._rowpos, 
+                                              weights=cache[matrix] * 
+                                              dX[self._colpos],
+                                              minlength=len(values))
+            result[name] = values
+        return result
+
+    def _update_cache(self, X, active, names, epar):
+        """Evaluate the active elements and store the results in the cache"""
+        cache = self._bypasscache
+        k = len(self)
+
+        if self.batched(X):
+            parameters = dict((name, values[active]) 
+                              for name, values in self.parameters.items())
+            result = self.elementclass.eval_group(X.reshape(k, -1)[active], 
+                                                  parameters, epar, 
+                                                  want=names)
+            for name in names:
+                cache[name].reshape(k, -1)[active] = \
+                    result[name].reshape(len(result[name]), -1)
+        else:
+            for i in np.flatnonzero(active):
+                start, mstart, size = \
+                    self._starts[i], self._mstarts[i], self._sizes[i]
+                result = self.elements[i].evaluate(X[start:start + size], 
+                                                   epar=epar, want=names)
+                for name in names:
+                    if name in ('i', 'q'):
+                        values = cache[name][start:start + size]
+                    else:
+                        values = cache[name][mstart:mstart + size**2]
+                    values[:] = np.ravel(_todense(result[name]))
+
+        changed = np.repeat(active, self._sizes)
+        cache['X'][changed] = X[changed]
+
+class CircuitBatch(object):
+    """Batch of variants of a circuit that are evaluated together
+
+    The variants share the topology of the circuit but the instance 
+    parameters of the leaf elements can differ between the variants. The 
+    x-vectors of the variants are the rows of a nbatch x n array and the 
+    batch is flattened into one block diagonal circuit of nbatch*n 
+    unknowns so the leaves of all variants are evaluated by the same 
+    vectorized code as a CompiledCircuit, where each ElementGroup holds 
+    the elements of all variants.
+
+    The variations argument is a dictionary keyed by hierarchical instance 
+    names of the leaves of dictionaries of sequences of nbatch parameter 
+    values. The elements of the varied leaves are instantiated once for
+    each variant with the varied parameter values.
+
+    **Attributes**
+        *circuit*
+          The circuit of the variants
+
+        *nbatch*
+          Number of variants
+
+        *groups*
+          Dictionary of ElementGroup objects of the nonlinear leaves of all 
+          variants keyed by the element class
+
+    >>> from elements import *
+    >>> c = SubCircuit()
+    >>> c['R1'] = R(1, gnd, r=1e3)
+    >>> c['D1'] = Diode(1, gnd)
+    >>> batch = CircuitBatch(c, {'R1': {'r': [1e3, 2e3, 4e3]}})
+    >>> X = np.zeros((batch.nbatch, batch.n))
+    >>> G = batch.evaluate(X, want=('G',))['G']
+    >>> G.shape, np.allclose(G[2], R(1, gnd, r=4e3).G(X[2]) + c['D1'].G(X[2]))
+    ((3, 2, 2), True)
+
+    """
+    def __init__(self, circuit, variations={}, nbatch=None):
+        self.circuit = circuit
+        self.toolkit = circuit.toolkit
+        self.n = n = circuit.n
+
+        lengths = set(len(values) for variation in variations.values()
+                      for values in variation.values())
+        if nbatch is not None:
+            lengths.add(nbatch)
+        if len(lengths) != 1:
+            raise ValueError('The number of variants must be given by nbatch'
+                             ' or by parameter value sequences of equal'
+                             ' length')
+        self.nbatch = nbatch = lengths.pop()
+
+        ## Offsets of the x-vectors of the variants in the flattened batch
+        self._offsets = n * np.arange(nbatch)
+
+        self.groups = {}
+        self._linearleaves = []
+        self._usources = []
+        self.linear = True
+
+        leafnames = set()
+        for name, element, nodemap in flatten_circuit(circuit):
+            leafnames.add(name)
+            if len(nodemap) == 0:
+                continue
+
+            if name in variations:
+                variants = self._variants(element, nodemap, 
+                                          variations[name])
+            else:
+                variants = element
+
+            self._add_leaf(name, element, variants, nodemap)
+
+        unknown = set(variations) - leafnames
+        if len(unknown) > 0:
+            raise ValueError('Unknown leaf instances: ' + 
+                             ', '.join(sorted(unknown)))
+
+        self._linearstamps = {}
+
+    def __getattr__(self, name):
+        return getattr(self.circuit, name)
+
+    def _variants(self, element, nodemap, variation):
+        """Return a list of the element instances of the variants"""
+        values = dict(element.iparv.items())
+        variants = []
+        for k in range(self.nbatch):
+            for param, paramvalues in variation.items():
+                values[param] = paramvalues[k]
+            variant = element.__class__(toolkit=element.toolkit, **values)
+            if variant.n != len(nodemap):
+                raise ValueError('The size of variant %d of %s differs from '
+                                 'the element' % (k, str(element)))
+            variants.append(variant)
+        return variants
+
+    def _add_leaf(self, name, element, variants, nodemap):
+        """Sort the leaf into the linear, group and source lists"""
+        if element.linear:
+            self._linearleaves.append((variants, nodemap))
+        else:
+            self.linear = False
+            elementclass = element.__class__
+            if elementclass not in self.groups:
+                self.groups[elementclass] = ElementGroup(elementclass)
+            group = self.groups[elementclass]
+            for k, offset in enumerate(self._offsets):
+                if isinstance(variants, list):
+                    element = variants[k]
+                group.append(name, element, nodemap + offset)
+
+        if _overrides(element, 'u', Circuit):
+            self._usources.append((variants, nodemap))
+
+    def _linear_stamps(self, methodname, epar):
+        """Return the pre-summed G or C matrix of the linear leaves"""
+        eparvalues = _epar_values(epar)
+
+        if methodname in self._linearstamps:
+            cachedepar, stamps = self._linearstamps[methodname]
+            if cachedepar == eparvalues:
+                return stamps
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        offsets = self._offsets
+        rows, cols, values = [], [], []
+        for variants, nodemap in self._linearleaves:
+            irows, icols = create_stamp_indices(nodemap)
+            x = np.zeros(len(nodemap))
+
+            if isinstance(variants, list):
+                for element, offset in zip(variants, offsets):
+                    A = getattr(element, methodname)(x, epar)
+                    _append_coords((rows, cols, values), 
+                                   *_stamp_coords(A, nodemap + offset, 
+                                                  irows + offset, 
+                                                  icols + offset))
+            else:
+                ## The stamp of an element that is not varied is repeated
+                A = getattr(variants, methodname)(x, epar)
+                r, c, v = _stamp_coords(A, nodemap, irows, icols)
+                _append_coords((rows, cols, values),
+                               np.add.outer(offsets, r).ravel(),
+                               np.add.outer(offsets, c).ravel(),
+                               np.tile(v, len(offsets)))
+
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
+
+        stamps = _sum_stamps(self.nbatch * self.n, rows, cols, values)
+
+        self._linearstamps[methodname] = (eparvalues, stamps)
+
+        return stamps
+
+    def evaluate(self, X, t=0.0, epar=defaultepar, want=('i', 'q', 'G', 'C'),
+                 analysis=None):
+        """Evaluate the variants with the x-vectors in the rows of X
+
+        Returns a dictionary of nbatch x n vectors and nbatch x n x n 
+        matrices keyed by the names in *want*.
+
+        """
+        nbatch, n = self.nbatch, self.n
+        x = np.ravel(X)
+
+        nlwant = tuple(name for name in want if name in ('i', 'q', 'G', 'C'))
+
+        coords = dict((name, ([], [], [])) for name in nlwant)
+
+        ## The timing dictionary is the one of the circuit
+        if self.timing is not None:
+            starttime = time.time()
+
+        for group in self.groups.values():
+            groupresult = group.evaluate(nlwant, x, epar)
+            for name in nlwant:
+                if name in ('i', 'q'):
+                    _append_coords(coords[name], group.indices, None,
+                                   groupresult[name])
+                else:
+                    _append_coords(coords[name], group.rows, group.cols,
+                                   groupresult[name])
+
+        if self.timing is not None:
+            self.timing['eval'] += time.time() - starttime
+
+        ## The linear leaves are timed when their stamps are evaluated
+        linearstamps = [self._linear_stamps({'i': 'G', 'q': 'C'}.get(name, 
+                                                                     name), 
+                                            epar)
+                        for name in nlwant]
+
+        if self.timing is not None:
+            starttime = time.time()
+
+        ## Add linear elements where i = G*x and q = C*x
+        for name, (rows, cols, values) in zip(nlwant, linearstamps):
+            if name in ('i', 'q'):
+                _append_coords(coords[name], rows, None, values * x[cols])
+            else:
+                _append_coords(coords[name], rows, cols, values)
+
+        result = {}
+        for name in nlwant:
+            rows, cols, values = coords[name]
+            if len(values) == 0:
+                indices, values = [], np.zeros(0)
+            elif name in ('i', 'q'):
+                indices, values = np.concatenate(rows), np.concatenate(values)
+            else:
+                ## The block rows of the flattened batch are the rows of 
+                ## the stacked nbatch x n x n matrices
+                indices = np.concatenate(rows) * n + np.concatenate(cols) % n
+                values = np.concatenate(values)
+
+            if name in ('i', 'q'):
+                shape = (nbatch, n)
+            else:
+                shape = (nbatch, n, n)
+            result[name] = _scatter_sum(indices, values, shape)
+
+        if self.timing is not None:
+            self.timing['assembly'] += time.time() - starttime
+
+        if 'u' in want:
+            result['u'] = self.u(t, epar, analysis)
+
+        return result
+
+    def u(self, t=0.0, epar=defaultepar, analysis=None):
+        """Return the nbatch x n array of the u vectors of the variants"""
+        dtype = None
+        if analysis == 'ac':
+            dtype = self.toolkit.ac_u_dtype
+
+        U = np.zeros((self.nbatch, self.n), dtype=dtype)
+
+        for variants, nodemap in self._usources:
+            if isinstance(variants, list):
+                u = np.array([element.u(t, epar, analysis) 
+                              for element in variants])
+            else:
+                u = variants.u(t, epar, analysis)
+            np.add.at(U, (slice(None), nodemap), u)
+
+        return U
+
+def _cached_names(cache, epar):
+    """Return the names of the results in a bypass cache that are valid
+
+    The cached results are only valid for the environment parameters of 
+    the evaluation.
+
+    """
+    if cache.get('epar') != _epar_values(epar):
+        return ()
+    return tuple(name for name in cache if name not in ('epar', 'X'))
+
+def flatten_circuit(circuit, nodemap=None, prefix=''):
+    """Iterate over the leaf elements of a circuit hierarchy
+
+    Returns (instance name, element, nodemap) tuples where nodemap are the 
+    indices of the x-vector elements of the leaf element in the x-vector
+    of the top circuit. SubCircuit objects that override any of the G, C, 
+    i, q, u or CY methods are treated as leaf elements.
+    
+    """
+    if nodemap is None:
+        nodemap = np.arange(circuit.n)
+
+    for instance, element in circuit.elements.items():
+        elementnodemap = nodemap[circuit._stampplan[instance][0]]
+        instancename = instjoin(prefix, instance)
+
+        if isinstance(element, SubCircuit) and \
+                not _overrides(element, ('G', 'C', 'i', 'q', 'u', 'CY'), 
+                              SubCircuit):
+            for leaf in flatten_circuit(element, elementnodemap, 
+                                        instancename):
+                yield leaf
+        else:
+            yield instancename, element, elementnodemap
+
+def _overrides(obj, methodnames, baseclass):
+    """Return True if any of the methods of baseclass is overridden by obj"""
+    if type(methodnames) is types.StringType:
+        methodnames = (methodnames,)
+    
+    for methodname in methodnames:
+        if getattr(obj.__class__, methodname) != getattr(baseclass, methodname):
+            return True
+    return False
+
+def _evaluate_stamps(leaves, methodname, x, args):
+    """Evaluate element matrices of (element, nodemap, rows, cols) tuples"""
+    rows, cols, values = [], [], []
+
+    for element, nodemap, irows, icols in leaves:
+        if x is not None:
+            rhs = getattr(element, methodname)(x[nodemap], *args)
+        else:
+            rhs = getattr(element, methodname)(*((None,) + tuple(args)))
+
+        rows.append(irows)
+        cols.append(icols)
+        values.append(np.ravel(_todense(rhs)))
+
+    return rows, cols, values
+
+def _sum_stamps(n, rows, cols, values):
+    """Concatenate and sum lists of coordinate vectors of a n x n matrix
+
+    Duplicate coordinates of numeric values are summed and the result is 
+    returned as a (rows, cols, values) tuple of arrays.
+
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    rows, cols, values = (np.concatenate(rows), np.concatenate(cols),
+                          np.concatenate(values))
+
+    ## Sum duplicate coordinates of numeric stamps
+    if values.dtype != object:
+        A = scatter_add_matrix((n, n), rows, cols, values, sparse=True).tocoo()
+        rows, cols, values = A.row, A.col, A.data
+
+    return rows, cols, values
+
+def _stamp_coords(A, nodemap, rows, cols):
+    """Return coordinates and values of an element matrix
+
+    The rows and cols arguments are the stamp index vectors of the 
+    element. Sparse matrices from sub-circuits are mapped using the 
+    nodemap.
+
+    """
+    if hasattr(A, 'tocoo'):
+        A = A.tocoo()
+        return nodemap[A.row], nodemap[A.col], A.data
+    return rows, cols, np.ravel(A)
+
+def _append_coords(coords, rows, cols, values):
+    """Append coordinate and value vectors to a (rows, cols, values) tuple"""
+    if len(values) > 0:
+        coords[0].append(rows)
+        coords[1].append(cols)
+        coords[2].append(values)
+
+def _assemble_matrix(toolkit, n, rows, cols, values, sparse=None):
+    """Sum lists of coordinate and value vectors into a n x n matrix
+
+    A scipy.sparse matrix is returned if *sparse* is True and the values are
+    numeric, otherwise a dense toolkit array. The default is given by the 
+    sparse attribute of the toolkit.
+
+    """
+    if sparse is None:
+        sparse = getattr(toolkit, 'sparse', False)
+
+    if len(values) == 0:
+        if sparse:
+            return scatter_add_matrix((n,n), [], [], [], sparse=True)
+        return toolkit.zeros((n,n))
+
+    values = np.concatenate(values)
+
+    ## Symbolic values can only be stored in dense arrays
+    if sparse and values.dtype != object:
+        return scatter_add_matrix((n,n), np.concatenate(rows), 
+                                  np.concatenate(cols), values, 
+                                  sparse=True)
+
+    lhs = toolkit.zeros((n,n), dtype=np.result_type(float, values))
+
+    return scatter_add_matrix((n,n), np.concatenate(rows), 
+                              np.concatenate(cols), values, dest=lhs)
+
+def _assemble_vector(toolkit, n, indices, values):
+    """Sum lists of index and value vectors into a vector of length n"""
+    if len(values) == 0:
+        return toolkit.zeros(n)
+
+    values = np.concatenate(values)
+
+    lhs = toolkit.zeros(n, dtype=np.result_type(float, values))
+
+    np.add.at(lhs, np.concatenate(indices), values)
+
+    return lhs
+
+def _scatter_sum(indices, values, shape):
+    """Sum values with duplicate flat indices into an array of given shape"""
+    size = np.prod(shape)
+    if len(values) > 0 and np.asarray(values).dtype == float:
+        return np.bincount(indices, weights=values, 
+                           minlength=size).reshape(shape)
+
+    result = np.zeros(size, dtype=np.result_type(float, values))
+    np.add.at(result, indices, values)
+    return result.reshape(shape)
+
+def _todense(A):
+    """Convert a scipy.sparse matrix to a dense array"""
+    if hasattr(A, 'toarray'):
+        return A.toarray()
+    return A
+
+def _epar_values(epar):
+    """Return the environment parameter values used as cache key"""
+    if isinstance(epar, ParameterDict):
+        return epar.items()
+    return epar
 
 def instjoin(*instnames):
     """Return hierarchical instance names from instance name components
@@ -0,0 +1,414 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Storage of compiled circuits on disk
+
+A circuit can be compiled and saved to a binary file with save_compiled()
+and loaded again with load_compiled(). The file holds the x-vector index
+maps of the leaf elements and the pre-summed linear G and C stamps as raw
+numpy buffers that are memory-mapped when the file is loaded. A small
+pickled header holds the nodes and branches and the classes and parameter
+values of the leaf elements.
+
+The loaded StoredCircuit can be passed to the analyses in place of the
+original circuit. Loading does not build the circuit hierarchy and does
+not evaluate any instance parameter expressions. Only the nonlinear leaf 
+elements and the sources are instantiated when the file is loaded, the 
+noise sources are instantiated at the first call to CY().
+
+CompiledCircuitCache keeps compiled circuits in a directory where the
+files are named by a hash of a netlist description or by the structural
+hash of a circuit.
+
+>>> import os, tempfile
+>>> from elements import *
+>>> from dcanalysis import DC
+>>> c = SubCircuit()
+>>> c['vs'] = VS(1, gnd, v=1.5)
+>>> c['R1'] = R(1, 2, r=1e3)
+>>> c['R2'] = R(2, gnd, r=1e3)
+>>> filename = os.path.join(tempfile.mkdtemp(), 'divider.pcc')
+>>> save_compiled(c, filename)
+>>> DC(load_compiled(filename)).solve().v('2')
+0.75
+
+"""
+
+import os
+import sys
+import struct
+import pickle
+import hashlib
+import numpy as np
+
+import numeric
+from circuit import Circuit, CompiledCircuit, defaultepar, \
+    flatten_circuit, instjoin, create_stamp_indices, _epar_values, _overrides
+
+MAGIC = b'PYCCOMP1'
+
+## The file starts with the magic string and the offset and length of
+## the pickled header that is stored after the array buffers
+_preamble = struct.Struct('<8sQQ')
+
+## Alignment of array buffers in the file
+_alignment = 64
+
+def structural_hash(circuit):
+    """Return a hash of the topology and parameter values of a circuit
+
+    The hash is calculated from the nodes and branches of the circuit and
+    the class, x-vector index map and parameter values of each leaf element.
+
+    >>> from elements import *
+    >>> c = SubCircuit()
+    >>> c['R1'] = R(1, gnd, r=1e3)
+    >>> h = structural_hash(c)
+    >>> c['R1'].ipar.r = 2e3
+    >>> structural_hash(c) == h
+    False
+
+    """
+    if isinstance(circuit, CompiledCircuit):
+        circuit = circuit.circuit
+
+    h = hashlib.sha1()
+    _update_hash(h, [str(node) for node in circuit.nodes])
+    _update_hash(h, [repr(branch) for branch in circuit.branches])
+
+    for name, element, nodemap in sorted(flatten_circuit(circuit),
+                                         key=lambda leaf: leaf[0]):
+        _update_hash(h, (name, _classname(element, check=False),
+                         list(nodemap), sorted(element.iparv.items())))
+
+    return h.hexdigest()
+
+def save_compiled(circuit, filename, epar=defaultepar):
+    """Compile a circuit and save it to a file
+
+    The circuit argument is a SubCircuit or a CompiledCircuit. The linear
+    stamps are evaluated with the given environment parameters. The
+    classes of the leaf elements must be defined at module level and the
+    elements must be possible to recreate from their parameter values.
+
+    """
+    if isinstance(circuit, CompiledCircuit):
+        compiled = circuit
+        circuit = compiled.circuit
+    else:
+        compiled = circuit.compile()
+
+    compiled._check()
+
+    if not getattr(compiled.toolkit, 'numeric', False):
+        raise ValueError('Only circuits using a numeric toolkit can be stored')
+
+    header = {'hash': structural_hash(circuit),
+              'epar': _epar_values(epar),
+              'nodes': circuit.nodes,
+              'nodenames': circuit.nodenames,
+              'branches': circuit.branches,
+              'terminalbranches': {},
+              'elements': [],
+              'arrays': {}
+              }
+
+    nodemaps = []
+    for name, element, nodemap in compiled.leaves:
+        if len(nodemap) == 0:
+            continue
+
+        header['elements'].append((name, _classname(element),
+                                   dict(element.iparv.items()),
+                                   element.linear, 
+                                   _overrides(element, 'u', Circuit),
+                                   _overrides(element, 'CY', Circuit)))
+        nodemaps.append(nodemap)
+
+        ## Save branches of terminals for current extraction
+        if len(element.branches) > 0:
+            for terminal in element.terminals:
+                terminalname = instjoin(name, terminal)
+                branch_sign = circuit.get_terminal_branch(terminalname)
+                if branch_sign is not None:
+                    header['terminalbranches'][terminalname] = branch_sign
+
+    arrays = {'nodemapptr': np.cumsum([0] + [len(nodemap)
+                                             for nodemap in nodemaps]),
+              'nodemaps': np.concatenate([np.zeros(0, dtype=int)] + nodemaps)
+              }
+
+    x = np.zeros(circuit.n)
+    for methodname in ('G', 'C'):
+        rows, cols, values = compiled._linear_stamps(methodname, x, epar)
+        if np.asarray(values).dtype == object:
+            raise ValueError('Only numeric stamps can be stored')
+        arrays[methodname + 'rows'] = rows
+        arrays[methodname + 'cols'] = cols
+        arrays[methodname + 'values'] = values
+
+    ## Write to a temporary file that replaces the old file when done
+    tmpfilename = filename + '.tmp'
+    f = open(tmpfilename, 'wb')
+    try:
+        f.write(_preamble.pack(MAGIC, 0, 0))
+
+        for name, A in sorted(arrays.items()):
+            A = np.ascontiguousarray(A)
+            offset = -(-f.tell() // _alignment) * _alignment
+            f.write(b'\0' * (offset - f.tell()))
+            A.tofile(f)
+            header['arrays'][name] = (A.dtype.str, A.shape, offset)
+
+        headeroffset = f.tell()
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        headerlength = f.tell() - headeroffset
+
+        f.seek(0)
+        f.write(_preamble.pack(MAGIC, headeroffset, headerlength))
+    finally:
+        f.close()
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpfilename, filename)
+
+def load_compiled(filename, mmap=True):
+    """Load a compiled circuit saved by save_compiled
+
+    If mmap is True the array buffers are memory-mapped, otherwise they are
+    read into memory.
+
+    """
+    f = open(filename, 'rb')
+    try:
+        magic, headeroffset, headerlength = \
+            _preamble.unpack(f.read(_preamble.size))
+
+        if magic != MAGIC:
+            raise ValueError('%s is not a compiled circuit file'%filename)
+
+        f.seek(headeroffset)
+        header = pickle.loads(f.read(headerlength))
+
+        arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            size = int(np.prod(shape))
+            if mmap and size > 0:
+                arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                         offset=offset,
+                                         shape=shape).view(np.ndarray)
+            else:
+                f.seek(offset)
+                arrays[name] = np.fromfile(f, dtype=dtype,
+                                           count=size).reshape(shape)
+    finally:
+        f.close()
+
+    return StoredCircuit(header, arrays)
+
+class StoredCircuit(CompiledCircuit, Circuit):
+    """Compiled circuit loaded from a file
+
+    The equation methods are inherited from CompiledCircuit and node and
+    branch lookup, extract_v() and extract_i() from Circuit. The stored
+    linear stamps are used when the circuit is evaluated with the
+    environment parameters it was saved with, otherwise the linear leaf
+    elements are recreated and evaluated.
+
+    **Attributes**
+        *structural_hash*
+          The structural hash of the circuit that was saved
+
+        *elements*
+          Dictionary of the recreated leaf elements keyed by the
+          hierarchical instance name
+
+    """
+    def __init__(self, header, arrays):
+        self.circuit = None
+        Circuit.__init__(self, toolkit=numeric)
+
+        self.nodes = header['nodes']
+        self.nodenames = header['nodenames']
+        self.branches = header['branches']
+        self._invalidate_indices()
+
+        self.structural_hash = header['hash']
+        self.linear = all(element[3] for element in header['elements'])
+
+        self._header = header
+        self._arrays = arrays
+        self._elementindex = dict((element[0], k) for k, element in
+                                  enumerate(header['elements']))
+        self._terminalbranches = header['terminalbranches']
+        self._storedepar = header['epar']
+        self._storedstamps = {}
+        for methodname in ('G', 'C'):
+            self._storedstamps[methodname] = \
+                tuple(arrays[methodname + name]
+                      for name in ('rows', 'cols', 'values'))
+
+        self.elements = {}
+        self._build()
+
+    def __getattr__(self, name):
+        raise AttributeError(name)
+
+    def __getitem__(self, instancename):
+        if instancename not in self.elements:
+            self._leaf(self._elementindex[instancename])
+        return self.elements[instancename]
+
+    def __repr__(self):
+        return 'StoredCircuit(' + repr(self.structural_hash) + ')'
+
+    def _leaf(self, k):
+        """Return (instance name, element, nodemap) of leaf k"""
+        name, classname, parameters = self._header['elements'][k][:3]
+
+        if name not in self.elements:
+            self.elements[name] = _create_element(classname, parameters)
+
+        ptr = self._arrays['nodemapptr']
+        nodemap = np.array(self._arrays['nodemaps'][ptr[k]:ptr[k+1]])
+
+        return name, self.elements[name], nodemap
+
+    def _build(self):
+        """Recreate the nonlinear and source leaf elements"""
+        self.groups = {}
+        self._usources = []
+        self._noisesources = []
+        self._linearleaves = []
+        self._limitleaves = []
+        self._linearstamps = {}
+
+        for k, (name, classname, parameters, linear, usource, noise) in \
+                enumerate(self._header['elements']):
+            if not linear or usource:
+                self._add_leaf(*self._leaf(k))
+
+        ## The linear leaves and the noise sources are only recreated when 
+        ## they are needed
+        self._linearleaves = None
+        self._noisesources = None
+
+        self._valid = True
+
+    def _stored_leaves(self, index):
+        """Return (element, nodemap, rows, cols) of leaves with a flag set"""
+        leaves = []
+        for k, element in enumerate(self._header['elements']):
+            if element[index]:
+                name, element, nodemap = self._leaf(k)
+                leaves.append((element, nodemap) + 
+                              create_stamp_indices(nodemap))
+        return leaves
+
+    def _linear_stamps(self, methodname, x, epar):
+        if _epar_values(epar) == self._storedepar:
+            return self._storedstamps[methodname]
+
+        if self._linearleaves is None:
+            self._linearleaves = self._stored_leaves(3)
+
+        return CompiledCircuit._linear_stamps(self, methodname, x, epar)
+
+    def CY(self, x, w, epar=defaultepar):
+        if self._noisesources is None:
+            self._noisesources = self._stored_leaves(5)
+
+        return CompiledCircuit.CY(self, x, w, epar)
+
+    def get_terminal_branch(self, terminalname):
+        return self._terminalbranches.get(terminalname)
+
+class CompiledCircuitCache(object):
+    """Directory of compiled circuit files keyed by a hash
+
+    The key is either a string or tuple that describes the netlist and
+    parameters, like the contents of a netlist file, or a circuit object
+    in which case the structural hash of the circuit is used.
+
+    >>> import tempfile
+    >>> from elements import *
+    >>> def divider():
+    ...     c = SubCircuit()
+    ...     c['R1'] = R(1, 2, r=1e3)
+    ...     c['R2'] = R(2, gnd, r=1e3)
+    ...     return c
+    >>> cache = CompiledCircuitCache(tempfile.mkdtemp())
+    >>> cache.load('divider')
+    >>> cache.compile('divider', divider).n
+    3
+    >>> cache.load('divider') is not None
+    True
+
+    """
+    suffix = '.pcc'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, key):
+        """Return the file name of the compiled circuit of a key"""
+        if isinstance(key, (Circuit, CompiledCircuit)):
+            digest = structural_hash(key)
+        else:
+            h = hashlib.sha1()
+            _update_hash(h, key)
+            digest = h.hexdigest()
+
+        return os.path.join(self.directory, digest + self.suffix)
+
+    def load(self, key, mmap=True):
+        """Load compiled circuit of a key or return None if it is missing"""
+        filename = self.filename(key)
+
+        if os.path.exists(filename):
+            return load_compiled(filename, mmap=mmap)
+
+    def save(self, key, circuit, epar=defaultepar):
+        """Compile and save a circuit under the given key"""
+        save_compiled(circuit, self.filename(key), epar=epar)
+
+    def compile(self, key, builder, epar=defaultepar):
+        """Return the stored circuit of a key
+
+        If the key is not in the cache the circuit is created by calling
+        builder without arguments and is compiled and saved.
+
+        """
+        stored = self.load(key)
+
+        if stored is None:
+            self.save(key, builder(), epar=epar)
+            stored = self.load(key)
+
+        return stored
+
+def _update_hash(h, obj):
+    h.update(repr(obj).encode('utf-8'))
+
+def _classname(element, check=True):
+    """Return the module and class name of an element"""
+    elementclass = element.__class__
+
+    if check:
+        module = sys.modules.get(elementclass.__module__)
+        if getattr(module, elementclass.__name__, None) is not elementclass:
+            raise ValueError('Class %s of element %s is not defined at module '
+                             'level'%(elementclass.__name__, repr(element)))
+
+    return elementclass.__module__, elementclass.__name__
+
+def _create_element(classname, parameters):
+    """Create element from module and class name and parameter values"""
+    modulename, name = classname
+    module = __import__(modulename, globals(), locals(), [name])
+    return getattr(module, name)(**parameters)
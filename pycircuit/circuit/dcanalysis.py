@@ -3,6 +3,7 @@ import logging
 import numpy as np
 
 from analysis import *
+from initialguess import initial_x
 
 class DC(Analysis):
     """DC analyis class
@@ -39,6 +40,19 @@ class DC(Analysis):
     >>> print np.around(res.v('net2'), 2)
     0.7
 
+    The Newton iterations are damped by limiting of the junction voltages 
+    of the elements and by a line search on the residual norm. The 
+    LU-factorization of the jacobian can be reused between iterations by 
+    setting the chord parameter. If Newton's method fails, gmin stepping 
+    and source stepping are tried where the homotopy parameter is 
+    controlled by pseudo-arclength continuation. Iteration counts, 
+    continuation steps, solver times and the name of the algorithm that 
+    succeeded are stored in the stats attribute of the result, see 
+    Analysis.
+
+    >>> res.stats['algorithm'], res.stats['nsolves']
+    ('simple', 1)
+
     """
     parameters = [Parameter(name='reltol', desc='Relative tolerance', unit='', 
                             default=1e-4),
@@ -51,6 +65,24 @@ class DC(Analysis):
                   Parameter(name='maxiter', 
                             desc='Maximum number of iterations', unit='', 
                             default=100),
+                  Parameter(name='limit', 
+                            desc='Limit junction voltage steps', unit='', 
+                            default=True),
+                  Parameter(name='linesearch', 
+                            desc='Backtracking line search of Newton steps', 
+                            unit='', default=True),
+                  Parameter(name='chord', 
+                            desc='Reuse jacobian factorization (chord method)',
+                            unit='', default=False),
+                  Parameter(name='opcache', 
+                            desc='Operating-point cache, None disables caching',
+                            unit='', default=None),
+                  Parameter(name='nodeset', 
+                            desc='Initial node voltages by node name',
+                            unit='V', default=None),
+                  Parameter(name='initialguess', 
+                            desc='InitialGuess object of the x-vector',
+                            unit='', default=None),
                   Parameter(name='epar', desc='Environment parameters',
                             default=defaultepar)
                   ]
@@ -65,65 +97,122 @@ class DC(Analysis):
         ## Refer the voltages to the reference node by removing
         ## the rows and columns that corresponds to this node
 
+        x0 = None
+
+        ## Start from a cached operating point of the same circuit unless
+        ## an initial guess is given
+        opcache = self.par.opcache
+        if opcache is not None and not self.toolkit.symbolic:
+            key = opcache.key(self.cir, self.epar, self.irefnode)
+            if self.par.nodeset is None and self.par.initialguess is None:
+                x0 = opcache.get(key)
+        else:
+            key = None
+
+        with self._assembly_toolkit():
+            if x0 is None:
+                x0 = self._initial_x()
+
+            self._reset_stats()
+
+            try:
+                x = self._solve_x(x0)
+            finally:
+                self._finish_stats()
+
+        if key is not None:
+            opcache.put(key, x)
+
+        logging.info('DC solver statistics: ' + str(self.stats))
+
+        self.result = CircuitResult(self.cir, x)
+        self.result.stats = self.stats
+
+        return self.result
+
+    def _solve_x(self, x0):
+        """Solve for x starting at x0 and try the convergence helpers in turn
+        """
         convergence_helpers = [self._simple, self._homotopy_gmin, 
                                self._homotopy_source, 
                                None]
 
-        x0 = self.toolkit.zeros(self.cir.n) # Would be good with a better initial guess
-
         for algorithm in convergence_helpers:
             if algorithm == None:
                 raise last_e
             else:
                 if algorithm.__doc__:
                     logging.info('Trying ' + algorithm.__doc__)
+                name = algorithm.__name__.lstrip('_')
                 try:
                     x = algorithm(x0)
                 except (NoConvergenceError, SingularMatrix), last_e:
                     logging.warning('Problems encoutered: ' + str(last_e))
+                    self._monitor('algorithm', algorithm=name, success=False)
                 else:
+                    self.stats['algorithm'] = name
+                    self._monitor('algorithm', algorithm=name, success=True)
                     break
 
-        self.result = CircuitResult(self.cir, x)
+        return x
 
-        return self.result
+    def _initial_x(self):
+        """Return initial x-vector from the nodeset and initial guess"""
+        return initial_x(self.cir, self.toolkit.zeros(self.cir.n),
+                         initialguess=self.par.initialguess, 
+                         nodeset=self.par.nodeset)
+
+    def _reset_stats(self):
+        super(DC, self)._reset_stats(algorithm=None)
 
     def _simple(self, x0):
         """Simple Newton's method"""
+        u = self.cir.u(0, self.epar, analysis='dc')
+
         def func(x):
-            return self.cir.i(x) + self.cir.u(0,analysis='dc'), self.cir.G(x)
+            res = self.cir.evaluate(x, epar=self.epar, want=('i', 'G'))
+            return res['i'] + u, res['G']
 
         return self._newton(func, x0)
 
     def _homotopy_gmin(self, x0):
-        """Newton's method with gmin stepping"""
-        x = x0
-        for gmin in (1, 1e-1, 1e-2, 0):
-            n_nodes = len(self.cir.nodes)
-            Ggmin = self.toolkit.zeros((self.cir.n, self.cir.n))
-            Ggmin[0:n_nodes, 0:n_nodes] = gmin * self.toolkit.eye(n_nodes)
+        """Gmin stepping by pseudo-arclength continuation"""
+        ## The conductance from the nodes to ground goes from gmax to zero
+        ## logarithmically when lambda goes from 0 to 1
+        gmax, ndecades = 1., 12
+        def gmin(lambda_):
+            return gmax * (10**(-ndecades * lambda_) - 10**-ndecades) / \
+                (1 - 10**-ndecades)
+        def dgmin(lambda_):
+            return -gmax * np.log(10) * ndecades * \
+                10**(-ndecades * lambda_) / (1 - 10**-ndecades)
 
-            def func(x):
-                return self.cir.i(x) + self.cir.u(0,analysis='dc'), \
-                       self.cir.G(x) + Ggmin
+        n_nodes = len(self.cir.nodes)
+        gdiag = self.toolkit.zeros(self.cir.n)
+        gdiag[0:n_nodes] = 1
+        Gdiag = self.toolkit.diag(gdiag)
+        u = self.cir.u(0, self.epar, analysis='dc')
 
-            x, x0 = self._newton(func, x0), x
+        def func(x, lambda_):
+            res = self.cir.evaluate(x, epar=self.epar, want=('i', 'G'))
+            g = gmin(lambda_)
+            return res['i'] + u + g * gdiag * x, res['G'] + g * Gdiag, \
+                dgmin(lambda_) * gdiag * x
 
-        return x
+        return self._continuation(func, x0)
 
     def _homotopy_source(self, x0):
-        """Newton's method with source stepping"""
-        x = x0
-        for lambda_ in (0, 1e-2, 1e-1, 1):
-            def func(x):
-                f = self.cir.i(x) + lambda_ * self.cir.u(0,analysis='dc')
-                dFdx = self.cir.G(x)
-                return f, dFdx            
-            x, x0 = self._newton(func, x0), x
+        """Source stepping by pseudo-arclength continuation"""
+        u = self.cir.u(0, self.epar, analysis='dc')
 
-        return x
+        def func(x, lambda_):
+            res = self.cir.evaluate(x, epar=self.epar, want=('i', 'G'))
+            return res['i'] + lambda_ * u, res['G'], u
 
-    def _newton(self, func, x0):
+        return self._continuation(func, x0)
+
+    def _tolerances(self, reduction):
+        """Return absolute residual and x tolerances of the reduced system"""
         ones_nodes = self.toolkit.ones(len(self.cir.nodes))
         ones_branches = self.toolkit.ones(len(self.cir.branches))
 
@@ -132,32 +221,245 @@ class DC(Analysis):
         xtol = self.toolkit.concatenate((self.par.vabstol * ones_nodes,
                                  self.par.iabstol * ones_branches))
 
-        (x0, abstol, xtol) = remove_row_col((x0, abstol, xtol), self.irefnode, self.toolkit)
+        return reduction.reduce(abstol), reduction.reduce(xtol)
+
+    def _continuation(self, func, x0):
+        """Solve func(x, lambda) = 0 at lambda = 1 by continuation from 0"""
+        reduction = self._refnode_reduction(self.irefnode)
+        abstol, xtol = self._tolerances(reduction)
+
+        def reduced(x, lambda_):
+            F, J, Flambda = func(reduction.expand(x), lambda_)
+            return tuple(reduction.reduce(A) for A in (F, J, Flambda))
+
+        try:
+            result = continuation(reduced, reduction.reduce(x0),
+                                  full_output = True,
+                                  reltol = self.par.reltol,
+                                  abstol = abstol, xtol = xtol,
+                                  toolkit = self.toolkit,
+                                  callback = self._iteration_callback())
+        except self.toolkit.linearsolverError(), e:
+            raise SingularMatrix(e.message)
+
+        x, infodict, ier, mesg = result
+
+        self._accumulate_stats(infodict)
+
+        if ier != 1:
+            raise NoConvergenceError(mesg)
+
+        return reduction.expand(x)
+
+    def _newton(self, func, x0):
+        reduction = self._refnode_reduction(self.irefnode)
+        abstol, xtol = self._tolerances(reduction)
+        x0 = reduction.reduce(x0)
+
+        limit = None
+        if self.par.limit and getattr(self.cir, 'limit', None) is not None:
+            nnodes = len(self.cir.nodes)
+            def limit(x, x0):
+                xl = self.cir.limit(reduction.expand(x), reduction.expand(x0),
+                                    self.epar)
+                ## Keep the node voltages referred to the reference node
+                xl[:nnodes] -= xl[self.irefnode]
+                return reduction.reduce(xl)
 
         try:
-            result = fsolve(refnode_removed(func, self.irefnode,self.toolkit), 
+            result = fsolve(reduction.reduced_function(func), 
                             x0, 
                             full_output = True, 
                             reltol = self.par.reltol,
                             abstol = abstol, xtol=xtol,
                             maxiter = self.par.maxiter,
-                            toolkit = self.toolkit)
+                            toolkit = self.toolkit,
+                            limit = limit,
+                            linesearch = self.par.linesearch,
+                            chord = self.par.chord,
+                            callback = self._iteration_callback())
         except self.toolkit.linearsolverError(), e:
             raise SingularMatrix(e.message)
 
         x, infodict, ier, mesg = result
 
+        self._accumulate_stats(infodict)
+
         if ier != 1:
             raise NoConvergenceError(mesg)
 
         # Insert reference node voltage
-        return self.toolkit.concatenate((x[:self.irefnode], self.toolkit.array([0.0]), x[self.irefnode:]))
+        return reduction.expand(x)
+
+class DCSweep(DC):
+    """DC sweep analysis
+
+    The swept parameter can be an instance parameter, a global parameter 
+    or an environment parameter like the temperature T. Each point is 
+    started from a linear extrapolation of the previous solutions and the 
+    step is subdivided if the Newton iterations do not converge.
+
+    >>> c = SubCircuit()
+    >>> n1, n2 = c.add_nodes('net1', 'net2')
+    >>> c['vs'] = VS(n1, gnd, v=0)
+    >>> c['R'] = R(n1, n2, r=1e3)
+    >>> c['D'] = Diode(n2, gnd)
+    >>> res = DCSweep(c).solve(np.linspace(0, 5, 11), 'v', instance='vs')
+    >>> print np.around(res.v('net1').y, 1)
+    [ 0.   0.5  1.   1.5  2.   2.5  3.   3.5  4.   4.5  5. ]
+
+    """
+    parameters = DC.parameters + \
+                 [Parameter(name='maxstepdivisions',
+                            desc='Maximum number of step subdivisions', 
+                            unit='', default=10)
+                 ]
+
+    def solve(self, values, param, instance=None, globalparams=None):
+        """Solve DC operating points for the given parameter values
+        
+        *values*
+          Sequence of parameter values
+
+        *param*
+          Parameter name
+
+        *instance*
+          Name of the instance whose instance parameter is swept
+
+        *globalparams*
+          ParameterDict of global parameters, if param is a global parameter
+          the instance parameters of the circuit are evaluated with these
+          values
+
+        If neither instance nor globalparams holds the parameter it is taken 
+        from the environment parameters.
+
+        """
+        values = np.array(values)
+
+        setvalue, unit = self._parameter_setter(param, instance, globalparams)
+        restore = setvalue(None)
+
+        with self._assembly_toolkit():
+            self._reset_stats()
+
+            X = []
+            try:
+                ## Solutions and parameter values of the last two points
+                xlast, plast = [], []
+                for value in values:
+                    x = self._solve_point(setvalue, value, xlast, plast)
+                    X.append(x)
+                    xlast, plast = [x] + xlast[:1], [value] + plast[:1]
+                    self._monitor('step', value=value, nit=self.stats['nit'])
+            finally:
+                restore()
+                self._finish_stats()
+
+        logging.info('DC sweep solver statistics: ' + str(self.stats))
+
+        self.result = CircuitResult(self.cir, x=self.toolkit.array(X).T,
+                                    sweep_values=values, 
+                                    sweep_label=param,
+                                    sweep_unit=unit)
+        self.result.stats = self.stats
+
+        return self.result
+
+    def _solve_point(self, setvalue, value, xlast, plast):
+        """Solve the operating point at value 
+
+        The step from the last point is halved on convergence failure and
+        the intermediate points are used for the extrapolation.
+
+        """
+        if len(xlast) == 0:
+            setvalue(value)
+            return self._solve_x(self._initial_x())
+
+        step = value - plast[0]
+        ndivisions = 0
+        while True:
+            nextvalue = plast[0] + step
+            if abs(nextvalue - plast[0]) >= abs(value - plast[0]):
+                nextvalue = value
+            
+            setvalue(nextvalue)
+            try:
+                x = self._simple(self._predict(nextvalue, xlast, plast))
+            except (NoConvergenceError, SingularMatrix), e:
+                logging.info('Step to %s failed: %s' % (str(nextvalue), 
+                                                         str(e)))
+                self.stats['nrejected'] += 1
+                self._monitor('rejected', value=nextvalue)
+                ndivisions += 1
+                if ndivisions > self.par.maxstepdivisions:
+                    setvalue(value)
+                    return self._solve_x(xlast[0])
+                step /= 2.
+                continue
+
+            self.stats['algorithm'] = 'simple'
+
+            if nextvalue == value:
+                return x
+
+            xlast, plast = [x] + xlast[:1], [nextvalue] + plast[:1]
+
+    def _predict(self, value, xlast, plast):
+        """Extrapolate the initial guess from the last two solutions"""
+        if len(xlast) < 2 or plast[0] == plast[1]:
+            return xlast[0]
+        slope = (xlast[0] - xlast[1]) / (plast[0] - plast[1])
+        return xlast[0] + slope * (value - plast[0])
+
+    def _parameter_setter(self, param, instance, globalparams):
+        """Return function that sets the swept parameter and its unit
+
+        The function returns a function that restores the original value 
+        when it is called with None.
+
+        """
+        if instance is not None:
+            ipar = self.cir[instance].ipar
+            orig = ipar.get(param)
+            def setvalue(value):
+                if value is None:
+                    return lambda: ipar.set(**{param: orig})
+                ipar.set(**{param: value})
+            return setvalue, ipar[param].unit or ''
+        elif globalparams is not None and param in globalparams:
+            orig = globalparams.get(param)
+            def setvalue(value):
+                if value is None:
+                    return lambda: setvalue(orig)
+                globalparams.set(**{param: value})
+                self.cir.update_iparv(globalparams=globalparams)
+            return setvalue, globalparams[param].unit or ''
+        else:
+            orig = self.epar
+            def setvalue(value):
+                if value is None:
+                    return lambda: setattr(self, 'epar', orig)
+                self.epar = orig.copy(**{param: value})
+            return setvalue, orig[param].unit or ''
+
+def refnode_removed(func, irefnode, toolkit, n=None):
+    """Return function of the system where the reference node is removed
+
+    The size n of the full system is needed to plan the reduction once,
+    if it is not given the plan is made at the first call.
+
+    """
+    plan = []
+    if n is not None:
+        plan.append(RefnodeReduction(n, irefnode, toolkit))
 
-def refnode_removed(func, irefnode,toolkit):
     def new(x, *args, **kvargs):
-        newx = toolkit.concatenate((x[:irefnode], toolkit.array([0.0]), x[irefnode:]))
-        f, J = func(newx, *args, **kvargs)
-        return remove_row_col((f, J), irefnode, toolkit)
+        if not plan:
+            plan.append(RefnodeReduction(len(x) + 1, irefnode, toolkit))
+        return plan[0].reduced_function(func)(x, *args, **kvargs)
     return new
 
 if __name__ == "__main__":
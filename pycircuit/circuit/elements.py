@@ -185,6 +185,12 @@ class VS(Circuit):
         else:
             return self.toolkit.array([0, 0, 0])
 
+    def next_event(self, t):
+        ## Only the discontinuities of the function are breakpoints
+        if self.function.discontinuous:
+            return self.function.next_event(t)
+        return self.toolkit.inf
+
     def CY(self, x, w, epar=defaultepar):
         CY = super(VS, self).CY(x, w)
         CY[2, 2] = self.iparv.noisePSD
@@ -259,6 +265,12 @@ class IS(Circuit):
         else:
             return self.toolkit.array([0, 0])
 
+    def next_event(self, t):
+        ## Only the discontinuities of the function are breakpoints
+        if self.function.discontinuous:
+            return self.function.next_event(t)
+        return self.toolkit.inf
+
     def CY(self, x, w, epar=defaultepar):
         return  self.toolkit.array([[self.iparv.noisePSD, -self.iparv.noisePSD],
                                     [-self.iparv.noisePSD, self.iparv.noisePSD]])
@@ -718,6 +730,30 @@ class Gyrator(Circuit):
         
     def G(self, x, epar=defaultepar): return self._G
 
+def pnjlim(vnew, vold, vt, vcrit):
+    """Limit the change of a pn-junction voltage in a Newton iteration
+
+    Above the critical voltage vcrit the change of the voltage is
+    compressed logarithmically so the junction current grows at most 
+    linearly between iterations.
+
+    >>> pnjlim(5.0, 0.6, 0.025, 0.65) < 0.75
+    True
+    >>> pnjlim(0.61, 0.6, 0.025, 0.65)
+    0.61
+
+    """
+    if vnew > vcrit and abs(vnew - vold) > 2 * vt:
+        if vold > 0:
+            arg = 1 + (vnew - vold) / vt
+            if arg > 0:
+                vnew = vold + vt * np.log(arg)
+            else:
+                vnew = vcrit
+        else:
+            vnew = vt * np.log(vnew / vt)
+    return vnew
+
 class Diode(Circuit):
     """ Nonlinear diode
     """
@@ -726,21 +762,84 @@ class Diode(Circuit):
                   unit='A', default=1e-13)]
     linear = False
     def G(self, x, epar=defaultepar):
-        VD = x[0]-x[1]
-
-        VT = self.toolkit.kboltzmann * epar.T / self.toolkit.qelectron
-        g = self.iparv.IS * self.toolkit.exp(VD/VT) / VT
-        return self.toolkit.array([[g, -g],
-                                   [-g, g]])
+        return self.evaluate(x, epar=epar, want=('G',))['G']
 
     def i(self, x, epar=defaultepar):
-        """
+        return self.evaluate(x, epar=epar, want=('i',))['i']
+
+    def evaluate(self, x, t=0.0, epar=defaultepar, want=('i', 'q', 'G', 'C'),
+                 analysis=None):
+        """Evaluate i and G from a common exponential
+
+        >>> d = Diode(1, 0)
+        >>> res = d.evaluate(np.array([0.6, 0.]), want=('i', 'G'))
+        >>> res['G'][0,0] > res['i'][0] > 0
+        True
         
         """
         VD = x[0]-x[1]
         VT = self.toolkit.kboltzmann * epar.T / self.toolkit.qelectron
-        I = self.iparv.IS * (self.toolkit.exp(VD/VT)-1)
-        return self.toolkit.array([I, -I])
+        expVD = self.toolkit.exp(VD/VT)
+
+        result = super(Diode, self).evaluate(x, t, epar, 
+                                             [name for name in want 
+                                              if name not in ('i', 'G')], 
+                                             analysis)
+        if 'i' in want:
+            I = self.iparv.IS * (expVD-1)
+            result['i'] = self.toolkit.array([I, -I])
+        if 'G' in want:
+            g = self.iparv.IS * expVD / VT
+            result['G'] = self.toolkit.array([[g, -g],
+                                              [-g, g]])
+        return result
+
+    def limit(self, xnew, xold, epar=defaultepar):
+        """Limit the change of the junction voltage
+
+        >>> d = Diode(1, 0)
+        >>> d.limit(np.array([5., 0.]), np.array([0.6, 0.]))[0] < 0.75
+        True
+
+        """
+        VT = self.toolkit.kboltzmann * epar.T / self.toolkit.qelectron
+        Vcrit = VT * np.log(VT / (np.sqrt(2) * self.iparv.IS))
+
+        x = np.array(xnew, dtype=float)
+        x[0] = x[1] + pnjlim(xnew[0] - xnew[1], xold[0] - xold[1], VT, Vcrit)
+        return x
+
+    @classmethod
+    def eval_group(cls, X, params, epar=defaultepar, want=('i', 'G')):
+        """Evaluate a group of diodes
+
+        >>> X = np.array([[0.5, 0.], [0.6, 0.1], [0.7, 0.]])
+        >>> params = {'IS': np.array([1e-13, 1e-13, 2e-13])}
+        >>> res = Diode.eval_group(X, params)
+        >>> res['i'].shape, res['G'].shape
+        ((3, 2), (3, 2, 2))
+        >>> d = Diode(1, 0, IS=2e-13)
+        >>> np.allclose(res['G'][2], d.G(X[2]))
+        True
+
+        """
+        VD = X[:,0] - X[:,1]
+        VT = numeric.kboltzmann * epar.T / numeric.qelectron
+        expVD = np.exp(VD/VT)
+        
+        result = {}
+        if 'i' in want:
+            I = params['IS'] * (expVD - 1)
+            result['i'] = np.array([I, -I]).T
+        if 'G' in want:
+            g = params['IS'] * expVD / VT
+            result['G'] = np.array([[g, -g], 
+                                    [-g, g]]).transpose(2, 0, 1)
+        if 'q' in want:
+            result['q'] = np.zeros(X.shape)
+        if 'C' in want:
+            result['C'] = np.zeros(X.shape + X.shape[-1:])
+        return result
 
 class VCVS_limited(Circuit):
     """Voltage controlled voltage source with limited output voltage.
@@ -785,6 +884,38 @@ class VCVS_limited(Circuit):
         vout = x[3] - x[2] - self.function.fprime(x[1]-x[0])*self.function.f(x[1]-x[0])
         return self.toolkit.array([0,0,x[4],-x[4],vout])
 
+    @classmethod
+    def eval_group(cls, X, params, epar=defaultepar, want=('i', 'G')):
+        """Evaluate a group of limited voltage controlled voltage sources"""
+        function = func.Tanh(params['offset'], params['level'], 
+                             toolkit=numeric)
+        vin = X[:,1] - X[:,0]
+        k, n = X.shape
+
+        result = {}
+        if 'i' in want:
+            I = np.zeros(X.shape, dtype=np.result_type(float, X))
+            I[:,2] = X[:,4]
+            I[:,3] = -X[:,4]
+            I[:,4] = X[:,3] - X[:,2] - function.fprime(vin) * function.f(vin)
+            result['i'] = I
+        if 'G' in want:
+            g = function.fprime(vin) * params['g']
+            G = np.zeros((k, n, n))
+            ## Node indices are inp, inn, outp, outn and branch
+            G[:, 2, 4] += 1
+            G[:, 3, 4] += -1
+            G[:, 4, 2] += -1
+            G[:, 4, 3] += 1
+            G[:, 4, 0] += g
+            G[:, 4, 1] += -g
+            result['G'] = G
+        if 'q' in want:
+            result['q'] = np.zeros(X.shape)
+        if 'C' in want:
+            result['C'] = np.zeros((k, n, n))
+        return result
+
 class Idt(Circuit):
     """Integrator
     
@@ -835,6 +966,7 @@ class Idtmod(Circuit):
     
     terminals = ('iplus', 'iminus', 'oplus', 'ominus')
     branches = (Branch(Node('oplus'), Node('ominus')),)
+    linear = False
         
     def __init__(self, *args, **kvargs):
         super(Idtmod, self).__init__(*args, **kvargs)
@@ -871,6 +1003,37 @@ class Idtmod(Circuit):
         _q += _qmask*self.offset
         return _q
 
+    @classmethod
+    def eval_group(cls, X, params, epar=defaultepar, want=('i', 'G')):
+        """Evaluate a group of modulus integrators"""
+        k, n = X.shape
+
+        ## Node indices are iplus, iminus, oplus, ominus, idt_node and branch
+        G = np.zeros((n, n))
+        G[4, 0] +=  1
+        G[4, 1] += -1
+        G[2, 5] +=  1
+        G[3, 5] += -1
+        G[5, 4] += -1
+        G[5, 2] += -1
+        G[5, 3] +=  1
+        
+        result = {}
+        if 'i' in want:
+            result['i'] = np.dot(X, G.T)
+        if 'G' in want:
+            result['G'] = np.tile(G, (k, 1, 1))
+        if 'q' in want:
+            q = np.zeros(X.shape)
+            q[:,4] = X[:,4] % -params['modulus']
+            q[:,4] += np.sign(np.abs(q[:,4])) * params['offset']
+            result['q'] = q
+        if 'C' in want:
+            C = np.zeros((k, n, n))
+            C[:, 4, 4] = 1
+            result['C'] = C
+        return result
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
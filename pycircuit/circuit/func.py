@@ -2,7 +2,13 @@ import numeric
 from scipy import interpolate
 
 class TimeFunction(object):
-    """Time dependent function"""
+    """Time dependent function
+
+    The discontinuous attribute is True if the events of next_event are 
+    discontinuities of the function or its derivative.
+
+    """
+    discontinuous = False
     
     def __init__(self, toolkit=numeric):
         self.toolkit = toolkit
@@ -29,7 +35,9 @@ class Sin(TimeFunction):
     
     def next_event(self, t):
         """Return events at peaks and zero-crossings"""
-        
+        if self.omega == 0:
+            return self.toolkit.inf
+
 #        phase = self.toolkit.simplify(self.omega * (t - self.td) + self.phase)
         phase = self.omega * (t - self.td) + self.phase
         nextevent_phase = (self.toolkit.floor(phase / (self.toolkit.pi / 2)) + 1) * self.toolkit.pi / 2
@@ -42,6 +50,8 @@ class Sin(TimeFunction):
             toolkit.sin(self.omega * (t - self.td) + self.phase)
 
 class Pulse(TimeFunction):
+    discontinuous = True
+
     def __init__(self, v1, v2, td, tr, tf, pw, per, toolkit=numeric):
         self.v1, self.v2, self.td, self.tr, self.tf, self.pw, self.per = \
             v1, v2, td, tr, tf, pw, per
@@ -63,6 +73,8 @@ class Pulse(TimeFunction):
             return t + self.td + self.tr + self.pw - tmod
         elif tmod < self.td + self.tr + self.pw + self.tf:
             return t + self.td + self.tr + self.pw + self.tf - tmod
+        elif self.per == 0:
+            return self.toolkit.inf
         else:
             return self.toolkit.ceil(t / self.per) * self.per
 
@@ -0,0 +1,195 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Initial guesses of the x-vector by node and branch names
+
+An InitialGuess holds node voltages and branch currents by name. It can
+be created from a converged x-vector, saved to a file and applied to a
+modified circuit where the entries are matched by name. This makes it
+possible to start the Newton iterations of a re-simulation close to the
+solution even if nodes or branches have been added or removed.
+
+A nodeset is a partial initial guess of node voltages that is given as a
+dictionary of node names or Node objects and voltages.
+
+>>> from elements import *
+>>> from dcanalysis import DC
+>>> c = SubCircuit()
+>>> c['vs'] = VS('net1', gnd, v=1.5)
+>>> c['R1'] = R('net1', 'net2', r=1e3)
+>>> c['R2'] = R('net2', gnd, r=1e3)
+>>> guess = InitialGuess.from_x(c, DC(c).solve().x)
+>>> guess.nodes['net2']
+0.75
+>>> c['R3'] = R('net2', 'net3', r=1e3)
+>>> guess.apply(c).tolist()
+[1.5, 0.0, 0.75, 0.0, -0.00075]
+
+"""
+
+from circuit import Node, gnd
+
+import numpy as np
+
+class InitialGuess(object):
+    """Node voltages and branch currents by name
+
+    The nodes and branches attributes are dictionaries that map node names
+    and branch names to values. A branch is named by the names of its plus
+    and minus nodes separated by a comma. If there are several branches
+    between the same nodes a suffix '#k' is added for the k:th duplicate.
+
+    """
+    def __init__(self, nodes=None, branches=None):
+        self.nodes = {}
+        self.branches = {}
+
+        if nodes is not None:
+            self.nodes.update(nodeset_names(nodes))
+        if branches is not None:
+            self.branches.update(branches)
+
+    @classmethod
+    def from_x(cls, circuit, x):
+        """Create initial guess from an x-vector of a circuit
+
+        If x holds one x-vector per column, like the result of a transient
+        analysis, the last column is used.
+
+        """
+        guess = cls()
+        guess.update(circuit, x)
+        return guess
+
+    def update(self, circuit, x):
+        """Store the values of x by the node and branch names of circuit"""
+        x = np.asarray(x)
+        if len(x.shape) > 1:
+            x = x[:, -1]
+
+        for index, node in enumerate(circuit.nodes):
+            self.nodes[node.name] = x[index]
+
+        nnodes = len(circuit.nodes)
+        for index, name in enumerate(branch_names(circuit)):
+            self.branches[name] = x[nnodes + index]
+
+    def apply(self, circuit, x=None):
+        """Return x-vector of circuit with the stored values
+
+        Entries that are not found by name are taken from x or are set
+        to zero if x is not given. The node voltages are referred to the
+        ground node if it is present in the stored values.
+
+        """
+        if x is None:
+            x = np.zeros(circuit.n)
+        else:
+            x = np.array(x)
+
+        vref = self.nodes.get(gnd.name, 0)
+
+        for index, node in enumerate(circuit.nodes):
+            if node.name in self.nodes:
+                x[index] = self.nodes[node.name] - vref
+
+        nnodes = len(circuit.nodes)
+        for index, name in enumerate(branch_names(circuit)):
+            if name in self.branches:
+                x[nnodes + index] = self.branches[name]
+
+        return x
+
+    def save(self, filename):
+        """Save the initial guess to a text file
+
+        Each line holds the quantity (V or I), the node or branch name
+        and the value.
+
+        """
+        f = open(filename, 'w')
+        try:
+            for quantity, values in ('V', self.nodes), ('I', self.branches):
+                for name in sorted(values):
+                    f.write('%s %s %s\n' % (quantity, name,
+                                            repr(float(values[name]))))
+        finally:
+            f.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Load initial guess from a file written by save()"""
+        guess = cls()
+        f = open(filename)
+        try:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                quantity, rest = line.split(None, 1)
+                name, value = rest.rsplit(None, 1)
+                if quantity == 'V':
+                    guess.nodes[name] = float(value)
+                else:
+                    guess.branches[name] = float(value)
+        finally:
+            f.close()
+        return guess
+
+    def __len__(self):
+        return len(self.nodes) + len(self.branches)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + repr(self.nodes) + ', ' + \
+            repr(self.branches) + ')'
+
+def nodeset_names(nodeset):
+    """Return nodeset dictionary with node names as keys
+
+    >>> nodeset_names({Node('n1'): 1.0, 'n2': 0.5}) == {'n1': 1.0, 'n2': 0.5}
+    True
+
+    """
+    names = {}
+    for node, value in nodeset.items():
+        if isinstance(node, Node):
+            node = node.name
+        names[node] = value
+    return names
+
+def branch_names(circuit):
+    """Return names of the branches of a circuit
+
+    >>> from elements import *
+    >>> c = SubCircuit()
+    >>> c['vs'] = VS('net1', gnd)
+    >>> c['L1'] = L('net1', gnd)
+    >>> branch_names(c)
+    ['net1,gnd', 'net1,gnd#1']
+
+    """
+    names = []
+    count = {}
+    for branch in circuit.branches:
+        name = branch.plus.name + ',' + branch.minus.name
+        k = count.get(name, 0)
+        count[name] = k + 1
+        if k > 0:
+            name += '#%d' % k
+        names.append(name)
+    return names
+
+def initial_x(circuit, x=None, initialguess=None, nodeset=None):
+    """Return initial x-vector from an initial guess and a nodeset
+
+    The initial guess is applied to x, or to a zero vector, and the
+    nodeset voltages are applied last.
+
+    """
+    if initialguess is not None:
+        x = initialguess.apply(circuit, x)
+    if nodeset is not None:
+        x = InitialGuess(nodes=nodeset).apply(circuit, x)
+    if x is None:
+        x = np.zeros(circuit.n)
+    return x
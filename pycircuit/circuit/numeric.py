@@ -12,12 +12,15 @@ The module is based on `numpy <http://numpy.org>`_.
 from constants import *
 
 import numpy as np
+import scipy.linalg
 from numpy import cos, sin, tan, cosh, sinh, tanh, log, exp, pi, linalg,\
      inf, ceil, floor, dot, linspace, eye, concatenate, sqrt, real, imag,\
      ones, complex, diff, delete, alltrue, maximum, size, conj
 
 symbolic = False
 
+sparse = False
+
 ac_u_dtype = np.complex
 
 def linearsolver(*args, **kvargs):
@@ -26,6 +29,139 @@ def linearsolver(*args, **kvargs):
 def linearsolverError(*args, **kvargs):
     return np.linalg.LinAlgError
 
+def factorize(A):
+    """Return LU factorization of A with a solve method"""
+    return DenseLU(A)
+
+class DenseLU(object):
+    """LU factorization of a dense matrix"""
+    def __init__(self, A):
+        self.lu = scipy.linalg.lu_factor(A, check_finite=False)
+
+        if np.any(np.diag(self.lu[0]) == 0):
+            raise np.linalg.LinAlgError('Singular matrix')
+
+    def solve(self, b):
+        return scipy.linalg.lu_solve(self.lu, b, check_finite=False)
+
+def factorize_pencil(G, C):
+    """Return a factorization of the matrix pencil G + s*C with a solve 
+    method that solves the pencil for a vector of values of s"""
+    return DensePencil(G, C)
+
+class DensePencil(object):
+    """Factorization of a dense matrix pencil G + s*C
+
+    The solve method returns the n x len(ss) array of the solutions of 
+    (G + s*C) x = b for the values s of ss. 
+
+    Small pencils are solved by stacked LU factorizations of G + s*C in 
+    chunks of chunksize values of s. Larger pencils are reduced once by the
+    QZ algorithm to the generalized Schur form G = Q AA Z' and C = Q BB Z' 
+    where AA and BB are upper triangular, or quasi-triangular with 2x2 
+    blocks if G and C are real. Each value of s then costs a back 
+    substitution of O(n**2) that is done for all values together, the 
+    rows below a block of blocksize rows are eliminated by matrix 
+    products.
+
+    The method is 'lu', 'schur' or None which selects schur when n is 
+    larger than nlu and there are more than n / nlu values of s.
+
+    >>> pencil = factorize_pencil(np.eye(2), np.diag([1., 2.]))
+    >>> pencil.solve(np.array([0., 1.]), np.ones(2)).tolist()
+    [[1.0, 0.5], [1.0, 0.3333333333333333]]
+
+    """
+    nlu = 24
+    chunksize = 256
+    blocksize = 32
+
+    def __init__(self, G, C, method=None):
+        self.G = np.asarray(G)
+        self.C = np.asarray(C)
+        self.method = method
+        self._schur = None
+
+    def solve(self, ss, b):
+        ss = np.asarray(ss)
+        n = len(self.G)
+
+        method = self.method
+        if method is None:
+            if n > self.nlu and len(ss) * self.nlu > n:
+                method = 'schur'
+            else:
+                method = 'lu'
+
+        if method == 'schur':
+            return self._solve_schur(ss, b)
+        elif method == 'lu':
+            return self._solve_lu(ss, b)
+        else:
+            raise ValueError('Unknown pencil method %s'%method)
+
+    def _solve_lu(self, ss, b):
+        n = len(self.G)
+        x = np.empty((n, len(ss)), dtype=np.result_type(self.G, ss, b))
+        for start in xrange(0, len(ss), self.chunksize):
+            s = ss[start:start + self.chunksize, np.newaxis, np.newaxis]
+            A = self.G + s * self.C
+            B = np.repeat(np.asarray(b)[np.newaxis, :, np.newaxis], len(s), 
+                          axis=0)
+            x[:, start:start + len(s)] = np.linalg.solve(A, B)[..., 0].T
+        return x
+
+    def _solve_schur(self, ss, b):
+        if self._schur is None:
+            if np.iscomplexobj(self.G) or np.iscomplexobj(self.C):
+                output = 'complex'
+            else:
+                output = 'real'
+            self._schur = scipy.linalg.qz(self.G, self.C, output=output)
+        AA, BB, Q, Z = self._schur
+        n = len(AA)
+
+        c = np.dot(Q.conj().T, b)
+        y = np.empty((n, len(ss)), dtype=complex)
+
+        ## Back substitution of blocks of rows that don't split the 2x2 
+        ## diagonal blocks
+        stop = n
+        while stop > 0:
+            start = max(stop - self.blocksize, 0)
+            if start > 0 and AA[start, start - 1] != 0:
+                start -= 1
+
+            r = c[start:stop, np.newaxis] - np.dot(AA[start:stop, stop:], 
+                                                   y[stop:]) - \
+                ss * np.dot(BB[start:stop, stop:], y[stop:])
+
+            i = stop
+            while i > start:
+                if i - 2 >= start and AA[i - 1, i - 2] != 0:
+                    k = i - 2
+                else:
+                    k = i - 1
+                rk = r[k - start:i - start] - \
+                    np.dot(AA[k:i, i:stop], y[i:stop]) - \
+                    ss * np.dot(BB[k:i, i:stop], y[i:stop])
+                d = AA[k:i, k:i, np.newaxis] + ss * BB[k:i, k:i, np.newaxis]
+                if i - k == 1:
+                    denom = d[0, 0]
+                    y[k] = rk[0]
+                else:
+                    denom = d[0, 0] * d[1, 1] - d[0, 1] * d[1, 0]
+                    y[k] = d[1, 1] * rk[0] - d[0, 1] * rk[1]
+                    y[k + 1] = d[0, 0] * rk[1] - d[1, 0] * rk[0]
+                if np.any(denom == 0):
+                    raise np.linalg.LinAlgError('Singular matrix')
+                y[k:i] /= denom
+                i = k
+
+            stop = start
+
+        return np.dot(Z, y)
+
 def toMatrix(array): 
     return array.astype('complex')
 
@@ -37,6 +173,9 @@ def simplify(x): return x
 def zeros(*args, **kvargs): 
     return np.zeros(*args, **kvargs)
 
+def diag(*args, **kvargs): 
+    return np.diag(*args, **kvargs)
+
 def array(*args, **kvargs): 
     return np.array(*args, **kvargs)
 
@@ -0,0 +1,108 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Cache of DC operating points
+
+The small-signal analyses need the DC operating point of the circuit and
+solve it with a DC analysis when no x-vector is given. The operating
+points are kept in an OperatingPointCache keyed by the structural hash of
+the circuit, the environment parameter values and the reference node
+index so repeated analyses of the same circuit solve the DC operating
+point only once. DC.solve uses a cached operating point as initial guess.
+Caching is disabled unless a cache is given by the opcache parameter of
+the analyses, the same cache can be shared by several analyses.
+
+>>> from elements import *
+>>> from dcanalysis import DC
+>>> cache = OperatingPointCache(maxsize=4)
+>>> c = SubCircuit()
+>>> c['vs'] = VS(1, gnd, v=1.5)
+>>> c['R1'] = R(1, gnd, r=1e3)
+>>> res = DC(c, opcache=cache).solve()
+>>> res = DC(c, opcache=cache).solve()
+>>> cache.hits, cache.misses
+(1, 1)
+
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from circuit import defaultepar, _epar_values
+from compiledcache import structural_hash
+
+class OperatingPointCache(object):
+    """LRU cache of DC solution vectors
+
+    At most maxsize operating points are kept, when a new point is stored
+    in a full cache the least recently used point is evicted. The number
+    of successful and failed lookups are counted in the hits and misses
+    attributes.
+
+    >>> cache = OperatingPointCache(maxsize=2)
+    >>> for key in 'abc':
+    ...     cache.put(key, np.zeros(2))
+    >>> cache.get('a') is None, cache.get('c')
+    (True, array([ 0.,  0.]))
+    >>> len(cache), cache.hits, cache.misses
+    (2, 1, 1)
+
+    """
+    def __init__(self, maxsize=32):
+        self._entries = OrderedDict()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, circuit, epar=defaultepar, irefnode=None):
+        """Return cache key of a circuit and environment parameters"""
+        h = getattr(circuit, 'structural_hash', None)
+        if not isinstance(h, str):
+            h = structural_hash(circuit)
+        return (h, repr(_epar_values(epar)), irefnode)
+
+    def get(self, key):
+        """Return a copy of the cached x-vector or None if key is missing"""
+        x = self._entries.pop(key, None)
+
+        if x is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries[key] = x
+        return np.array(x)
+
+    def put(self, key, x):
+        """Store x-vector and evict the least recently used entries"""
+        self._entries.pop(key, None)
+        self._entries[key] = np.array(x)
+        self._evict()
+
+    def clear(self):
+        """Remove all entries and reset the hit and miss counters"""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while len(self._entries) > max(self._maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _get_maxsize(self):
+        return self._maxsize
+
+    def _set_maxsize(self, maxsize):
+        self._maxsize = maxsize
+        self._evict()
+
+    maxsize = property(_get_maxsize, _set_maxsize,
+                       doc='Maximum number of cached operating points')
@@ -0,0 +1,173 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Storage of the x-vectors of time domain simulations
+
+The transient analysis passes the time and the x-vector of each accepted
+time step to a result writer. When the simulation is finished the writer
+returns the time vector and the x-vectors as a n x npoints array that is
+used as the x attribute of the result.
+
+An ArrayWriter keeps the points in a preallocated NumPy buffer that grows
+geometrically. A MemmapWriter writes the points to a file in chunks and
+returns arrays that are memory mapped from the file so the memory use is
+bounded by the chunk size. The voltages and currents of the result are
+then read from the file when they are extracted.
+
+>>> writer = ArrayWriter(capacity=2)
+>>> for t in 0., 1., 2.:
+...     writer.append(t, np.array([t, 2 * t]))
+>>> t, X = writer.finish()
+>>> t.tolist(), X.tolist()
+([0.0, 1.0, 2.0], [[0.0, 1.0, 2.0], [0.0, 2.0, 4.0]])
+
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+class ResultWriter(object):
+    """Base class of result writers
+
+    The points are stored as rows of the time followed by the x-vector. The
+    size of the x-vector is taken from the first point. No points can be 
+    appended after finish() has been called.
+
+    """
+    def __init__(self, dtype=float):
+        self.dtype = dtype
+        self.n = None
+        self._count = 0
+        self._finished = False
+
+    def reserve(self, npoints):
+        """Hint that about npoints points will be appended"""
+        pass
+
+    def append(self, t, x):
+        """Append the x-vector at time t"""
+        if self._finished:
+            raise ValueError('Cannot append to a finished result writer')
+        if self.n is None:
+            self.n = len(x)
+            self._allocate()
+        row = self._row()
+        row[0] = t
+        row[1:] = x
+        self._count += 1
+
+    def finish(self):
+        """Return the time vector and the n x npoints array of x-vectors"""
+        self._finished = True
+        data = self._data()
+        ## The time vector is returned as a plain ndarray as the waveforms
+        ## only accept exact ndarray instances as x-values
+        return np.asarray(data[:, 0]), data[:, 1:].T
+
+    def __len__(self):
+        return self._count
+
+    def _allocate(self):
+        raise NotImplementedError()
+
+    def _row(self):
+        """Return the buffer row of the next point"""
+        raise NotImplementedError()
+
+    def _data(self):
+        """Return the npoints x n+1 array of the points"""
+        raise NotImplementedError()
+
+class ArrayWriter(ResultWriter):
+    """Result writer with a growable preallocated buffer
+
+    The capacity of the buffer is doubled when it is full. The points are
+    then copied to a new buffer so arrays returned by finish() never refer
+    to memory that is released. When the writer is finished the returned 
+    arrays are views of the buffer unless more than half of the buffer is
+    unused, then the points are copied to release the unused rows.
+
+    """
+    def __init__(self, capacity=1024, dtype=float):
+        super(ArrayWriter, self).__init__(dtype)
+        self.capacity = max(capacity, 1)
+        self._buffer = None
+
+    def reserve(self, npoints):
+        if self._buffer is None:
+            self.capacity = max(npoints, 1)
+        elif npoints > self.capacity:
+            self._resize(npoints)
+
+    def _allocate(self):
+        self._buffer = np.empty((self.capacity, self.n + 1),
+                                dtype=self.dtype)
+
+    def _resize(self, capacity):
+        buffer = np.empty((capacity, self.n + 1), dtype=self.dtype)
+        buffer[:self._count] = self._buffer[:self._count]
+        self._buffer = buffer
+        self.capacity = capacity
+
+    def _row(self):
+        if self._count == self.capacity:
+            self._resize(2 * self.capacity)
+        return self._buffer[self._count]
+
+    def _data(self):
+        if self._buffer is None:
+            return np.empty((0, 1), dtype=self.dtype)
+        if 2 * self._count < self.capacity:
+            self._resize(self._count)
+        return self._buffer[:self._count]
+
+class MemmapWriter(ResultWriter):
+    """Result writer that streams the points to a file
+
+    The points are collected in a buffer of chunksize rows that is written
+    to the file when it is full. The arrays returned by finish() are
+    memory mapped from the file. If no filename is given a temporary file
+    is created, it is not removed when the result is deleted.
+
+    """
+    def __init__(self, filename=None, chunksize=4096, dtype=float):
+        super(MemmapWriter, self).__init__(dtype)
+        if filename is None:
+            fd, filename = tempfile.mkstemp(prefix='pycircuit',
+                                            suffix='.dat')
+            os.close(fd)
+        self.filename = filename
+        self.chunksize = max(chunksize, 1)
+        self._file = None
+        self._chunk = None
+        self._nchunk = 0
+
+    def _allocate(self):
+        self._file = open(self.filename, 'wb')
+        self._chunk = np.empty((self.chunksize, self.n + 1),
+                               dtype=self.dtype)
+
+    def _row(self):
+        if self._nchunk == self.chunksize:
+            self._flush()
+        self._nchunk += 1
+        return self._chunk[self._nchunk - 1]
+
+    def _flush(self):
+        self._chunk[:self._nchunk].tofile(self._file)
+        self._nchunk = 0
+
+    def _data(self):
+        if self._file is None:
+            return np.empty((0, 1), dtype=self.dtype)
+        if not self._file.closed:
+            self._flush()
+            self._file.close()
+            self._chunk = None
+        if self._count == 0:
+            return np.empty((0, self.n + 1), dtype=self.dtype)
+        return np.memmap(self.filename, dtype=self.dtype, mode='r',
+                         shape=(self._count, self.n + 1))
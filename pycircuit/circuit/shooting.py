@@ -38,6 +38,10 @@ class PSS(Analysis):
         Steady-State Methods for Simulating Analog and Microwave Circuits
         Kluwer Academic Publishers
         ISBN 0792390695
+
+    The statistics of the Newton solves of the time steps, see Analysis, 
+    are stored in the stats attribute of the results where the statistics
+    of the shooting Newton iterations are found under the key 'shooting'.
     
     """
 
@@ -63,31 +67,37 @@ class PSS(Analysis):
     
     def __init__(self, cir, toolkit=None, irefnode=None, **kvargs):
         self.parameters = super(PSS, self).parameters + self.parameters            
-        super(PSS, self).__init__(cir, **kvargs)
+        super(PSS, self).__init__(cir, toolkit=toolkit, **kvargs)
 
     def solve_timestep(self, x0, t, dt, refnode=gnd):
-        toolkit = self.toolkit
-        concatenate, array = toolkit.concatenate, toolkit.array
-
         n=self.cir.n
         analysis_name = self.par.analysis
         ## Refer the voltages to the reference node by removing
         ## the rows and columns that corresponds to this node
         irefnode = self.cir.get_node_index(refnode)
+        reduction = self._refnode_reduction(irefnode)
+
+        xlast = reduction.expand(x0)
+        ueq = -self.cir.q(xlast, self.epar)/dt
+        u = self.cir.u(t, self.epar, analysis=analysis_name)
 
         def func(x):
-            x = concatenate((x[:irefnode], array([0.0]), x[irefnode:]))
-            xlast = concatenate((x0[:irefnode], array([0.0]), x0[irefnode:]))
-            C = self.cir.C(x)
+            x = reduction.expand(x)
+            res = self.cir.evaluate(x, t, self.epar, want=('i', 'q', 'G', 'C'))
+            C = res['C']
             Geq = C/dt
-            ueq = -self.cir.q(xlast)/dt
-            f =  self.cir.i(x) + self.cir.q(x)/dt + self.cir.u(t, analysis=analysis_name) + ueq
-            J = self.cir.G(x) + Geq
-            (f,J,C) = remove_row_col((f,J,C), irefnode, self.toolkit)
+            f =  res['i'] + res['q']/dt + u + ueq
+            J = res['G'] + Geq
+            (f,J,C) = (reduction.reduce(A) for A in (f,J,C))
             self._Jf, self._C = J, C
             return f, J
 
-        x = analysis.fsolve(func, x0, reltol=self.par.reltol, toolkit=self.toolkit)
+        x, infodict, ier, mesg = \
+            analysis.fsolve(func, x0, reltol=self.par.reltol, 
+                            toolkit=self.toolkit, full_output=True,
+                            callback=self._iteration_callback())
+        self._accumulate_stats(infodict)
+        self.stats['nsteps'] += 1
         # Insert reference node voltage
         #x = concatenate((x[:irefnode], array([0.0]), x[irefnode:]))
         return x
@@ -114,8 +124,8 @@ class PSS(Analysis):
         def func(x):
             x = self.solve_timestep(x, times[0], dt)
             x0 = copy(x)
-            Jshoot = np.mat(toolkit.eye(n-1))
-            C = copy(np.mat(self._C))
+            Jshoot = np.mat(np.eye(n-1))
+            C = copy(self._C)
 
             ## Save C and transient jacobian for PAC analysis
             self.Cvec = [copy(self._C)]
@@ -125,28 +135,35 @@ class PSS(Analysis):
                 x = copy(self.solve_timestep(x, t, dt))
                 self.Cvec.append(copy(self._C))
                 self.Jtvec.append(copy(self._Jf))
-                Jshoot = np.mat(self._Jf).I * C * Jshoot
-                C = copy(np.mat(self._C))
+                Jshoot = np.mat(toolkit.linearsolver(self._Jf, 
+                                                     toolkit.dot(C, Jshoot)))
+                C = copy(self._C)
 
             residual = x0 - x
 
-            D = np.mat(toolkit.eye(n-1))
+            D = np.mat(np.eye(n-1))
             return residual, D - alpha * Jshoot
         
         ## Find periodic steady state x-vector
-        x0_ss = analysis.fsolve(func, x, maxiter=maxiterations, toolkit=self.toolkit)
+        self._reset_stats()
+        try:
+            x0_ss, infodict, ier, mesg = \
+                analysis.fsolve(func, x, maxiter=maxiterations, 
+                                toolkit=self.toolkit, full_output=True)
+            self.stats['shooting'] = infodict
+            self._monitor('shooting', **infodict)
         
-        X = [x0_ss]
-        for t in times:
-            x=self.solve_timestep(X[-1],t,dt)
-            X.append(copy(x))
+            X = [x0_ss]
+            for t in times:
+                x=self.solve_timestep(X[-1],t,dt)
+                X.append(copy(x))
+        finally:
+            self._finish_stats()
 
         X = toolkit.array(X[1:]).T
 
         # Insert reference node voltage
-        X = toolkit.concatenate((X[:irefnode], 
-                                 toolkit.zeros((1,len(times))), 
-                                 X[irefnode:]))
+        X = self._refnode_reduction(irefnode).expand(X)
 
         tpss = analysis.CircuitResult(self.cir, x=X, xdot=None,
                                       sweep_values=times, sweep_label='time', 
@@ -158,7 +175,10 @@ class PSS(Analysis):
                                       sweep_values=freqs, sweep_label='freq', 
                                       sweep_unit='Hz')
         
-        return InternalResultDict({'tpss': tpss, 'fpss': fpss})
+        result = InternalResultDict({'tpss': tpss, 'fpss': fpss})
+        result.stats = tpss.stats = fpss.stats = self.stats
+
+        return result
 
 class PAC(Analysis):
     """Small-signal analysis over a time varying operating point"""
@@ -168,7 +188,7 @@ class PAC(Analysis):
 
     def __init__(self, cir, toolkit=None, **kvargs):
         self.parameters = super(PAC, self).parameters + self.parameters            
-        super(PAC, self).__init__(cir, **kvargs)
+        super(PAC, self).__init__(cir, toolkit=toolkit, **kvargs)
     
     def solve(self, pss, freqs, refnode=gnd, period=1e-3, x0=None, timestep=1e-6, 
               maxiterations=20):
@@ -183,8 +203,8 @@ class PAC(Analysis):
         N = self.cir.n - 1 ## ref node removed
         M = len(times)
 
-        irefnode = self.cir.get_node_index(refnode)
-        (u0,) = remove_row_col((self.cir.u(0, analysis_name),), irefnode, self.toolkit)
+        reduction = self._refnode_reduction(self.cir.get_node_index(refnode))
+        u0 = reduction.reduce(self.cir.u(0, analysis_name))
 
         ## Create LHS matrix using backward Euler discretization
         L = tk.zeros((N*M, N*M),dtype=tk.complex)
@@ -229,10 +249,7 @@ class PAC(Analysis):
         freqs = np.array(freqs)
 
         # Insert reference node voltage
-        irefnode = self.cir.get_node_index(refnode)
-        X = tk.concatenate((X[:,:irefnode], 
-                            tk.zeros((len(freqs),1)), 
-                            X[:,irefnode:]), axis=1)
+        X = reduction.expand(X.T).T
 
 
         res = analysis.CircuitResult(self.cir, x = X.T, 
@@ -0,0 +1,162 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Module of sparse numeric operations that can be used as a toolkit for
+Analysis objects
+
+The module is based on `scipy.sparse <http://scipy.org>`_ and extends the
+:mod:`numeric` toolkit. Circuit matrices are assembled as sparse matrices
+and linear systems are solved with SuperLU. The column ordering computed by
+the first factorization of a given sparsity pattern is reused by later
+factorizations of matrices with the same pattern, e.g. in consecutive
+Newton iterations or frequency points.
+
+Vectors and the small element matrices are still dense numpy arrays.
+
+Example:
+
+>>> import sparse_numeric
+>>> from elements import *
+>>> from dcanalysis import DC
+>>> c = SubCircuit()
+>>> n1 = c.add_node('net1')
+>>> c['vs'] = VS(n1, gnd, v=1.5)
+>>> c['R'] = R(n1, gnd, r=1e3)
+>>> DC(c, toolkit=sparse_numeric).solve().v('net1')
+1.5
+
+"""
+
+from numeric import *
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+sparse = True
+
+## Maximum number of column orderings kept in the ordering cache
+maxorderings = 16
+
+_orderings = {}
+
+def issparse(x):
+    return scipy.sparse.issparse(x)
+
+def array(obj, *args, **kvargs):
+    if issparse(obj):
+        dtype = kvargs.get('dtype', (args or (None,))[0])
+        if dtype is not None:
+            return obj.astype(dtype)
+        return obj
+    return np.array(obj, *args, **kvargs)
+
+def dot(a, b):
+    if issparse(a):
+        return a.dot(b)
+    elif issparse(b):
+        return np.asarray(b.T.dot(np.asarray(a).T)).T
+    else:
+        return np.dot(a, b)
+
+def delete(arr, obj, axis=None):
+    """Delete rows or columns of a sparse matrix or elements of an array"""
+    if not issparse(arr):
+        return np.delete(arr, obj, axis=axis)
+
+    keep = np.delete(np.arange(arr.shape[axis]), obj)
+    if axis == 0:
+        return arr.tocsr()[keep, :]
+    else:
+        return arr.tocsc()[:, keep]
+
+def diag(v):
+    return scipy.sparse.diags(v, 0, format='csr')
+
+def eye(n, dtype=float):
+    return scipy.sparse.identity(n, dtype=dtype, format='csr')
+
+def det(x):
+    if issparse(x):
+        x = x.toarray()
+    return np.linalg.det(x)
+
+def _pattern_key(A):
+    return (A.shape, A.dtype.char,
+            hash(A.indptr.tobytes()), hash(A.indices.tobytes()))
+
+def factorize(A):
+    """Return a SuperLU factorization of A
+
+    The fill-reducing column ordering is cached per sparsity pattern so
+    matrices sharing a pattern skip the ordering step.
+
+    """
+    A = scipy.sparse.csc_matrix(A)
+    A.sum_duplicates()
+    A.sort_indices()
+
+    key = _pattern_key(A)
+    perm_c = _orderings.get(key)
+
+    try:
+        if perm_c is None:
+            lu = scipy.sparse.linalg.splu(A)
+            if len(_orderings) >= maxorderings:
+                _orderings.clear()
+            _orderings[key] = lu.perm_c
+            return lu
+        else:
+            return PermutedLU(scipy.sparse.linalg.splu(A[:, perm_c],
+                                                       permc_spec='NATURAL'),
+                              perm_c)
+    except RuntimeError, e:
+        raise np.linalg.LinAlgError(str(e))
+
+class PermutedLU(object):
+    """LU factorization of A[:, perm_c] that solves A x = b"""
+    def __init__(self, lu, perm_c):
+        self.lu = lu
+        self.perm_c = perm_c
+
+    def solve(self, b):
+        y = self.lu.solve(b)
+        x = np.empty_like(y)
+        x[self.perm_c] = y
+        return x
+
+def factorize_pencil(G, C):
+    """Return a factorization of the matrix pencil G + s*C
+
+    Dense matrices are factorized by the numeric toolkit. A sparse pencil
+    is factorized for each value of s, sharing the column ordering.
+
+    """
+    if not issparse(G) and not issparse(C):
+        return DensePencil(G, C)
+    return SparsePencil(G, C)
+
+class SparsePencil(object):
+    """Sparse matrix pencil G + s*C solved by one factorization per s"""
+    def __init__(self, G, C):
+        self.G = scipy.sparse.csc_matrix(G)
+        self.C = scipy.sparse.csc_matrix(C)
+
+    def solve(self, ss, b):
+        x = np.empty((self.G.shape[0], len(ss)), dtype=complex)
+        for k, s in enumerate(ss):
+            x[:, k] = linearsolver(self.G + s * self.C, b)
+        return x
+
+def linearsolver(A, b):
+    if not issparse(A):
+        return np.linalg.solve(A, b)
+
+    b = np.asarray(b)
+    if np.iscomplexobj(b) and not np.iscomplexobj(A.data):
+        A = A.astype(complex)
+    elif np.iscomplexobj(A.data):
+        b = b.astype(A.dtype)
+
+    return factorize(A).solve(b)
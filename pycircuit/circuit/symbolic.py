@@ -19,6 +19,8 @@ from constants_sympy import kboltzmann, eps0, epsRSi, epsRSiO2, qelectron
 
 symbolic = True
 
+sparse = False
+
 ac_u_dtype = np.object
 
 def linearsolver(A, b):
@@ -89,6 +91,9 @@ def dot(*args,**kvargs):
 def delete(*args,**kvargs):
     return np.delete(*args,**kvargs)
 
+def diag(*args,**kvargs):
+    return np.diag(*args,**kvargs)
+
 def eye(*args,**kvargs):
     return np.eye(*args,**kvargs)
 
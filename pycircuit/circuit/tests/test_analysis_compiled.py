@@ -0,0 +1,164 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Test analyses of compiled circuits
+"""
+
+from nose.tools import *
+import pycircuit.circuit.circuit
+from pycircuit.circuit import *
+from pycircuit.circuit.transient import Transient
+from pycircuit.utilities import Parameter, ParameterDict
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+epar = ParameterDict(Parameter('T', default=300))
+
+class Stage(SubCircuit):
+    """RC-stage with a diode clamp"""
+    terminals = ('inp', 'outp')
+
+    def __init__(self, *args, **kvargs):
+        super(Stage, self).__init__(*args, **kvargs)
+        self['R'] = R('inp', 'outp', r=1e3)
+        self['C'] = C('outp', gnd, c=1e-12)
+        self['D'] = Diode('outp', gnd)
+
+def create_circuit():
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    c = SubCircuit()
+    c['vs'] = VSin('n0', gnd, vo=0.8, va=0.1, freq=1e8, vac=1.0)
+    c['I1'] = Stage('n0', 'n1')
+    c['I2'] = Stage('n1', 'n2')
+    c['RL'] = R('n2', gnd, r=1e4)
+
+    return c
+
+def test_compiled_equations():
+    c = create_circuit()
+    cc = c.compile()
+
+    assert_equal(len(cc.leaves), 8)
+    assert_equal(sorted(sum([group.names for group in cc.groups.values()],
+                            [])),
+                 ['I1.D', 'I2.D'])
+
+    x = np.linspace(0, 0.5, c.n)
+
+    for method in ('G', 'C', 'i', 'q'):
+        assert_array_almost_equal(getattr(cc, method)(x, epar),
+                                  getattr(c, method)(x, epar))
+
+    assert_array_almost_equal(cc.u(1e-9, epar), c.u(1e-9, epar))
+    assert_array_almost_equal(cc.u(0, epar, analysis='ac'),
+                              c.u(0, epar, analysis='ac'))
+    assert_array_almost_equal(cc.CY(x, 1e6, epar), c.CY(x, 1e6, epar))
+
+def test_compiled_update():
+    """Test that the compiled circuit follows changes of the circuit"""
+    c = create_circuit()
+    cc = c.compile()
+
+    x = np.linspace(0, 0.5, c.n)
+
+    cc.G(x, epar)
+    c['I2']['R'].ipar.r = 2e3
+    assert_array_almost_equal(cc.G(x, epar), c.G(x, epar))
+
+    c['R2'] = R('n1', gnd, r=1e3)
+    x = np.linspace(0, 0.5, c.n)
+    assert_array_almost_equal(cc.G(x, epar), c.G(x, epar))
+    assert_equal(len(cc.leaves), 9)
+
+def test_dc():
+    resref = DC(create_circuit(), epar=epar).solve()
+    res = DC(create_circuit().compile(), epar=epar).solve()
+
+    assert_array_almost_equal(res.x, resref.x)
+    assert_almost_equal(res.v('n2'), resref.v('n2'))
+
+def test_ac():
+    freqs = np.array([1e6, 1e9])
+    resref = AC(create_circuit(), epar=epar).solve(freqs)
+    res = AC(create_circuit().compile(), epar=epar).solve(freqs)
+
+    assert_array_almost_equal(res.v('n2').y, resref.v('n2').y)
+
+def test_noise():
+    resref = Noise(create_circuit(), inputsrc='vs',
+                   outputnodes=(Node('n2'), gnd), epar=epar).solve(1e6)
+    res = Noise(create_circuit().compile(), inputsrc='vs',
+                outputnodes=(Node('n2'), gnd), epar=epar).solve(1e6)
+
+    assert_almost_equal(res['Svnout'] / resref['Svnout'], 1)
+    assert_almost_equal(res['gain'] / resref['gain'], 1)
+
+def test_transient():
+    resref = Transient(create_circuit(),
+                       epar=epar).solve(tend=1e-8, timestep=1e-9)
+    res = Transient(create_circuit().compile(),
+                    epar=epar).solve(tend=1e-8, timestep=1e-9)
+
+    assert_array_almost_equal(res.x, resref.x)
+
+def test_stored():
+    """Test saving and loading of compiled circuits"""
+    from pycircuit.circuit.compiledcache import save_compiled, load_compiled,\
+        CompiledCircuitCache, structural_hash
+    import tempfile, os, shutil
+
+    directory = tempfile.mkdtemp()
+    try:
+        c = create_circuit()
+        filename = os.path.join(directory, 'stages.pcc')
+        save_compiled(c, filename, epar=epar)
+
+        for mmap in True, False:
+            sc = load_compiled(filename, mmap=mmap)
+
+            assert_equal(sc.structural_hash, structural_hash(c))
+            assert_equal(sc.nodes, c.nodes)
+            assert_equal(sc.branches, c.branches)
+
+            x = np.linspace(0, 0.5, c.n)
+            for method in ('G', 'C', 'i', 'q'):
+                assert_array_almost_equal(getattr(sc, method)(x, epar),
+                                          getattr(c, method)(x, epar))
+            assert_array_almost_equal(sc.u(1e-9, epar), c.u(1e-9, epar))
+            assert_array_almost_equal(sc.CY(x, 1e6, epar), c.CY(x, 1e6, epar))
+
+            ## Linear leaves are recreated for other environment parameters
+            epar2 = ParameterDict(Parameter('T', default=350))
+            assert_array_almost_equal(sc.G(x, epar2), c.G(x, epar2))
+            assert_array_almost_equal(sc.CY(x, 1e6, epar2), 
+                                      c.CY(x, 1e6, epar2))
+
+        freqs = np.array([1e6, 1e9])
+        resref = AC(c, epar=epar).solve(freqs)
+        res = AC(sc, epar=epar).solve(freqs)
+        assert_array_almost_equal(res.v('n2').y, resref.v('n2').y)
+        assert_array_almost_equal(res.i('vs.plus').y, resref.i('vs.plus').y)
+
+        resref = Transient(c, epar=epar).solve(tend=1e-8, timestep=1e-9)
+        res = Transient(sc, epar=epar).solve(tend=1e-8, timestep=1e-9)
+        assert_array_almost_equal(res.x, resref.x)
+
+        ## Test the cache directory
+        cache = CompiledCircuitCache(os.path.join(directory, 'cache'))
+        builds = []
+        def builder():
+            builds.append(1)
+            return create_circuit()
+        
+        assert_equal(cache.load('stages'), None)
+        for k in range(2):
+            sc = cache.compile('stages', builder, epar=epar)
+            assert_equal(sc.structural_hash, structural_hash(c))
+        assert_equal(len(builds), 1)
+
+        cache.save(c, c, epar=epar)
+        assert_equal(cache.load(c).structural_hash, structural_hash(c))
+    finally:
+        shutil.rmtree(directory)
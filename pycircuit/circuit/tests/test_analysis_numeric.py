@@ -54,3 +54,316 @@ def test_noise_with_frequency_vector():
     res = noise.solve(np.array([0,1]))
     assert_array_equal(res['Svnout'], should)
 
+
+def test_ac_pencil():
+    """Test that the batched AC solvers agree with solves per frequency"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    c = SubCircuit(toolkit=numeric)
+
+    c['vs'] = VS('n0', gnd, vac=1.0)
+    for k in range(40):
+        c['R%d'%k] = R('n%d'%k, 'n%d'%(k+1), r=1e3)
+        c['C%d'%k] = C('n%d'%(k+1), gnd, c=1e-12 * (1 + k % 3))
+        c['L%d'%k] = L('n%d'%(k+1), 'm%d'%k, L=1e-6)
+        c['RL%d'%k] = R('m%d'%k, gnd, r=1e4)
+
+    freqs = np.logspace(3, 10, 50)
+    res = AC(c).solve(freqs)
+
+    ac = AC(c)
+    for k in (0, 17, 49):
+        assert_array_almost_equal(ac.solve(freqs[k]).x, res.x[:, k], 12)
+
+    ## Both methods of the pencil factorization
+    n = c.n
+    keep = np.delete(np.arange(n), c.get_node_index(gnd))
+    x = res.x[keep]
+    Gmat = c.G(np.zeros(n))[np.ix_(keep, keep)]
+    Cmat = c.C(np.zeros(n))[np.ix_(keep, keep)]
+    u = c.u(np.zeros(n), analysis='ac')[keep]
+    ss = 2j * np.pi * freqs
+    for method in 'lu', 'schur':
+        pencil = numeric.DensePencil(Gmat, Cmat, method=method)
+        assert_array_almost_equal(pencil.solve(ss, -u), x, 12)
+
+    pencil = numeric.DensePencil(Gmat + 0j, Cmat, method='schur')
+    assert_array_almost_equal(pencil.solve(ss, -u), x, 12)
+
+def test_refnode_reduction():
+    """Test removal of reference node by a reduced-index vector"""
+    from pycircuit.circuit.analysis import RefnodeReduction
+
+    A = np.arange(16.).reshape(4,4)
+    reduction = RefnodeReduction(4, 2)
+
+    assert_array_equal(reduction.reduce(A), 
+                       np.delete(np.delete(A, 2, axis=0), 2, axis=1))
+    assert_array_equal(reduction.reduce(A[0]), np.array([0., 1., 3.]))
+
+    ## Expand several solutions at once
+    X = np.array([[1., 2.], [3., 4.], [5., 6.]])
+    assert_array_equal(reduction.expand(X), 
+                       np.array([[1., 2.], [3., 4.], [0., 0.], [5., 6.]]))
+
+    ## Use a reference node that is not the ground node
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    c = SubCircuit()
+    c['vs'] = VS('net1', 'net0', v=9)
+    c['R1'] = R('net1', 'net2', r=50)
+    c['R2'] = R('net2', 'net0', r=50)
+    c['R3'] = R('net0', gnd, r=50)
+
+    res = DC(c, refnode=Node('net0')).solve()
+    assert_almost_equal(res.v('net1', 'net0'), 9)
+    assert_almost_equal(res.v('net2', 'net0'), 4.5)
+    assert_equal(res.x[c.get_node_index('net0')], 0)
+
+def test_dc_damped_newton():
+    """Test DC with junction limiting, line search and the chord method"""
+    from pycircuit.utilities import Parameter, ParameterDict
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VS('net1', gnd, v=5.)
+    c['R'] = R('net1', 'net2', r=1e2)
+    c['D'] = Diode('net2', gnd)
+
+    resref = DC(c, epar=epar, limit=False, linesearch=False).solve()
+
+    for chord in False, True:
+        res = DC(c, epar=epar, chord=chord).solve()
+        assert_almost_equal(res.v('net2'), resref.v('net2'), places=6)
+        assert_equal(res.stats['algorithm'], 'simple')
+        assert res.stats['nfactor'] <= res.stats['nit']
+
+    ## The limiting keeps the diode voltage bounded in the first iteration
+    d = Diode('net2', gnd)
+    x = d.limit(np.array([5., 0.]), np.array([0., 0.]), epar)
+    assert x[0] < 1.
+
+def test_dcsweep():
+    """Test DC sweep of instance, global and environment parameters"""
+    from pycircuit.utilities import Parameter, ParameterDict
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VS('net1', gnd, v=1.)
+    c['R1'] = R('net1', 'net2', r=1e3)
+    c['D'] = Diode('net2', gnd)
+    c['R2'] = R('net2', gnd, r='RL')
+    globalparams = ParameterDict(Parameter('RL', default=1e4))
+    c.update_iparv(globalparams=globalparams)
+
+    def dc(**kvargs):
+        return DC(c, **kvargs).solve()
+
+    ## Instance parameter
+    values = np.linspace(0, 5, 21)
+    res = DCSweep(c, epar=epar).solve(values, 'v', instance='vs')
+
+    vref = []
+    for v in values:
+        c['vs'].ipar.v = v
+        vref.append(dc(epar=epar).v('net2'))
+    c['vs'].ipar.v = 1.
+
+    assert_array_almost_equal(res.v('net2').x[0], values)
+    assert_array_almost_equal(res.v('net2').y, vref)
+    assert_array_almost_equal(res.i('vs.plus').y, 
+                              (res.v('net2').y - values) / 1e3)
+    assert_equal(c['vs'].ipar.v, 1.)
+
+    ## Global parameter
+    res = DCSweep(c, epar=epar).solve([1e2, 1e4], 'RL', 
+                                      globalparams=globalparams)
+    assert_equal(c['R2'].iparv.r, 1e4)
+    assert_almost_equal(res.v('net2').y[1], dc(epar=epar).v('net2'))
+    globalparams.RL = 1e2
+    c.update_iparv(globalparams=globalparams)
+    assert_almost_equal(res.v('net2').y[0], dc(epar=epar).v('net2'))
+
+    ## Temperature
+    res = DCSweep(c, epar=epar).solve([250., 350.], 'T')
+    for T, v in zip((250., 350.), res.v('net2').y):
+        assert_almost_equal(v, dc(epar=epar.copy(T=T)).v('net2'))
+    assert_equal(list(res.v('net2').xlabels), ['T'])
+
+def test_continuation():
+    """Test pseudo-arclength continuation through turning points"""
+    from pycircuit.circuit.analysis import continuation
+
+    ## lambda(x) has turning points at x = -1 and x = 1
+    def f(x, lam):
+        return x**3 - 3*x + 18 - 36*lam, np.diag(3*x**2 - 3), np.array([-36.])
+
+    x, infodict, ier, mesg = continuation(f, np.array([-3.]), full_output=True)
+    assert_equal(ier, 1)
+    assert_almost_equal(x[0], 3.)
+    assert infodict['nsteps'] > 2
+
+def test_dc_homotopy():
+    """Test gmin and source stepping by continuation"""
+    from pycircuit.utilities import Parameter, ParameterDict
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VS('n0', gnd, v=5.)
+    for k in range(5):
+        c['R%d'%k] = R('n%d'%k, 'n%d'%(k+1), r=1e2)
+        c['D%d'%k] = Diode('n%d'%(k+1), gnd)
+
+    dc = DC(c, epar=epar)
+    xref = dc.solve().x
+
+    for algorithm in dc._homotopy_gmin, dc._homotopy_source:
+        dc._reset_stats()
+        assert_array_almost_equal(algorithm(np.zeros(c.n)), xref)
+        assert dc.stats['nsteps'] > 0
+        assert dc.stats['nit'] > 0
+
+def test_opcache():
+    """Test sharing of DC operating points between analyses"""
+    from pycircuit.utilities import Parameter, ParameterDict
+    from pycircuit.circuit.opcache import OperatingPointCache
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VS('net1', gnd, v=1., vac=1.)
+    c['R1'] = R('net1', 'net2', r=1e3)
+    c['D'] = Diode('net2', gnd)
+
+    ## Caching is disabled by default
+    nit = [DC(c, epar=epar).solve().stats['nit'] for k in range(2)]
+    assert nit[0] > 1
+    assert_equal(nit[1], nit[0])
+
+    cache = OperatingPointCache(maxsize=2)
+
+    resref = AC(c, epar=epar).solve(1e3)
+    for k in range(2):
+        res = AC(c, epar=epar, opcache=cache).solve(1e3)
+        assert_almost_equal(res.v('net2'), resref.v('net2'))
+    assert_equal((cache.hits, cache.misses), (1, 1))
+
+    ## DC starts from the cached operating point
+    res = DC(c, epar=epar, opcache=cache).solve()
+    assert_equal(cache.hits, 2)
+    assert_equal(res.stats['nit'], 1)
+
+    ## Changed parameters and environment parameters give new entries
+    c['R1'].ipar.r = 2e3
+    DC(c, epar=epar, opcache=cache).solve()
+    DC(c, epar=epar.copy(T=350), opcache=cache).solve()
+    assert_equal((cache.hits, cache.misses), (2, 3))
+
+    ## The least recently used entry is evicted
+    assert_equal(len(cache), 2)
+    c['R1'].ipar.r = 1e3
+    AC(c, epar=epar, opcache=cache).solve(1e3)
+    assert_equal(cache.misses, 4)
+
+    cache.maxsize = 1
+    assert_equal(len(cache), 1)
+
+def test_initialguess():
+    """Test nodesets and reuse of solutions after circuit changes"""
+    import tempfile, os
+    from pycircuit.circuit.transient import Transient
+    from pycircuit.utilities import Parameter, ParameterDict
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    def create_ladder(nsections):
+        c = SubCircuit()
+        c['vs'] = VS('n0', gnd, v=5.)
+        for k in range(nsections):
+            c['R%d'%k] = R('n%d'%k, 'n%d'%(k+1), r=1e2)
+            c['D%d'%k] = Diode('n%d'%(k+1), gnd)
+        return c
+
+    c = create_ladder(20)
+    res = DC(c, epar=epar).solve()
+    nitcold = res.stats['nit']
+
+    guess = InitialGuess.from_x(c, res.x)
+    filename = os.path.join(tempfile.mkdtemp(), 'guess.txt')
+    guess.save(filename)
+    guess = InitialGuess.load(filename)
+    os.remove(filename)
+
+    ## Modify the circuit and solve from the stored solution
+    c['R5'].ipar.r = 1.1e2
+    c['R20'] = R('n20', 'n21', r=1e2)
+    c['D20'] = Diode('n21', gnd)
+
+    resref = DC(c, epar=epar).solve()
+    res = DC(c, epar=epar, initialguess=guess).solve()
+    assert_array_almost_equal(res.x, resref.x)
+    assert res.stats['nit'] < nitcold / 2
+
+    ## Partial nodeset
+    x0 = DC(c, epar=epar, nodeset={'n1': 0.7, Node('n2'): 0.6})._initial_x()
+    assert_equal(x0[c.get_node_index('n1')], 0.7)
+    assert_equal(x0[c.get_node_index('n2')], 0.6)
+    assert_equal(x0[c.get_node_index('n3')], 0)
+
+    res = DC(c, epar=epar, 
+             nodeset=guess.nodes).solve()
+    assert_array_almost_equal(res.x, resref.x)
+
+    ## Transient
+    res = Transient(c, epar=epar).solve(tend=1e-9, timestep=1e-9, 
+                                        initialguess=guess)
+    assert_array_almost_equal(res.x[:, -1], resref.x)
+
+def test_solver_stats():
+    """Test solver statistics and monitoring of the analyses"""
+    from pycircuit.circuit.transient import Transient
+    from pycircuit.utilities import Parameter, ParameterDict
+    pycircuit.circuit.circuit.default_toolkit = numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['is'] = IS(gnd, 'net1', i=57e-3)
+    c['R'] = R('net1', 'net2', r=1e1)
+    c['D'] = Diode('net2', gnd)
+    c['C'] = C('net2', gnd, c=1e-9)
+
+    events = []
+    res = DC(c, epar=epar, 
+             monitor=lambda event, info: events.append((event, info))).solve()
+    
+    stats = res.stats
+    assert_equal(stats['nsolves'], 1)
+    assert_equal(stats['algorithm'], 'simple')
+    assert stats['time_solve'] > 0 and stats['time_assembly'] > 0
+    assert stats['time_eval'] > 0
+    assert stats['time_func'] >= stats['time_assembly'] + stats['time_eval']
+    assert stats['time'] >= stats['time_func'] + stats['time_solve']
+    assert_equal(stats['norms'], [])
+
+    ## One iteration event per Newton iteration followed by the succeeded
+    ## algorithm and the final statistics
+    names = [event for event, info in events]
+    assert_equal(names, ['iteration'] * stats['nit'] + ['algorithm', 'done'])
+    assert_equal(events[-2][1], {'algorithm': 'simple', 'success': True})
+    assert events[-3][1]['xnorm'] < events[0][1]['xnorm']
+    assert_equal(c.timing, None)
+
+    res = DC(c, epar=epar, trace=True).solve()
+    assert_equal(len(res.stats['norms']), res.stats['nit'])
+
+    ## Transient
+    events = []
+    res = Transient(c, epar=epar, 
+                    monitor=lambda event, info: events.append(event)
+                    ).solve(tend=1e-8, timestep=1e-9)
+    assert_equal(res.stats['nsteps'], len(res.sweep_values))
+    assert_equal(res.stats['nsolves'], res.stats['nsteps'])
+    assert_equal(res.stats['nrejected'], 0)
+    assert_equal(events.count('step'), res.stats['nsteps'])
+    assert_equal(events.count('iteration'), res.stats['nit'])
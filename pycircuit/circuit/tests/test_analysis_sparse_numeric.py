@@ -0,0 +1,119 @@
+# -*- coding: latin-1 -*-
+# Copyright (c) 2008 Pycircuit Development Team
+# See LICENSE for details.
+
+"""Test analyses using the sparse numeric toolkit
+"""
+
+from nose.tools import *
+import pycircuit.circuit.circuit
+from pycircuit.circuit import *
+from pycircuit.circuit import sparse_numeric
+from pycircuit.circuit.transient import Transient
+from pycircuit.utilities import Parameter, ParameterDict
+import numpy as np
+import scipy.sparse
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+def create_ladder(nsections=10, toolkit=numeric):
+    """RC-ladder driven by a voltage source"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    c = SubCircuit(toolkit=toolkit)
+
+    c['vs'] = VS('n0', gnd, v=1.0, vac=1.0)
+    for k in range(nsections):
+        c['R%d'%k] = R('n%d'%k, 'n%d'%(k+1), r=1e3)
+        c['C%d'%k] = C('n%d'%(k+1), gnd, c=1e-12)
+    c['RL'] = R('n%d'%nsections, gnd, r=1e4)
+
+    return c
+
+def test_sparse_assembly():
+    """Test that the sparse toolkit assembles sparse circuit matrices"""
+    c = create_ladder(toolkit=sparse_numeric)
+    cref = create_ladder()
+
+    x = np.linspace(0, 1, c.n)
+
+    G = c.G(x)
+    assert scipy.sparse.issparse(G)
+    assert_array_almost_equal(G.toarray(), cref.G(x))
+    assert_array_almost_equal(c.C(x).toarray(), cref.C(x))
+
+def test_sparse_linearsolver():
+    """Test that factorizations with a reused column ordering are correct"""
+    A = scipy.sparse.rand(20, 20, density=0.2, random_state=0) + \
+        5 * scipy.sparse.identity(20)
+    A = scipy.sparse.csr_matrix(A)
+    b = np.arange(20.)
+
+    for scale in (1, 2):
+        x = sparse_numeric.linearsolver(scale * A, b)
+        assert_array_almost_equal(scale * A.dot(x), b)
+
+    x = sparse_numeric.linearsolver(A, 1j * b)
+    assert_array_almost_equal(A.dot(x), 1j * b)
+
+def test_sparse_delete():
+    A = scipy.sparse.csr_matrix(np.arange(9.).reshape(3,3))
+
+    (B,) = remove_row_col((A,), 1, sparse_numeric)
+
+    assert_array_equal(B.toarray(), np.array([[0., 2.], [6., 8.]]))
+
+def test_dc():
+    resref = DC(create_ladder()).solve()
+    res = DC(create_ladder(), toolkit=sparse_numeric).solve()
+
+    assert_array_almost_equal(res.x, resref.x)
+
+def test_ac():
+    freqs = np.array([1e3, 1e6, 1e9])
+    resref = AC(create_ladder()).solve(freqs)
+    res = AC(create_ladder(), toolkit=sparse_numeric).solve(freqs)
+
+    assert_array_almost_equal(res.v('n5').y, resref.v('n5').y)
+
+def test_dense_after_sparse():
+    """Test that a sparse analysis leaves the toolkit of the circuit"""
+    freqs = np.array([1e3, 1e6, 1e9])
+    resref = AC(create_ladder()).solve(freqs)
+
+    c = create_ladder()
+    DC(c, toolkit=sparse_numeric).solve()
+    AC(c, toolkit=sparse_numeric).solve(freqs)
+    Transient(c, toolkit=sparse_numeric).solve(tend=1e-9, timestep=1e-10)
+    assert c.toolkit is numeric
+    assert not scipy.sparse.issparse(c.G(np.zeros(c.n)))
+
+    res = AC(c, toolkit=numeric).solve(freqs)
+    assert_array_almost_equal(res.v('n5').y, resref.v('n5').y)
+
+    ## The toolkit is restored between the steps of the step generator
+    steps = Transient(c, toolkit=sparse_numeric).iter_solve(tend=1e-9, 
+                                                            timestep=1e-10)
+    t, x = next(steps)
+    assert c.toolkit is numeric
+    res = AC(c, toolkit=numeric).solve(freqs)
+    assert_array_almost_equal(res.v('n5').y, resref.v('n5').y)
+    t, x = next(steps)
+    assert c.toolkit is numeric
+
+def test_noise():
+    epar = ParameterDict(Parameter('T', default=300))
+    cref = create_ladder()
+    resref = Noise(cref, inputsrc='vs', outputnodes=(Node('n3'), gnd),
+                   epar=epar).solve(1e6)
+    c = create_ladder()
+    res = Noise(c, inputsrc='vs', outputnodes=(Node('n3'), gnd),
+                epar=epar, toolkit=sparse_numeric).solve(1e6)
+
+    assert_almost_equal(res['Svnout'] / resref['Svnout'], 1)
+
+def test_transient():
+    resref = Transient(create_ladder()).solve(tend=1e-8, timestep=1e-9)
+    res = Transient(create_ladder(),
+                    toolkit=sparse_numeric).solve(tend=1e-8, timestep=1e-9)
+
+    assert_array_almost_equal(res.x, resref.x)
@@ -4,15 +4,19 @@
 """Circuit element tests
 """
 
-from pycircuit.circuit.elements import VSin, ISin, IS, R, L, C, SubCircuit, gnd
-from pycircuit.circuit.transient import Transient
+from pycircuit.circuit.elements import VSin, ISin, IS, VS, R, L, C, SubCircuit, gnd
+from pycircuit.circuit.elements import VPulse, Diode
+from pycircuit.circuit.transient import Transient, Breakpoints, BatchTransient
+from pycircuit.circuit.resultwriter import ArrayWriter, MemmapWriter
 from pycircuit.circuit import circuit #new
 from math import floor
+import os
 import numpy as np
 import unittest
+from nose.tools import assert_equal, assert_raises
 
 from pycircuit.circuit import Circuit, defaultepar
-from pycircuit.utilities.param import Parameter
+from pycircuit.utilities.param import Parameter, ParameterDict
 
 class myC(Circuit):
     """Capacitor
@@ -137,6 +141,315 @@ def test_transient_get_diff():
     print iq,geq
 
 
+def test_transient_adaptive():
+    """Test of adaptive time step control of a stiff circuit with fast edge
+    and long settling
+    """
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    def create_circuit():
+        c = SubCircuit()
+        c['vs'] = VPulse(1, gnd, v1=0, v2=1, tr=1e-9, tf=1e-9, pw=1, per=2)
+        c['R'] = R(1, 2, r=1e3)
+        c['C'] = C(2, gnd, c=1e-9)
+        c['D'] = Diode(2, gnd)
+        return c
+
+    tend = 10e-6
+    for method in 'euler', 'trap', 'gear2':
+        resref = Transient(create_circuit(), epar=epar, method=method).solve(
+            tend=tend, timestep=5e-9)
+        res = Transient(create_circuit(), epar=epar, method=method, 
+                        adaptive=True).solve(tend=tend, timestep=1e-9)
+
+        assert res.stats['nsteps'] < len(resref.sweep_values) / 10
+        assert res.stats['nrejected'] < res.stats['nsteps']
+        assert_equal(res.sweep_values[-1], tend)
+        assert np.all(np.diff(res.sweep_values) <= tend / 50 * (1 + 1e-9))
+
+        vref = np.interp(res.sweep_values, resref.sweep_values, 
+                         resref.v(2).y)
+        assert np.max(abs(res.v(2).y - vref)) < 1e-2
+
+    ## Time step limits
+    res = Transient(create_circuit(), epar=epar, adaptive=True, 
+                    dtmax=1e-7).solve(tend=tend, timestep=1e-9)
+    assert np.max(np.diff(res.sweep_values)) <= 1e-7 * (1 + 1e-9)
+
+def test_transient_breakpoints():
+    """Test that adaptive time steps land on the pulse corners"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    td, tr, pw, per = 2e-6, 1e-9, 5e-6, 20e-6
+    c = SubCircuit()
+    c['vs'] = VPulse(1, gnd, v1=0, v2=1, td=td, tr=tr, tf=tr, pw=pw, per=per)
+    c['R'] = R(1, 2, r=1e3)
+    c['C'] = C(2, gnd, c=1e-10)
+
+    breakpoints = Breakpoints(c)
+    assert_equal(breakpoints.next_event(0), td)
+    assert_equal(breakpoints.next_event(td), td + tr)
+    assert_equal(breakpoints.next_event(td + tr + pw + tr), per)
+    
+    tend = 2 * per
+    res = Transient(c, epar=epar, adaptive=True).solve(tend=tend, 
+                                                       timestep=1e-9)
+    t = list(res.sweep_values)
+    for tbreak in td, td + tr, per + td, per + td + tr:
+        assert_equal(min(abs(np.array(t) - tbreak)) < 1e-18, True)
+    ## Four corners per pulse and the start of the second period
+    assert_equal(res.stats['nbreakpoints'], 9)
+
+    ## The capacitor voltage settles on the pulse plateau
+    v = res.v(2)
+    assert abs(v.y[t.index(min(t, key=lambda ti: abs(ti - td - pw)))] - 1) \
+        < 1e-3
+    assert res.stats['nsteps'] < 500
+
+def test_transient_linear():
+    """Test that linear circuits are solved by one substitution per step"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VPulse('n0', gnd, v1=0, v2=1, td=1e-9, tr=1e-9, tf=1e-9, 
+                     pw=5e-8, per=1e-7)
+    for k in range(10):
+        c['R%d'%k] = R('n%d'%k, 'n%d'%(k+1), r=10)
+        c['C%d'%k] = C('n%d'%(k+1), gnd, c=1e-13)
+        c['L%d'%k] = L('n%d'%(k+1), 'm%d'%k, L=1e-12)
+        c['RL%d'%k] = R('m%d'%k, gnd, r=1e5)
+
+    for method in 'euler', 'trap', 'gear2':
+        resref = Transient(c, epar=epar, method=method, 
+                           fastlinear=False).solve(tend=1e-8, timestep=1e-10)
+        res = Transient(c, epar=epar, method=method).solve(tend=1e-8, 
+                                                           timestep=1e-10)
+        assert np.allclose(res.x, resref.x, rtol=1e-6, atol=1e-9)
+
+        ## The first backward euler step and the following steps
+        assert res.stats['nfactor'] <= 2
+        assert_equal(res.stats['nit'], res.stats['nsteps'])
+
+        res = Transient(c, epar=epar, method=method, adaptive=True).solve(
+            tend=1e-8, timestep=1e-10)
+        assert res.stats['nfactor'] <= res.stats['nsteps'] + \
+            res.stats['nrejected']
+
+def test_transient_writer():
+    """Test that the result writers give the same result"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VSin(1, gnd, va=1, freq=1e7)
+    c['R'] = R(1, 2, r=1e3)
+    c['C'] = C(2, gnd, c=1e-12)
+
+    resref = Transient(c, epar=epar).solve(tend=1e-7, timestep=1e-9)
+
+    writer = ArrayWriter()
+    res = Transient(c, epar=epar).solve(tend=1e-7, timestep=1e-9,
+                                        writer=writer)
+    assert np.array_equal(res.x, resref.x)
+    assert np.array_equal(res.v(2).y, resref.v(2).y)
+
+    ## The reserved buffer holds exactly the time steps
+    assert_equal(len(writer), 101)
+    assert_equal(writer.capacity, len(writer))
+    writer = ArrayWriter()
+    Transient(c, epar=epar).solve(tend=2e-8, timestep=1e-10, writer=writer)
+    assert_equal(writer.capacity, len(writer))
+
+    ## Growing of the buffer
+    writer = ArrayWriter(capacity=3)
+    for t, x in zip(resref.sweep_values, resref.x.T):
+        writer.append(t, x)
+    assert writer.capacity > 3
+    t, X = writer.finish()
+    assert np.array_equal(t, resref.sweep_values)
+    assert np.array_equal(X, resref.x)
+    assert_raises(ValueError, writer.append, 0., resref.x[:, 0])
+    assert np.array_equal(X, resref.x)
+
+    writer = MemmapWriter(chunksize=7)
+    try:
+        res = Transient(c, epar=epar).solve(tend=1e-7, timestep=1e-9,
+                                            writer=writer)
+        assert isinstance(res.x, np.memmap)
+        assert_equal(len(writer), len(resref.sweep_values))
+        assert np.array_equal(res.x, resref.x)
+        assert np.array_equal(res.v(2).y, resref.v(2).y)
+        del res
+    finally:
+        os.remove(writer.filename)
+
+def test_transient_iter_solve():
+    """Test the step generator and the callbacks of the transient analysis"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VPulse(1, gnd, v1=0, v2=1, td=1e-9, tr=1e-9, tf=1e-9, 
+                     pw=5e-8, per=1e-7)
+    c['R'] = R(1, 2, r=1e3)
+    c['C'] = C(2, gnd, c=1e-12)
+    c['D'] = Diode(2, gnd)
+    i2 = c.get_node_index(c.nodenames['2'])
+
+    for adaptive in False, True:
+        tran = Transient(c, epar=epar, adaptive=adaptive)
+        resref = tran.solve(tend=2e-8, timestep=1e-10)
+
+        steps = list(tran.iter_solve(tend=2e-8, timestep=1e-10))
+        assert np.array_equal([t for t, x in steps], resref.sweep_values)
+        assert np.array_equal(np.array([x for t, x in steps]).T, resref.x)
+
+        chunks = list(tran.iter_solve(tend=2e-8, timestep=1e-10, 
+                                      chunksize=16))
+        assert np.array_equal(np.concatenate([t for t, X in chunks]),
+                              resref.sweep_values)
+        assert np.array_equal(np.concatenate([X for t, X in chunks], axis=1),
+                              resref.x)
+
+        ## Stop when the capacitor voltage crosses 0.3 V
+        tran.add_callback(lambda t, x: x[i2] > 0.3)
+        res = tran.solve(tend=2e-8, timestep=1e-10)
+        npoints = len(res.sweep_values)
+        assert res.stats['stopped']
+        assert_equal(res.stats['nsteps'], npoints)
+        assert npoints < len(resref.sweep_values)
+        assert res.x[i2, -1] > 0.3 and res.x[i2, -2] <= 0.3
+        assert np.array_equal(res.x, resref.x[:, :npoints])
+
+def test_transient_batch():
+    """Test that a batch of variants gives the results of the variants"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    def rectifier(r=1e3, IS=1e-14, v2=1):
+        c = SubCircuit()
+        c['vs'] = VPulse(1, gnd, v1=0, v2=v2, td=1e-9, tr=1e-9, tf=1e-9, 
+                         pw=5e-9, per=1e-8)
+        c['R'] = R(1, 2, r=r)
+        c['C'] = C(2, gnd, c=1e-12)
+        c['D'] = Diode(2, gnd, IS=IS)
+        return c
+
+    rs = [1e3, 2e3, 5e2, 1e3]
+    iss = [1e-14, 1e-13, 1e-14, 1e-12]
+    v2s = [1, 1.5, 0.5, 1]
+
+    for method in 'euler', 'gear2':
+        tran = BatchTransient(rectifier(), 
+                              {'R': {'r': rs}, 'D': {'IS': iss}, 
+                               'vs': {'v2': v2s}},
+                              epar=epar, method=method)
+        res = tran.solve(tend=2e-8, timestep=1e-10)
+        assert_equal(res.x.shape[1], 4)
+        assert res.stats['time_eval'] > 0
+        assert res.stats['time_assembly'] > 0
+        assert_equal(res.v(2).y.shape, (4, len(res.sweep_values[1])))
+
+        for k in range(4):
+            resref = Transient(rectifier(rs[k], iss[k], v2s[k]), epar=epar, 
+                               method=method).solve(tend=2e-8, 
+                                                    timestep=1e-10)
+            assert np.allclose(res.x[:, k], resref.x, rtol=1e-4, atol=1e-6)
+
+    ## A linear batch is solved by one LU substitution per time step
+    c = rectifier()
+    del c['D']
+    tran = BatchTransient(c, {'R': {'r': rs}}, epar=epar)
+    res = tran.solve(tend=1e-8, timestep=1e-10)
+    assert_equal(res.stats['nit'], res.stats['nsteps'])
+
+    resref = BatchTransient(c, {'R': {'r': rs}}, epar=epar, 
+                            fastlinear=False).solve(tend=1e-8, timestep=1e-10)
+    assert resref.stats['nfev'] > res.stats['nfev']
+    assert res.stats['nfactor'] <= 2 * len(rs)
+    assert np.allclose(res.x, resref.x, rtol=1e-6, atol=1e-9)
+
+    ## Unsupported features
+    for kvargs in {'method': 'bdf'}, {'adaptive': True}, {'bypass': True}:
+        assert_raises(ValueError, BatchTransient, c, {'R': {'r': rs}}, 
+                      epar=epar, **kvargs)
+    assert_raises(NotImplementedError, tran.iter_solve, tend=1e-8)
+    assert_raises(NotImplementedError, tran.add_callback, lambda t, x: None)
+
+def test_transient_bypass():
+    """Test that the bypass of latent devices keeps the transient result"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    class MyDiode(Diode):
+        eval_group = None
+
+    c = SubCircuit()
+    c['vs'] = VPulse('in', gnd, v1=0, v2=1, td=1e-9, tr=1e-9, tf=1e-9, 
+                     pw=5e-9, per=2e-8)
+    c['vb'] = VS('b', gnd, v=0.3)
+    for k in range(5):
+        c['R%d'%k] = R('in' if k == 0 else 'n%d'%(k-1), 'n%d'%k, r=100)
+        c['C%d'%k] = C('n%d'%k, gnd, c=1e-12)
+        c['D%d'%k] = Diode('n%d'%k, gnd)
+        c['RB%d'%k] = R('b', 'm%d'%k, r=1e3)
+        c['DB%d'%k] = MyDiode('m%d'%k, gnd)
+
+    for cir in c, c.compile():
+        resref = Transient(cir, epar=epar).solve(tend=2e-8, timestep=1e-10)
+        assert 'nbypass' not in resref.stats
+
+        res = Transient(cir, epar=epar, bypass=True).solve(tend=2e-8, 
+                                                           timestep=1e-10)
+        assert np.allclose(res.x, resref.x, rtol=1e-6, atol=1e-9)
+        assert res.stats['nbypass'] > 0
+        assert_equal(res.stats['bypassrate'], 
+                     res.stats['nbypass'] / float(res.stats['ndevices']))
+        assert cir.bypass is None
+
+def test_transient_bdf():
+    """Test of the variable order bdf method on a smooth nonlinear circuit"""
+    circuit.default_toolkit = circuit.numeric
+    epar = ParameterDict(Parameter('T', default=300))
+
+    def create_circuit():
+        c = SubCircuit()
+        c['vs'] = VSin(1, gnd, va=2, freq=1e5)
+        c['R'] = R(1, 2, r=1e3)
+        c['C'] = C(2, gnd, c=1e-9)
+        c['D'] = Diode(2, gnd)
+        return c
+
+    tend = 5e-5
+    resref = Transient(create_circuit(), epar=epar, method='trap').solve(
+        tend=tend, timestep=5e-9)
+
+    nsteps = {}
+    for method in 'gear2', 'bdf':
+        tran = Transient(create_circuit(), epar=epar, method=method, 
+                         adaptive=True, reltol=1e-5, dtmax=tend)
+        orders = []
+        tran.add_callback(lambda t, x: orders.append(tran._order))
+        res = tran.solve(tend=tend, timestep=1e-9)
+        nsteps[method] = res.stats['nsteps']
+        ## The sine has no breakpoints
+        assert_equal(res.stats['nbreakpoints'], 0)
+        
+    vref = np.interp(res.sweep_values, resref.sweep_values, resref.v(2).y)
+    assert np.max(abs(res.v(2).y - vref)) < 5e-3
+    assert max(orders) > 2
+    assert max(orders) <= 5
+    assert nsteps['bdf'] < nsteps['gear2']
+
+    ## Fixed time steps
+    res = Transient(create_circuit(), epar=epar, method='bdf', 
+                    maxorder=3).solve(tend=tend, timestep=5e-8)
+    vref = np.interp(res.sweep_values, resref.sweep_values, resref.v(2).y)
+    assert np.max(abs(res.v(2).y - vref)) < 5e-3
+
 if __name__ == '__main__':
     #test_transient_RC()
     test_transient_RLC()
@@ -272,6 +272,21 @@ def test_copy_circuit():
 
     assert_equal(cir, cir_copy)
 
+def test_linear_inferred():
+    """Test that elements overriding i or q are not taken as linear"""
+    class NonlinearG(Circuit):
+        terminals = ('plus', 'minus')
+        def i(self, x, epar=defaultepar):
+            return np.array([x[0]**3, -x[0]**3])
+
+    assert R(gnd, gnd).linear
+    assert not NonlinearG(gnd, gnd).linear
+    assert not Idtmod(gnd, gnd).linear
+
+    c = NonlinearG(gnd, gnd)
+    c.linear = True
+    assert c.linear
+
 def test_VCCS_tied():
     """Test VCCS with some nodes tied together"""
     pycircuit.circuit.circuit.default_toolkit = symbolic
@@ -426,3 +441,188 @@ def test_get_node():
     out = c.add_node('out')
     c['V1'] = VS(out, gnd)
     assert_equal(c.get_node('V1.plus'), out)
+
+def test_sparse_stamping():
+    """Test that sparse and dense matrix assembly give the same result"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    cir = generate_testcircuit()
+    cir['C1'] = C('plus', gnd, c=1e-12)
+    cir['L1'] = L('minus', gnd, L=1e-9)
+
+    x = np.arange(cir.n, dtype=float)
+
+    for method in ('G', 'C'):
+        dense = cir._add_element_submatrices(method, x, (defaultepar,), 
+                                             sparse=False)
+        sparse = cir._add_element_submatrices(method, x, (defaultepar,), 
+                                              sparse=True)
+        assert_array_equal(dense, getattr(cir, method)(x))
+        assert_array_equal(sparse.toarray(), dense)
+
+    ## Compare with an explicit mapping matrix per instance
+    G = np.zeros((cir.n, cir.n))
+    for instance, element in cir.elements.items():
+        nodemap = cir.elementnodemap[instance]
+        T = np.zeros((cir.n, len(nodemap)))
+        T[nodemap, range(len(nodemap))] = 1
+        G += np.dot(np.dot(T, element.G(x[nodemap])), T.T)
+    
+    assert_array_almost_equal(cir.G(x), G)
+
+def test_linear_stamp_cache():
+    """Test cached linear stamps and their invalidation"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    epar = ParameterDict(Parameter('T', default=300))
+
+    cir = generate_testcircuit()
+    cir['D1'] = Diode('plus', 'minus')
+    cir['I1']['D1'] = Diode('p', 'm')
+
+    assert_equal(sorted(cir.nonlinearinstances), ['D1', 'I1'])
+    assert not cir.linear and not cir['I1'].linear
+
+    x = np.linspace(0, 0.5, cir.n)
+
+    def reference(method):
+        result = 0
+        for instance, element in cir.elements.items():
+            nodemap = cir.elementnodemap[instance]
+            T = np.zeros((cir.n, len(nodemap)))
+            T[nodemap, range(len(nodemap))] = 1
+            rhs = getattr(element, method)(x[nodemap], epar)
+            if method in ('i', 'q'):
+                result += np.dot(T, rhs)
+            else:
+                result += np.dot(np.dot(T, rhs), T.T)
+        return result
+
+    ## Evaluate twice to use the cache
+    for k in range(2):
+        for method in ('G', 'C', 'i', 'q'):
+            assert_array_almost_equal(getattr(cir, method)(x, epar), 
+                                      reference(method))
+
+    ## Changing instance parameters must invalidate the cache
+    G0 = cir.G(x, epar)
+    cir['R1'].ipar.r = 1e3
+    assert_almost_equal(cir.G(x, epar)[0,1] - G0[0,1], -0.5e-3)
+
+    cir['I1']['R3'].ipar.r = 5e3
+    assert_array_almost_equal(cir.G(x, epar), reference('G'))
+    assert_array_almost_equal(cir.i(x, epar), reference('i'))
+
+    ## Removing the nonlinear elements makes the circuit linear
+    del cir['D1']
+    del cir['I1']['D1']
+    assert cir.linear
+    assert_equal(cir.nonlinearinstances, [])
+
+def test_evaluate():
+    """Test that evaluate returns the same quantities as the separate methods"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    epar = ParameterDict(Parameter('T', default=300))
+
+    cir = generate_testcircuit()
+    cir['D1'] = Diode('plus', 'minus')
+    cir['I1']['D1'] = Diode('p', 'm')
+    cir['VS'] = VS('plus', gnd, v=1.0)
+
+    x = np.linspace(0, 0.5, cir.n)
+
+    for circuit in cir, cir.compile():
+        res = circuit.evaluate(x, 1e-9, epar, 
+                               want=('i', 'q', 'G', 'C', 'u'))
+
+        assert_equal(sorted(res.keys()), ['C', 'G', 'i', 'q', 'u'])
+        for method in ('G', 'C', 'i', 'q'):
+            assert_array_almost_equal(res[method],
+                                      getattr(cir, method)(x, epar))
+        assert_array_almost_equal(res['u'], cir.u(1e-9, epar))
+
+        assert_equal(circuit.evaluate(x, epar=epar, want=('G',)).keys(), 
+                     ['G'])
+
+def test_incremental_node_map():
+    """Test that the incrementally updated node map equals a full update"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    cir = SubCircuit()
+    cir['V1'] = VS('n0', gnd, v=1.0)
+    cir['L1'] = L('n0', 'n1', L=1e-9)
+    for k in range(1, 5):
+        cir['R%d'%k] = R('n%d'%k, 'n%d'%(k+1), r=1e3)
+    cir.add_instance('I1', generate_testcircuit()['I1'], p='n2', m='n3')
+    cir['V2'] = VS('n5', gnd, v=1.0)
+
+    def check():
+        nodemap = dict((k, list(v)) for k, v in cir.elementnodemap.items())
+        cir.update_node_map()
+        assert_equal(nodemap, cir.elementnodemap)
+
+        for index, node in enumerate(cir.nodes):
+            assert_equal(cir.get_node_index(node), index)
+        for index, branch in enumerate(cir.branches):
+            assert_equal(cir.get_branch_index(branch), cir.n - 
+                         len(cir.branches) + index)
+
+    check()
+
+    ## Indices must follow removed nodes and branches
+    del cir['L1']
+    del cir['R2']
+    check()
+
+    ## The floating node n1 is removed from the middle of the node list
+    del cir['R1']
+    check()
+    assert Node('n1') not in cir.nodes
+    assert_equal(len(cir.nodes), len(set(cir.nodes)))
+    assert 'n1' not in cir.nodenames
+
+    cir['R6'] = R('n6', 'n7', r=1e3)
+    check()
+
+def test_batch():
+    """Test that adding instances in a batch gives the same circuit"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    class A(SubCircuit):
+        instparams = [Parameter('x', default=1e3)]
+
+    def instances():
+        yield 'V1', VS('n0', gnd, v=1.0), None
+        for k in range(5):
+            yield 'R%d'%k, R('n%d'%k, 'n%d'%(k+1), r='x'), None
+        yield 'L1', L(), {'plus': 'n5', 'minus': gnd}
+        yield 'R2', R('n2', gnd, r='2*x'), None
+
+    cref = A()
+    for name, instance, connection in instances():
+        if connection is None:
+            cref[name] = instance
+        else:
+            cref.add_instance(name, instance, **connection)
+
+    c = A()
+    c.add_instances(instances())
+
+    assert_equal(c.nodes, cref.nodes)
+    assert_equal(c.branches, cref.branches)
+    assert_equal(c.elementnodemap, cref.elementnodemap)
+    assert_equal(c['R2'].iparv.r, 2e3)
+
+    x = np.zeros(c.n)
+    assert_array_equal(c.G(x), cref.G(x))
+
+    ## Test nested batches
+    c = A()
+    with c.batch():
+        with c.batch():
+            c['R1'] = R('n1', 'n2', r='x')
+        assert_equal(c.elementnodemap, {})
+        c['R2'] = R('n2', gnd, r='x')
+    assert_equal(c.elementnodemap, {'R1': [0, 1], 'R2': [1, 2]})
+    assert_equal(c['R1'].iparv.r, 1e3)
@@ -350,5 +350,63 @@ def test_Idtmod_modulo():
     # vout = vin * t with constant input => test that v(nout) = t
     assert_array_equal(y[1:]/(x[1:]%1.0), np.ones(y[1:].size)) #avoid divide by t=0.0
 
+def test_eval_group():
+    """Test that group evaluation is equal to evaluation of each instance"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    epar = ParameterDict(Parameter('T', default=300))
+
+    elements = [[Diode(1, gnd, IS=1e-13), Diode(1, gnd, IS=3e-14)],
+                [VCVS_limited(1, gnd, 2, gnd, g=2, level=0.3),
+                 VCVS_limited(1, gnd, 2, gnd, g=5, offset=0.1)],
+                [Idtmod(1, gnd, 2, gnd, modulus=0.5, offset=0.1),
+                 Idtmod(1, gnd, 2, gnd, modulus=2.)]]
+
+    np.random.seed(0)
+
+    for group in elements:
+        elementclass = group[0].__class__
+        X = np.random.uniform(-0.5, 0.8, (len(group), group[0].n))
+        params = dict((param.name, np.array([e.iparv.get(param) 
+                                             for e in group]))
+                      for param in elementclass.instparams)
+
+        result = elementclass.eval_group(X, params, epar, 
+                                         want=('i', 'q', 'G', 'C'))
+
+        for k, element in enumerate(group):
+            for method in ('i', 'q', 'G', 'C'):
+                assert_array_almost_equal(result[method][k],
+                                          getattr(element, method)(X[k], epar))
+
+def test_subcircuit_eval_group():
+    """Test that a SubCircuit evaluates diodes as a group"""
+    pycircuit.circuit.circuit.default_toolkit = numeric
+
+    epar = ParameterDict(Parameter('T', default=300))
+
+    c = SubCircuit()
+    c['vs'] = VS(1, gnd, v=0.6)
+    for k in range(10):
+        c['R%d'%k] = R(1, k+2, r=1e3)
+        c['D%d'%k] = Diode(k+2, gnd, IS=(k+1)*1e-14)
+
+    groups, instances = c._nonlinear_groups()
+    assert_equal(len(groups), 1)
+    assert_equal(len(groups[0]), 10)
+    assert_equal(instances, [])
+
+    x = np.linspace(0, 0.6, c.n)
+
+    G = np.zeros((c.n, c.n))
+    i = np.zeros(c.n)
+    for instance, element in c.elements.items():
+        nodemap = c.elementnodemap[instance]
+        G[np.ix_(nodemap, nodemap)] += element.G(x[nodemap], epar)
+        i[nodemap] += element.i(x[nodemap], epar)
+
+    assert_array_almost_equal(c.G(x, epar), G)
+    assert_array_almost_equal(c.i(x, epar), i)
+
 if __name__ == '__main__':
     test_nullor_vva()
@@ -84,3 +84,15 @@ def test_pulse():
     assert_almost_equal(pulse.next_event(td+tr+pw+tf), per)
     assert_almost_equal(pulse.next_event(td+tr+pw+tf-eps), td+tr+pw+tf)
     assert_almost_equal(pulse.next_event(per+td/2), per+td)
+
+def test_single_pulse():
+    """Test that a pulse without period has no events after the pulse"""
+    pulse = func.Pulse(toolkit = numeric,
+                       v1=0, v2=1, td=1, tr=0.1, tf=0.1, pw=1, per=0)
+    
+    assert_almost_equal(pulse.next_event(0.5), 1)
+    assert_almost_equal(pulse.next_event(2.15), 2.2)
+    assert_equal(pulse.next_event(3), numeric.inf)
+
+    sin = func.Sin(toolkit = numeric, offset=1, amplitude=0, freq=0)
+    assert_equal(sin.next_event(0), numeric.inf)
@@ -4,12 +4,52 @@
 
 from pycircuit.circuit.analysis import *
 from pycircuit.circuit.dcanalysis import DC
-from pycircuit.circuit.dcanalysis import refnode_removed
+from pycircuit.circuit.initialguess import initial_x
+from pycircuit.circuit.resultwriter import ArrayWriter
+from pycircuit.circuit.circuit import flatten_circuit, _overrides, CircuitBatch
+import heapq
 
 class Transient(Analysis):
     """Simple transient analysis class.
 
-    Time step is fixed.
+    The time step is fixed unless the adaptive parameter is True. The 
+    time step is then controlled by the local truncation error (LTE) of 
+    the charges which is estimated from divided differences of the charge
+    history. A step where the LTE exceeds trtol times the charge tolerance
+    or where the Newton iterations fail is rejected and retried with a 
+    shorter step. The step is changed by at most the factors maxgrowth and
+    1/maxshrink and is kept between dtmin and dtmax.
+
+    With adaptive time steps the breakpoints of the time dependent 
+    sources, given by their next_event methods, are hit exactly. The 
+    breakpoints are the discontinuities of the sources, e.g. the corners
+    of a pulse, while smooth sources like sines have none. The 
+    integration is restarted with a backward Euler step of at most the 
+    initial time step after each breakpoint.
+
+    The bdf method is a variable order backward differentiation formula 
+    of order 1 to maxorder. The derivative of the charges is the 
+    derivative of the polynomial through the charges of the new and the 
+    previous time points, so the coefficients are correct for varying time
+    steps. The order is chosen after each step as the order with the 
+    largest allowed time step estimated from the LTE at the current order 
+    and at one order lower and higher. It starts at 1 and is raised by at 
+    most one after order + 1 steps at the current order.
+
+    If all elements are linear the G and C matrices are evaluated once and
+    each time step is solved by one forward and back substitution with a 
+    LU factorization that is reused as long as the time step is unchanged.
+
+    The x-vectors are stored by a result writer that is given to solve, by
+    default an ArrayWriter. A MemmapWriter streams the x-vectors to a file
+    to bound the memory use of long simulations.
+
+    The iter_solve method is a generator of the time and x-vector of each
+    accepted time step, or of arrays of chunks of steps, that lets the 
+    simulation be consumed without storing the result. Functions 
+    registered by add_callback are called as callback(t, x) after each
+    accepted step by both solve and iter_solve and the simulation is 
+    stopped after the step if a callback returns True.
 
     i(t) = c*dv/dt
     v(t) = L*di/dt
@@ -52,14 +92,21 @@ class Transient(Analysis):
     >>> expected = 0.063
     >>> abs(res.v(n1,gnd)[-1]) < 1e-1*expected #node 2 of last x
     True
+
+    The solver statistics, see Analysis, are stored in the stats attribute
+    of the result where nsteps is the number of time steps.
+    >>> res.stats['nsteps'] == len(res.sweep_values)
+    True
+
+    Stop the simulation when the capacitor voltage has settled:
+    >>> i1 = c.get_node_index(n1)
+    >>> tran = Transient(c)
+    >>> tran.add_callback(lambda t, x: t > 20e-6 and abs(x[i1]) < 1e-3)
+    >>> res = tran.solve(tend=260e-6,timestep=1e-6)
+    >>> res.sweep_values[-1] < 260e-6, res.stats['stopped']
+    (True, True)
     
     """
-    ## TODO:
-    ## * Implement automatic timestep adjustment, using difference between
-    ##   BE and trapezoidal as a measure of the error.
-    ##   Reference: "Time Step Control in Transient Analysis", by SHUBHA VIJAYCHAND
-    
-
     parameters = Analysis.parameters + \
         [Parameter(name='analysis', desc='Analysis name', 
                    #default='transient'),
@@ -77,88 +124,313 @@ class Transient(Analysis):
                    desc='Maximum number of iterations', unit='', 
                    default=100),
          Parameter(name='method', 
-                   desc='Differentiation method', unit='', 
-                   default="euler")]        
+                   desc='Differentiation method, euler, trap, gear2 or bdf', 
+                   unit='', default="euler"),
+         Parameter(name='maxorder', 
+                   desc='Maximum order of the bdf method', unit='', 
+                   default=5),
+         Parameter(name='adaptive', 
+                   desc='Adaptive time step control by local truncation error',
+                   unit='', default=False),
+         Parameter(name='qabstol', 
+                   desc='Absolute charge error tolerance', unit='C', 
+                   default=1e-14),
+         Parameter(name='trtol', 
+                   desc='Truncation error overestimation factor', unit='', 
+                   default=7.),
+         Parameter(name='dtmin', 
+                   desc='Minimum time step', unit='s', 
+                   default=1e-15),
+         Parameter(name='dtmax', 
+                   desc='Maximum time step, default is tend/50', unit='s', 
+                   default=None),
+         Parameter(name='maxgrowth', 
+                   desc='Maximum time step growth factor', unit='', 
+                   default=2.),
+         Parameter(name='maxshrink', 
+                   desc='Maximum time step reduction factor', unit='', 
+                   default=8.),
+         Parameter(name='fastlinear', 
+                   desc='Solve linear circuits by one LU substitution per '
+                   'time step', unit='', default=True)]
+
+    ## Order and error constant of the local truncation error of the methods
+    _lteconstants = {'euler': (1, 1./2), 
+                     'trap': (2, 1./12), 
+                     'trapezoidal': (2, 1./12), 
+                     'gear2': (2, 2./9)}
+
+    ## Error constants of the backward differentiation formulas by order
+    _bdfconstants = {1: 1./2, 2: 2./9, 3: 3./22, 4: 12./125, 5: 10./137}
 
     def __init__(self, cir, toolkit=None, irefnode=None, **kvargs):
         self.parameters = super(Transient, self).parameters + self.parameters            
-        super(Transient, self).__init__(cir, **kvargs)
+        super(Transient, self).__init__(cir, toolkit=toolkit, **kvargs)
     
         self._method={
             "euler":(self.toolkit.array([1.]),self.toolkit.array([0.]),1.),
             "trap":(self.toolkit.array([1.]),self.toolkit.array([0.5]),0.5),
             "trapezoidal":(self.toolkit.array([1.]),self.toolkit.array([0.5]),0.5),
-            "gear2":(self.toolkit.array([4./3,-1./3]),self.toolkit.array([0]),2./3)
+            "gear2":(self.toolkit.array([4./3,-1./3]),self.toolkit.array([0]),2./3),
+            ## The bdf coefficients are calculated from the history
+            "bdf":(self.toolkit.array([1.]),self.toolkit.array([0.]),1.)
             }
         self._qlast  = None #q history
         self._iqlast = None #dq/dt history
         
         self._dt = None
+        self._dtlast = None #previous accepted time step
+        self._dtmax = None
+        self._iq = None #dq/dt of the last step
+        self._linearGC = None #constant G and C matrices of linear circuits
+        self._linearlu = None #(b_*dt, factorization) of the linear step
         self._diff_error = None #used for saving difference between euler and trapezoidal
+        self._tolerances = None #reduced abstol and xtol vectors
+        self._history = None #(t, q) of the accepted steps, newest first
+        self._order = 1 #order of the bdf method
+        self._ordersteps = 0 #number of steps at the current bdf order
+        self._callbacks = [] #functions called after each accepted step
+
+    def add_callback(self, callback):
+        """Register a function callback(t, x) called after each accepted step
+
+        The simulation is stopped after the step if the function returns 
+        True.
+
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Remove a function registered by add_callback"""
+        self._callbacks.remove(callback)
     
     ## This is borrowed from dcanalysis.py, would like to 
     ## import it from there instead.
     ## But it's an object method requiring a DC as self
     ## so using DC._newton doesn't work
     def _newton(self, func, x0): 
-        ones_nodes = self.toolkit.ones(len(self.cir.nodes))
-        ones_branches = self.toolkit.ones(len(self.cir.branches))
-        
-        abstol = self.toolkit.concatenate((self.par.iabstol * ones_nodes,
-                                 self.par.vabstol * ones_branches))
-        xtol = self.toolkit.concatenate((self.par.vabstol * ones_nodes,
-                                 self.par.iabstol * ones_branches))
-        
-        (x0, abstol, xtol) = remove_row_col((x0, abstol, xtol), self.irefnode, self.toolkit)
+        reduction = self._refnode_reduction(self.irefnode)
+
+        ## The reduced tolerance vectors are calculated once per analysis
+        if self._tolerances is None:
+            ones_nodes = self.toolkit.ones(len(self.cir.nodes))
+            ones_branches = self.toolkit.ones(len(self.cir.branches))
+
+            abstol = self.toolkit.concatenate((self.par.iabstol * ones_nodes,
+                                     self.par.vabstol * ones_branches))
+            xtol = self.toolkit.concatenate((self.par.vabstol * ones_nodes,
+                                     self.par.iabstol * ones_branches))
+            self._tolerances = (reduction.reduce(abstol), 
+                                reduction.reduce(xtol))
+
+        abstol, xtol = self._tolerances
+        x0 = reduction.reduce(x0)
         
         try:
-            result = fsolve(refnode_removed(func, self.irefnode, self.toolkit), 
+            result = fsolve(reduction.reduced_function(func), 
                             x0, 
                             full_output = True, 
                             reltol = self.par.reltol,
                             abstol = abstol, xtol=xtol,
                             maxiter = self.par.maxiter,
-                            toolkit = self.toolkit)
+                            toolkit = self.toolkit,
+                            callback = self._iteration_callback())
         except self.toolkit.linalg.LinAlgError, e:
             raise SingularMatrix(e.message)
         
         x, infodict, ier, mesg = result
+
+        self._accumulate_stats(infodict)
         
         if ier != 1:
             raise NoConvergenceError(mesg)
         
         # Insert reference node voltage
-        return self.toolkit.concatenate((x[:self.irefnode], self.toolkit.array([0.0]), x[self.irefnode:]))
+        return reduction.expand(x)
     
     def get_timestep(self,endtime,dtmin=1e-12):
-        """Method to provide the next timestep for transient simulation.
+        """Method to provide the time points and steps of a fixed step 
+        transient simulation.
         
         """
-        ## Use the difference between euler and trapezoidal
-        ## Error as abs(self._diff_error)/abs(self._iq) - iq_tolerance
-        ## If error > 0: decrease timestep
-        ## If error < 0: increase timestep
-        
-        ## Start with simple variant:
-        ## increase as dt *=2
-        ## decrease as dt /=2
-        ## with convergence error, both decrease and reject timestep
-        ## support for rejecting timesteps need to be implemented
-        
-        iq_tolerance = 1e-2
-        iq_p = 1e4 #proportionality constant
-        iq_i = 1 #integrator constant
-        dt=self._dt
-        t=0
-        while t<endtime:
-            yield t,dt
-            de=self._diff_error
-            iq=self._iq
-            if (de != None) and (iq != None):
-                #iq_error=self.toolkit.dot(de,de)/self.toolkit.dot(iq,iq)-iq_tolerance
-                #print iq_error
-                dt = max(dt, dtmin)
-            t+=dt
+        dt=max(self._dt, dtmin)
+        for k in xrange(self.get_nsteps(endtime, dt)):
+            yield k*dt,dt
+
+    def get_nsteps(self, endtime, timestep, dtmin=1e-12):
+        """Return the number of time steps of a fixed step simulation
+
+        The time points k*timestep up to endtime are counted, including a 
+        time point that is within rounding errors of endtime.
+
+        >>> Transient(SubCircuit()).get_nsteps(1e-7, 1e-9)
+        101
+
+        """
+        return int(np.floor(endtime / max(timestep, dtmin) + 1e-9)) + 1
+
+    def get_coefficients(self):
+        """Return the coefficients a, b, b_ of the differentiation method
+
+        The coefficients of gear2 are adjusted to the ratio of the current
+        and the previous time step.
+
+        """
+        a,b,b_=self._method[self.par.method]
+        dt, dtlast = self._dt, self._dtlast
+        if self.par.method == 'gear2' and dtlast is not None and \
+                dt != dtlast:
+            w = dt / dtlast
+            a = self.toolkit.array([(1 + w)**2, -w**2]) / (1 + 2 * w)
+            b_ = (1 + w) / (1 + 2 * w)
+        return a,b,b_
+
+    def get_order(self, order=None):
+        """Return the order and LTE error constant of the method
+
+        The order of the bdf method is the current order unless given.
+
+        """
+        if self.par.method == 'bdf':
+            if order is None:
+                order = self._order
+            return order, self._bdfconstants[order]
+        return self._lteconstants[self.par.method]
+
+    def get_lte_ratio(self, q, t, history, order=None):
+        """Return the ratio of the local truncation error to its tolerance
+
+        The derivative of order k+1 of the charges, where k is the order of 
+        the method, is estimated by the divided difference of q at time t 
+        and the history of (t, q) tuples of the accepted steps, newest 
+        first.
+        None is returned if the history is too short.
+
+        """
+        order, constant = self.get_order(order)
+        if len(history) < order + 1:
+            return None
+
+        times = [t] + [th for th, qh in history[:order + 1]]
+        values = [q] + [qh for th, qh in history[:order + 1]]
+
+        ## Divided differences of increasing order
+        for j in xrange(1, order + 2):
+            values = [(values[i] - values[i + 1]) / (times[i] - times[i + j])
+                      for i in xrange(len(values) - 1)]
+
+        ## The distances to the previous time points are (order+1)!*dt**(order+1)
+        ## for constant time steps
+        spans = np.prod([t - th for th in times[1:]])
+        lte = constant * spans * abs(values[0])
+
+        qmax = self.toolkit.maximum(abs(q), abs(history[0][1]))
+        tolerance = self.par.trtol * (self.par.reltol * qmax + 
+                                      self.par.qabstol)
+
+        return np.max(lte / tolerance)
+
+    def get_next_timestep(self, ratio, order=None):
+        """Return the time step scaled by the LTE ratio and the limits"""
+        order, constant = self.get_order(order)
+        factor = min(max(self._get_step_factor(ratio, order), 
+                         1. / self.par.maxshrink), 
+                     self.par.maxgrowth)
+        return min(max(self._dt * factor, self.par.dtmin), self._dtmax)
+
+    def _get_step_factor(self, ratio, order):
+        """Return the time step factor that gives the tolerated LTE"""
+        if ratio is None:
+            return 1.
+        elif ratio == 0:
+            return self.par.maxgrowth
+        else:
+            return 0.9 * ratio**(-1. / (order + 1))
+
+    def get_next_order(self, q, t, history):
+        """Return the order of the next step of the bdf method
+
+        The LTE ratio of the step to t with the charges q is estimated at 
+        the current order and at one order lower and higher and the order 
+        that allows the longest next time step is returned. A change of 
+        order must allow a 20% longer time step. The order is only raised 
+        after order + 1 steps at the current order.
+
+        """
+        order = self._order
+        candidates = [order - 1]
+        if order < self.par.maxorder and self._ordersteps > order:
+            candidates.append(order + 1)
+
+        ratio = self.get_lte_ratio(q, t, history, order)
+        if ratio is None:
+            return order
+        bestorder, bestfactor = order, self._get_step_factor(ratio, order)
+
+        for k in candidates:
+            if k < 1:
+                continue
+            ratio = self.get_lte_ratio(q, t, history, k)
+            if ratio is None:
+                continue
+            factor = self._get_step_factor(ratio, k)
+            if factor > 1.2 * bestfactor:
+                bestorder, bestfactor = k, factor
+
+        return bestorder
+
+    def set_order(self, order):
+        """Set the order of the bdf method"""
+        if order != self._order:
+            self._order = order
+            self._ordersteps = 0
+
+    def update_history(self, t, q):
+        """Insert the charges q of the accepted step to t in the history"""
+        if self.par.method == 'bdf':
+            length = self.par.maxorder + 2
+            self._ordersteps += 1
+        else:
+            length = self.get_order()[0] + 2
+        self._history = [(t, q)] + self._history[:length - 1]
+
+    def get_bdf_coefficients(self, t):
+        """Return the coefficients of the bdf derivative of the charges
+
+        The coefficients alpha are the derivatives at t of the Lagrange 
+        basis polynomials of t and the time points of the history so the 
+        derivative is dq/dt = alpha[0]*q + sum(alpha[j]*q[j]) where q[j]
+        are the charges of the history. The order is limited by the length
+        of the history.
+
+        >>> tran = Transient(SubCircuit(), method='bdf')
+        >>> tran._history = [(1., 0.), (0., 0.)]
+        >>> tran._order = 2
+        >>> tran.get_bdf_coefficients(2.).tolist()
+        [1.5, -2.0, 0.5]
+
+        """
+        times = [t] + [th for th, qh in self._history[:self._order]]
+        order = len(times) - 1
+
+        alpha = np.zeros(order + 1)
+        alpha[0] = sum(1. / (t - times[m]) for m in xrange(1, order + 1))
+        for j in xrange(1, order + 1):
+            alpha[j] = 1. / (times[j] - t)
+            for m in xrange(1, order + 1):
+                if m != j:
+                    alpha[j] *= (t - times[m]) / (times[j] - times[m])
+        return alpha
+
+    def get_bdf_diff(self, q, C, t):
+        """Return the bdf derivative of the charges and the equivalent 
+        conductance"""
+        alpha = self.get_bdf_coefficients(t)
+        iq = alpha[0] * q
+        for j in xrange(1, len(alpha)):
+            iq = iq + alpha[j] * self._history[j - 1][1]
+        self._iq = iq
+        return iq, alpha[0] * C
     
     def get_diff(self,q,C):#shouldn't I provide an x0 here?
         """Method used to calculate time derivative for charge storing elements (i_eq and g_eq).
@@ -173,7 +445,7 @@ class Transient(Analysis):
         #the amount of history values is determined by the length of the coefficient-vector
         
         dt=self._dt
-        a,b,b_=self._method[self.par.method] 
+        a,b,b_=self.get_coefficients()
         resultEuler = (q-self._qlast[0])/dt
         if self._iqlast == None: #first step always requires backward euler
             geq=C/dt
@@ -196,75 +468,622 @@ class Transient(Analysis):
     
     def solve_timestep(self, x0, t, refnode=gnd, provided_function=None):
         #if provided_function is not None, it is called as a function with 
-        #most of what is calculated during a time_step, f,J,ueq,Geq,xlast,x
+        #the residual f, the jacobian J and the C matrix of the last 
+        #Newton iteration of the time step
         
         n=self.cir.n
         x0 = x0
         dt = self._dt
         
+        u = self.cir.u(t, self.epar, analysis=self.par.analysis)
+        last = {}
+
         def func(x):
-            C = self.cir.C(x)
-            q=self.cir.q(x)
-            iq,Geq = self.get_diff(q,C)
-            f =self.cir.i(x) + iq + self.cir.u(t, analysis=self.par.analysis)
-            J = self.cir.G(x) + Geq #return C somehow?
+            res = self.cir.evaluate(x, t, self.epar, want=('i', 'q', 'G', 'C'))
+            if self.par.method == 'bdf':
+                iq,Geq = self.get_bdf_diff(res['q'],res['C'],t)
+            else:
+                iq,Geq = self.get_diff(res['q'],res['C'])
+            f = res['i'] + iq + u
+            J = res['G'] + Geq
+            last.update(f=f, J=J, C=res['C'])
             return self.toolkit.array(f, dtype=float), self.toolkit.array(J, dtype=float)
         
-        x=self._newton(func,x0)
-        #history update
-        self._iqlast = self.toolkit.concatenate((self.toolkit.array([self._iq]),self._iqlast))[:-1]
-        self._qlast = self.toolkit.concatenate((self.toolkit.array([self.cir.q(x)]),self._qlast))[:-1]
+        if self._linearGC is not None and provided_function is None:
+            x, q = self.solve_linear_timestep(u, t)
+        else:
+            x=self._newton(func,x0)
+            q=self.cir.q(x, self.epar)
+        #history update, the bdf method uses the history of the accepted 
+        #steps instead
+        if self.par.method == 'bdf':
+            self._qlast = [q]
+        else:
+            self._iqlast = self.toolkit.concatenate((self.toolkit.array([self._iq]),self._iqlast))[:-1]
+            self._qlast = self.toolkit.concatenate((self.toolkit.array([q]),self._qlast))[:-1]
         
         # Insert reference node voltage
         #x = self.toolkit.concatenate((x[:irefnode], self.toolkit.array([0.0]), x[irefnode:]))
         if provided_function != None:
-            result=x,provided_function(f,J,C)
+            result=x,provided_function(last['f'],last['J'],last['C'])
         else:
             result=x,None
         return result
     
     
-    def solve(self, refnode=gnd, tend=1e-3, x0=None, timestep=1e-6, provided_function=None):
-        #provided_function is a function that is sent to solve_timestep for evaluation
-        
-        X = [] # will contain a list of all x-vectors
-        self.irefnode=self.cir.get_node_index(refnode)
-        n = self.cir.n
-        self._dt = timestep
-        if x0 is None:
-            x = self.toolkit.zeros(n)
+    def solve_linear_timestep(self, u, t=None):
+        """Solve a time step of a linear circuit by one substitution
+
+        The G and C matrices are constant so the equations of the step are
+        (G + C/(b_*dt))*x = a*qlast/(b_*dt) + b*iqlast/b_ - u. The LU
+        factorization of the matrix is reused as long as b_*dt is 
+        unchanged. Returns the x-vector and the charges q = C*x.
+
+        """
+        starttime = time.time()
+        G, C = self._linearGC
+        reduction = self._refnode_reduction(self.irefnode)
+
+        if self.par.method == 'bdf':
+            alpha = self.get_bdf_coefficients(t)
+            h = 1. / alpha[0]
+            rhs = -u
+            for j in xrange(1, len(alpha)):
+                rhs = rhs - alpha[j] * self._history[j - 1][1]
+        elif self._iqlast is None: #first step is backward euler
+            h = self._dt
+            rhs = self._qlast[0] / h - u
         else:
-            x = x0 
-        
-        a,b,b_=self._method[self.par.method] 
-        self._qlast=self.toolkit.zeros((len(a),n))#initialize q-history vector
-        #shift in q(x0) to q-history
-        self._qlast = self.toolkit.concatenate((self.toolkit.array([self.cir.q(x)]),self._qlast))[:-1]
-        #is this still needed
-        order=1 #number of past x-values needed
-        for i in xrange(order):
-            X.append(copy(x))
-        
-        times = self.get_timestep(tend)
-        timelist=[] #for plotting purposes
-        self._iqlast=None #forces first step to be Backward Euler
-        for t,dt in times:
-            timelist.append(t)
-            self._dt=dt
-            x,feval=self.solve_timestep(X[-1], t, provided_function=provided_function)
-            X.append(copy(x))
-        X = self.toolkit.array(X[1:]).T
-        timelist = self.toolkit.array(timelist)
+            a,b,b_=self.get_coefficients()
+            h = self._dt * b_
+            rhs = self.toolkit.dot(a, self._qlast) / h + \
+                self.toolkit.dot(b, self._iqlast) / b_ - u
+
+        nfactor = 0
+        if self._linearlu is None or self._linearlu[0] != h:
+            try:
+                lu = self.toolkit.factorize(reduction.reduce(G + C / h))
+            except self.toolkit.linearsolverError(), e:
+                raise SingularMatrix(str(e))
+            self._linearlu = h, lu
+            nfactor = 1
+
+        x = reduction.expand(self._linearlu[1].solve(reduction.reduce(rhs)))
+        q = C.dot(x)
+
+        ## Update the derivative of the charges
+        if self.par.method == 'bdf':
+            self.get_bdf_diff(q, C, t)
+        else:
+            self.get_diff(q, C)
+
+        self._accumulate_stats({'nit': 1, 'nfev': 1, 'nfactor': nfactor,
+                                'time_solve': time.time() - starttime})
+
+        return x, q
+
+    def get_step_to(self, t, dt, tstop):
+        """Return the time step and time point of the step from t
+
+        The step is shortened to land exactly on tstop and the remaining 
+        interval is split in two steps if the step would end just before 
+        tstop.
+
+        """
+        if t + dt >= tstop:
+            return tstop - t, tstop
+        if t + 1.25 * dt > tstop:
+            dt = (tstop - t) / 2.
+        return dt, t + dt
+
+    def solve_adaptive(self, x, tend, provided_function=None):
+        """Solve time steps up to tend with local truncation error control
+
+        This is a generator of the time points and x-vectors of the 
+        accepted time steps starting from the x-vector x. The first step 
+        is taken with the initial time step at t=0 like in the fixed step 
+        simulation and the last step ends at tend.
+
+        """
+        self._dtmax = self.par.dtmax or tend / 50.
+        self._dt = dtinit = min(self._dt, self._dtmax)
+        self._history = [(-self._dt, self._qlast[0])]
+
+        breakpoints = Breakpoints(self.cir, resolution=self.par.dtmin)
+        tbreak = breakpoints.next_event(0)
+        self.stats['nbreakpoints'] = 0
+
+        t = 0
+        while True:
+            state = self._qlast, self._iqlast, self._iq, self._diff_error
+
+            try:
+                xnew,feval=self.solve_timestep(x, t, provided_function=provided_function)
+            except (NoConvergenceError, SingularMatrix), e:
+                if self._dt <= self.par.dtmin:
+                    raise
+                reason = str(e)
+                dtnext = max(self._dt / self.par.maxshrink, self.par.dtmin)
+                self.set_order(1)
+            else:
+                q = self._qlast[0]
+                ratio = self.get_lte_ratio(q, t, self._history)
+
+                if ratio is None or ratio <= 1 or self._dt <= self.par.dtmin:
+                    ## Accept the step
+                    x = xnew
+                    if self.par.method == 'bdf':
+                        self.set_order(self.get_next_order(q, t, 
+                                                           self._history))
+                        ratio = self.get_lte_ratio(q, t, self._history)
+                    self.update_history(t, q)
+                    self.stats['nsteps'] += 1
+                    self._monitor('step', t=t, dt=self._dt, 
+                                  nit=self.stats['nit'])
+                    yield t, x
+
+                    if tend - t <= self.par.dtmin:
+                        break
+
+                    dtnext = self.get_next_timestep(ratio)
+                    self._dtlast = self._dt
+
+                    if t >= tbreak:
+                        ## Restart the integration after the breakpoint
+                        self._iqlast = None
+                        self._dtlast = None
+                        self._history = self._history[:1]
+                        self.set_order(1)
+                        dtnext = min(dtnext, dtinit)
+                        tbreak = breakpoints.next_event(t)
+                        self.stats['nbreakpoints'] += 1
+                        self._monitor('breakpoint', t=t)
+
+                    self._dt, t = self.get_step_to(t, dtnext, 
+                                                   min(tbreak, tend))
+                    continue
+
+                reason = 'LTE ratio %g' % ratio
+                dtnext = self.get_next_timestep(ratio)
+
+            ## Reject the step and restore the history
+            self._qlast, self._iqlast, self._iq, self._diff_error = state
+            self.stats['nrejected'] += 1
+            self._monitor('rejected', t=t, dt=self._dt, reason=reason)
+
+            self._dt = dtnext
+            if self.stats['nsteps'] == 0:
+                ## The initial x-vector is taken one time step before t=0
+                self._history = [(-dtnext, self._history[0][1])]
+            else:
+                t = self._history[0][0] + dtnext
+
+    def solve(self, refnode=gnd, tend=1e-3, x0=None, timestep=1e-6, provided_function=None,
+              nodeset=None, initialguess=None, writer=None):
+        #provided_function is a function that is sent to solve_timestep for evaluation
+        #the initial x-vector x0 can be partially overridden by the node voltages 
+        #of a nodeset dictionary and by an InitialGuess object
+        #the x-vectors are stored by the writer, an ArrayWriter by default
         
-        #print("steps: "+str( len(timelist)))
+        if writer is None:
+            writer = ArrayWriter()
+        if not self.par.adaptive:
+            writer.reserve(self.get_nsteps(tend, timestep))
+
+        for t, x in self.iter_solve(refnode=refnode, tend=tend, x0=x0, 
+                                    timestep=timestep, 
+                                    provided_function=provided_function,
+                                    nodeset=nodeset, 
+                                    initialguess=initialguess):
+            writer.append(t, x)
+        timelist, X = writer.finish()
         
         self.result = CircuitResult(self.cir, x=X, xdot=None,
                                     sweep_values=timelist, 
                                     sweep_label='time', 
                                     sweep_unit='s')
+        self.result.stats = self.stats
         
         return self.result
 
+    def iter_solve(self, refnode=gnd, tend=1e-3, x0=None, timestep=1e-6, 
+                   provided_function=None, nodeset=None, initialguess=None,
+                   chunksize=None):
+        """Generator of the time and x-vector of the accepted time steps
+
+        The arguments are the same as of solve. If chunksize is given the
+        steps are collected and yielded as a tuple of the time vector and
+        the n x npoints array of x-vectors of at most chunksize steps.
+        The simulation is stopped when the generator is closed, e.g. by 
+        breaking a for loop, and the stats attribute then holds the 
+        statistics of the steps taken so far.
+
+        >>> c = SubCircuit()
+        >>> n1 = c.add_node('net1')
+        >>> c['Is'] = IS(gnd, n1, i=1e-3)
+        >>> c['R'] = R(n1, gnd, r=1e3)
+        >>> c['C'] = C(n1, gnd, c=1e-9)
+        >>> tran = Transient(c)
+        >>> for t, x in tran.iter_solve(tend=1e-5, timestep=1e-7):
+        ...     if x[0] > 0.5: 
+        ...         break
+        >>> round(t / 1e-7), tran.stats['nsteps']
+        (7.0, 8)
+        >>> [len(t) for t, X in tran.iter_solve(tend=1e-5, timestep=1e-7, 
+        ...                                     chunksize=40)]
+        [40, 40, 21]
+
+        """
+        steps = self._iter_steps(refnode, tend, x0, timestep, 
+                                 provided_function, nodeset, initialguess)
+        try:
+            if chunksize is None:
+                for step in steps:
+                    yield step
+            else:
+                chunk = ArrayWriter(capacity=chunksize)
+                for t, x in steps:
+                    chunk.append(t, x)
+                    if len(chunk) == chunksize:
+                        yield chunk.finish()
+                        chunk = ArrayWriter(capacity=chunksize)
+                if len(chunk) > 0:
+                    yield chunk.finish()
+        finally:
+            steps.close()
+
+    def _iter_steps(self, refnode, tend, x0, timestep, provided_function,
+                    nodeset, initialguess):
+        with self._assembly_toolkit():
+            self.irefnode=self.cir.get_node_index(refnode)
+            n = self.cir.n
+            self._dt = timestep
+            self._tolerances = None
+            if x0 is None:
+                x = self.toolkit.zeros(n)
+            else:
+                x = x0 
+            if nodeset is not None or initialguess is not None:
+                x = initial_x(self.cir, x, initialguess=initialguess, 
+                              nodeset=nodeset)
+        
+            a,b,b_=self._method[self.par.method] 
+            self._qlast=self.toolkit.zeros((len(a),n))#initialize q-history vector
+            #shift in q(x0) to q-history
+            self._qlast = self.toolkit.concatenate((self.toolkit.array([self.cir.q(x, self.epar)]),self._qlast))[:-1]
+        
+            self._iqlast=None #forces first step to be Backward Euler
+            self._dtlast=None
+            self._history = [(-timestep, self._qlast[0])]
+            self.set_order(1)
+
+            ## The G and C matrices of a linear circuit are evaluated once
+            self._linearGC = None
+            self._linearlu = None
+            if self.par.fastlinear and self.cir.linear and \
+                    hasattr(self.toolkit, 'factorize') and \
+                    not self.toolkit.symbolic:
+                res = self.cir.evaluate(x, 0, self.epar, want=('G', 'C'))
+                self._linearGC = res['G'], res['C']
+        self._reset_stats(stopped=False)
+        if self.par.adaptive:
+            steps = self.solve_adaptive(x, tend, provided_function)
+        else:
+            steps = self._solve_fixed(x, tend, provided_function)
+        try:
+            while True:
+                ## The toolkit of the circuit is only replaced while a step
+                ## is solved so the circuit is left unchanged between steps
+                with self._assembly_toolkit():
+                    try:
+                        t, x = next(steps)
+                    except StopIteration:
+                        break
+                stop = [callback(t, x) for callback in self._callbacks]
+                yield t, x
+                if True in stop:
+                    self.stats['stopped'] = True
+                    self._monitor('stopped', t=t)
+                    break
+        finally:
+            steps.close()
+            self._finish_stats()
+
+    def _solve_fixed(self, x, tend, provided_function=None):
+        for t,dt in self.get_timestep(tend):
+            self._dt=dt
+            x,feval=self.solve_timestep(x, t, provided_function=provided_function)
+            if self.par.method == 'bdf':
+                q = self._qlast[0]
+                self.set_order(self.get_next_order(q, t, self._history))
+                self.update_history(t, q)
+            self.stats['nsteps'] += 1
+            self._monitor('step', t=t, dt=dt, nit=self.stats['nit'])
+            yield t, x
+
+
+class BatchTransient(Transient):
+    """Transient analysis of a batch of circuit variants
+
+    The variants, e.g. Monte Carlo samples or parameter sweeps, are given 
+    by the variations dictionary of a CircuitBatch that maps leaf instance
+    names to dictionaries of sequences of parameter values. All variants 
+    are simulated together with the same fixed time steps so the per-step
+    overhead is shared by the batch. The state is a nbatch x n array, the 
+    elements are evaluated by the vectorized code of CircuitBatch and the 
+    Newton iterations of the variants are solved by stacked linear solves.
+    If fastlinear is True the G and C matrices of a linear batch are 
+    evaluated once and a time step is solved by one forward and back 
+    substitution with the LU factorizations of the variants that are 
+    reused as long as the time step is unchanged.
+    The variable order bdf method, adaptive time steps, the bypass of 
+    latent elements and the step generator and callbacks of Transient are
+    not supported.
+
+    The x attribute of the result is a n x nbatch x npoints array and the 
+    voltages and currents are waveforms of the variant index and time.
+
+    >>> c = SubCircuit()
+    >>> n1 = c.add_node('net1')
+    >>> c['Is'] = IS(gnd, n1, i=1e-3)
+    >>> c['R'] = R(n1, gnd, r=1e3)
+    >>> c['C'] = C(n1, gnd, c=1e-9)
+    >>> tran = BatchTransient(c, {'R': {'r': [1e3, 2e3]}})
+    >>> res = tran.solve(tend=2e-5, timestep=1e-7)
+    >>> res.x.shape
+    (2, 2, 201)
+    >>> np.around(res.v(n1).y[:, -1], 2).tolist()
+    [1.0, 2.0]
+
+    """
+    def __init__(self, cir, variations={}, nbatch=None, toolkit=None, 
+                 **kvargs):
+        super(BatchTransient, self).__init__(cir, toolkit=toolkit, **kvargs)
+        for unsupported, feature in \
+                ((self.par.method == 'bdf', 'The bdf method'),
+                 (self.par.adaptive, 'Adaptive time step control'),
+                 (self.par.bypass, 'The bypass of latent elements')):
+            if unsupported:
+                raise ValueError(feature + ' is not supported by the batch '
+                                 'transient analysis')
+        self.batch = CircuitBatch(cir, variations, nbatch)
+        self.nbatch = self.batch.nbatch
+
+    def add_callback(self, callback):
+        raise NotImplementedError('Callbacks are not supported by the batch '
+                                  'transient analysis')
+
+    def iter_solve(self, *args, **kvargs):
+        raise NotImplementedError('The batch transient analysis is only '
+                                  'solved by solve()')
+
+    def solve_batch_timestep(self, X0, t):
+        """Solve a time step of the batch from the nbatch x n array X0"""
+        batch = self.batch
+        reduction = self._refnode_reduction(self.irefnode)
+        indices = reduction.indices
+        ix = np.ix_(indices, indices)
+
+        U = batch.u(t, self.epar, analysis=self.par.analysis)
+
+        ## Charge derivative iq = geq*q - iqeq
+        if self._iqlast is None: #first step is backward euler
+            geq = 1. / self._dt
+            iqeq = self._qlast[0] / self._dt
+        else:
+            a,b,b_=self.get_coefficients()
+            geq = 1. / (self._dt * b_)
+            iqeq = geq * np.tensordot(a, self._qlast, 1) + \
+                np.tensordot(b, self._iqlast, 1) / b_
+
+        if self._linearGC is not None:
+            X, q = self.solve_linear_batch_timestep(U, geq, iqeq)
+            self._update_batch_history(q, geq * q - iqeq)
+            return X
+
+        abstol, xtol = self._tolerances
+        X = X0
+        nit = 0
+        converged = False
+        starttime = time.time()
+        time_solve = 0
+        while True:
+            res = batch.evaluate(X, t, self.epar, want=('i', 'q', 'G', 'C'))
+            iq = geq * res['q'] - iqeq
+            if converged:
+                break
+
+            F = (res['i'] + iq + U)[:, indices]
+            if nit > 0 and np.all(abs(F) < self.par.reltol * abs(F).max() + 
+                                  abstol):
+                break
+            if nit >= self.par.maxiter:
+                raise NoConvergenceError('No convergence at t=%g' % t)
+
+            J = (res['G'] + geq * res['C'])[:, ix[0], ix[1]]
+
+            solvetime = time.time()
+            try:
+                dX = np.linalg.solve(J, -F[..., np.newaxis])[..., 0]
+            except np.linalg.LinAlgError, e:
+                raise SingularMatrix(str(e))
+            time_solve += time.time() - solvetime
+            nit += 1
+
+            Xnew = X.copy()
+            Xnew[:, indices] += dX
+            converged = batch.linear or \
+                np.all(abs(dX) < self.par.reltol * 
+                       np.maximum(abs(X[:, indices]), 
+                                  abs(Xnew[:, indices])) + xtol)
+            X = Xnew
+
+        self._accumulate_stats({'nit': nit, 'nfev': nit + 1, 
+                                'nfactor': nit * self.nbatch,
+                                'time_solve': time_solve,
+                                'time': time.time() - starttime})
+
+        self._update_batch_history(res['q'], iq)
+
+        return X
+
+    def solve_linear_batch_timestep(self, U, geq, iqeq):
+        """Solve a time step of a linear batch by LU substitutions
+
+        The G and C matrices are constant so the x-vectors of the step are 
+        the solution of (G + geq*C)*X = iqeq - U. The LU factorizations of
+        the matrices of the variants are reused as long as geq is unchanged.
+        Returns the x-vectors and the charges q = C*X.
+
+        """
+        starttime = time.time()
+        G, C = self._linearGC
+        indices = self._refnode_reduction(self.irefnode).indices
+
+        nfactor = 0
+        if self._linearlu is None or self._linearlu[0] != geq:
+            J = (G + geq * C)[:, indices[:, np.newaxis], indices]
+            try:
+                self._linearlu = geq, [numeric.factorize(Jk) for Jk in J]
+            except np.linalg.LinAlgError, e:
+                raise SingularMatrix(str(e))
+            nfactor = self.nbatch
+
+        X = np.zeros(U.shape)
+        X[:, indices] = [lu.solve(b) for lu, b in 
+                         zip(self._linearlu[1], (iqeq - U)[:, indices])]
+        q = np.einsum('bij,bj->bi', C, X)
+
+        self._accumulate_stats({'nit': 1, 'nfev': 1, 'nfactor': nfactor,
+                                'time_solve': time.time() - starttime})
+
+        return X, q
+
+    def _update_batch_history(self, q, iq):
+        """Insert the charges and their derivatives of a step in the 
+        history"""
+        if self._iqlast is None:
+            self._iqlast = np.zeros((len(self.get_coefficients()[1]),) + 
+                                    q.shape)
+        self._iqlast = np.concatenate((iq[np.newaxis], self._iqlast))[:-1]
+        self._qlast = np.concatenate((q[np.newaxis], self._qlast))[:-1]
+
+    def solve(self, refnode=gnd, tend=1e-3, x0=None, timestep=1e-6, 
+              writer=None):
+        """Solve the batch with fixed time steps
+
+        The initial x-vectors x0 is a vector that is used by all variants
+        or a nbatch x n array.
+
+        """
+        self.irefnode=self.cir.get_node_index(refnode)
+        nbatch, n = self.nbatch, self.cir.n
+        self._dt = timestep
+        self._dtlast = None
+
+        ## Reduced abstol and xtol vectors
+        indices = self._refnode_reduction(self.irefnode).indices
+        isnode = np.arange(n) < len(self.cir.nodes)
+        self._tolerances = \
+            (np.where(isnode, self.par.iabstol, self.par.vabstol)[indices],
+             np.where(isnode, self.par.vabstol, self.par.iabstol)[indices])
+
+        X = np.zeros((nbatch, n))
+        if x0 is not None:
+            X[:] = x0
+
+        a,b,b_=self._method[self.par.method] 
+        q = self.batch.evaluate(X, 0, self.epar, want=('q',))['q']
+        self._qlast = np.zeros((len(a), nbatch, n))
+        self._qlast[0] = q
+        self._iqlast = None #forces first step to be Backward Euler
+
+        ## The G and C matrices of a linear batch are evaluated once
+        self._linearGC = None
+        self._linearlu = None
+        if self.par.fastlinear and self.batch.linear:
+            res = self.batch.evaluate(X, 0, self.epar, want=('G', 'C'))
+            self._linearGC = res['G'], res['C']
+
+        if writer is None:
+            writer = ArrayWriter()
+        writer.reserve(self.get_nsteps(tend, timestep))
+
+        self._reset_stats()
+        try:
+            for t,dt in self.get_timestep(tend):
+                self._dt = dt
+                X = self.solve_batch_timestep(X, t)
+                writer.append(t, np.ravel(X))
+                self.stats['nsteps'] += 1
+                self._monitor('step', t=t, dt=dt, nit=self.stats['nit'])
+                self._dtlast = dt
+        finally:
+            self._finish_stats()
+        timelist, X = writer.finish()
+        
+        ## The rows of X are the x-vectors of the variants one after another
+        X = X.reshape(nbatch, n, len(timelist)).transpose(1, 0, 2)
+
+        self.result = CircuitResult(self.cir, x=X, xdot=None,
+                                    sweep_values=[np.arange(nbatch), timelist],
+                                    sweep_label=('batch', 'time'), 
+                                    sweep_unit=('', 's'))
+        self.result.stats = self.stats
+        
+        return self.result
+
+
+class Breakpoints(object):
+    """Breakpoints of the time dependent sources of a circuit
+
+    The time of the next event of each leaf element that implements 
+    next_event is kept in a heap so only the elements whose events have
+    passed are queried when the time advances. Events closer than 
+    resolution to the current time are considered as passed.
+
+    >>> from pycircuit.circuit.elements import VPulse
+    >>> c = SubCircuit()
+    >>> c['vs'] = VPulse(1, gnd, v2=1, td=1e-6, tr=1e-9, tf=1e-9, pw=1e-6)
+    >>> c['R'] = R(1, gnd, r=1e3)
+    >>> breakpoints = Breakpoints(c)
+    >>> [round(breakpoints.next_event(t) / 1e-9, 6) for t in 0, 1e-6, 1.5e-6]
+    [1000.0, 1001.0, 2001.0]
+    >>> breakpoints.next_event(3e-6)
+    inf
+
+    """
+    def __init__(self, circuit, resolution=1e-15):
+        self.resolution = resolution
+
+        if isinstance(getattr(circuit, 'elements', None), dict):
+            sources = [element 
+                       for name, element, nodemap in flatten_circuit(circuit)
+                       if _overrides(element, 'next_event', Circuit)]
+        else:
+            sources = [circuit]
+
+        ## The sources are queried at the first call to next_event
+        self._heap = [(-np.inf, k, element) 
+                      for k, element in enumerate(sources)]
+
+    def next_event(self, t):
+        """Return the time of the first breakpoint after t"""
+        tpassed = t + self.resolution + 1e-12 * abs(t)
+        heap = self._heap
+
+        while len(heap) > 0 and heap[0][0] <= tpassed:
+            tevent, k, element = heapq.heappop(heap)
+            tevent = element.next_event(tpassed)
+            if tevent <= tpassed:
+                tevent = element.next_event(tpassed + self.resolution)
+            if tpassed < tevent < np.inf:
+                heapq.heappush(heap, (tevent, k, element))
+
+        if len(heap) > 0:
+            return heap[0][0]
+        else:
+            return np.inf
 
 if __name__ == "__main__":
     import doctest
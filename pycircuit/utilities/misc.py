@@ -102,7 +102,47 @@ def create_index_vectors(indices):
         result.append((dst_i_list, src_i_list))
 
     return result
-    
+
+def create_stamp_indices(indices):
+    """Create row and column index vectors for stamping a square matrix
+
+    The returned vectors address the elements of a k x k matrix in row-major
+    order, which is the order of values.ravel(), when the matrix is scattered
+    into a larger matrix using the global indices given by *indices*.
+
+    >>> rows, cols = create_stamp_indices([2, 0])
+    >>> rows.tolist(), cols.tolist()
+    ([2, 2, 0, 0], [2, 0, 2, 0])
+
+    """
+    indices = N.asarray(indices, dtype=int)
+    k = len(indices)
+    return N.repeat(indices, k), N.tile(indices, k)
+
+def scatter_add_matrix(shape, rows, cols, values, sparse=False, dest=None):
+    """Sum values with duplicate (row, col) coordinates into a matrix
+
+    If *sparse* is True a scipy.sparse CSR matrix is returned, otherwise
+    the values are added to the dense array *dest* which is created
+    if not given.
+
+    >>> scatter_add_matrix((2,2), [0,1,0], [0,1,0], N.array([1.,2.,3.]))
+    array([[ 4.,  0.],
+           [ 0.,  2.]])
+
+    """
+    if sparse:
+        import scipy.sparse
+        return scipy.sparse.coo_matrix((values, (rows, cols)),
+                                       shape=shape).tocsr()
+
+    if dest is None:
+        dest = N.zeros(shape, dtype=N.result_type(float, values))
+
+    N.add.at(dest, (rows, cols), values)
+
+    return dest
+
 def combinations(iterable, r):
     # combinations('ABCD', 2) --> AB AC AD BC BD CD
     # combinations(range(4), 3) --> 012 013 023 123